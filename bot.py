@@ -2,32 +2,65 @@ import os
 import logging
 import sqlite3
 import re
+import sys
+import hashlib
+import threading
+import traceback
+import json
+import csv
+import gzip
+import tempfile
+import contextvars
+import signal
+from contextlib import contextmanager
+from types import MappingProxyType
 from datetime import datetime, timedelta
-from random import randint
+from random import randint, random
 import asyncio
+import time
+from collections import deque, OrderedDict, Counter
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram import Message
 from telegram.constants import ParseMode
+from telegram.error import Forbidden
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    CallbackContext,
     ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
 
+current_tenant = contextvars.ContextVar("current_tenant")  # Магазин, чей апдейт или задание сейчас обрабатывается
+
+class TenantLogFilter(logging.Filter):
+    """Имя магазина в каждой записи общего журнала"""
+
+    def filter(self, record):
+        record.tenant = getattr(current_tenant.get(None), "name", "-")
+        return True
+
 # Настройка логгирования
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(tenant)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
     handlers=[
         logging.FileHandler("bot.log"),
         logging.StreamHandler()
     ]
 )
+for log_handler in logging.getLogger().handlers:
+    log_handler.addFilter(TenantLogFilter())
 logger = logging.getLogger(__name__)
 
 # Конфигурация
@@ -37,13 +70,179 @@ COURSE_DEFAULT = 1.55
 COURSE_UNSUBSCRIBED = 1.65  # Повышенный курс для неподписанных
 MIN_STARS = 50
 REF_PERCENT = 5
+# Проценты реферальных начислений по уровням сети: первый — прямой реферер (например, REFERRAL_LEVELS="5,2,1")
+REFERRAL_LEVELS = [int(p) for p in os.getenv("REFERRAL_LEVELS", str(REF_PERCENT)).split(",")]
+REFERRAL_MAX_DEPTH = 10  # Глубина дерева рефералов, которая хранится и учитывается в обороте сети
 ADMIN_IDS = [694613924, 1012303659]  # Ваш Telegram ID. Чтобы добавить второго админа, просто добавьте его ID через запятую, например: [1012303659, 222222222]
 PAYMENTS_DIR = "payments"
 CHANNEL_USERNAME = "https://t.me/timoteo_store"  # Канал для проверки подписки
 CHECK_SUBSCRIPTION = True  # Включить проверку подписки
+LEDGER_RETENTION_DAYS = 30  # Записи журнала старше этого срока сворачиваются в контрольные точки
+LEDGER_COMPACT_INTERVAL = 24 * 60 * 60  # Интервал запуска сжатия журнала (сек)
+MAINTENANCE_INTERVAL = 60 * 60  # Интервал обслуживания БД и очистки (сек)
+UNPAID_ORDER_TTL_DAYS = 3  # Неоплаченные заказы старше этого срока удаляются
+RETENTION_BATCH_SIZE = 500  # Размер пачки при удалении старых заказов
+RETENTION_BATCH_PAUSE = 0.5  # Пауза между пачками (сек), чтобы не держать блокировку записи
+PAYMENT_FILES_RETENTION_DAYS = 90  # Срок хранения скриншотов оплаты
+ORDER_ARCHIVE_AFTER_DAYS = int(os.getenv("ORDER_ARCHIVE_AFTER_DAYS", 30))  # Оплаченные заказы старше срока переносятся в архив
+ARCHIVE_BATCH_SIZE = 500  # Размер пачки при переносе в архив
+ROLLUP_REBUILD_WINDOW = 30 * 24 * 3600  # Окно пересчёта итогов продаж за одну транзакцию (сек)
+ORDERS_PAGE_SIZE = 10  # Заказов на странице "Мои заказы"
+USER_CACHE_MAX_ENTRIES = 10000  # Максимум пользователей в кеше
+USER_CACHE_TTL = 300  # Время жизни записи кеша пользователей (сек)
+USER_STATE_MAX_RESIDENT = int(os.getenv("USER_STATE_MAX_RESIDENT", 5000))  # Сколько user_data держать в памяти, остальные — в БД
+USER_STATE_RETENTION_DAYS = 30  # Сколько хранить выгруженные user_data неактивных пользователей (дней)
+CONVERSATION_TIMEOUT = 900  # Брошенный диалог (покупка, рассылка, обмен) завершается через (сек)
+CONVERSATION_PERSIST_INTERVAL = 5  # Период записи изменившихся состояний диалогов в БД (сек)
+
+# Ограничение частоты действий: действие -> (запас токенов, пополнение в секунду)
+FLOOD_LIMITS = {
+    "default": (5, 1.0),
+    "message": (5, 1.0),
+    "profile": (2, 0.2),
+    "referrals": (2, 0.2),
+    "my_orders": (2, 0.2),
+    "daily_bonus": (2, 0.1),
+    "check_subscription": (1, 0.1),
+}
+FLOOD_MAX_BUCKETS = 50000  # Максимум бакетов в памяти
+FLOOD_IDLE_TTL = 300  # Бакет без активности дольше этого срока удаляется (сек)
+FLOOD_WARNING_TEXT = "⏳ Слишком часто. Подождите немного."
+SETTLE_FAILED_TEXT = "⚠️ База данных занята, заказ не изменён. Нажмите кнопку ещё раз."
+
+SUBSCRIPTION_API_BUDGET = int(os.getenv("SUBSCRIPTION_API_BUDGET", 60))  # Запросов get_chat_member в минуту
+SUBSCRIPTION_TTL = 600  # Как часто перепроверять подписку активных пользователей (сек)
+SUBSCRIPTION_PURCHASE_TTL = 60  # То же для пользователей в процессе покупки (сек)
+SUBSCRIPTION_PURCHASE_WINDOW = 900  # Сколько пользователь считается «в процессе покупки» (сек)
+SUBSCRIPTION_ACTIVE_WINDOW = 3600  # Сколько пользователь считается активным (сек)
+SUBSCRIPTION_MAX_TRACKED = 10000  # Максимум отслеживаемых активных пользователей
+SUBSCRIPTION_FORCE_TIMEOUT = 5  # Сколько ждать внеочередной проверки по кнопке (сек)
+
+LOOP_HEARTBEAT_INTERVAL = 0.1  # Период замера задержки цикла событий (сек)
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.25))  # Задержка, после которой фиксируется блокировка (сек)
+LOOP_STALL_STACK_DEPTH = 8  # Сколько кадров стека писать в лог при блокировке
+
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # Файл трасс в формате Chrome Trace Event (пусто — трассировка выключена)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))  # Доля апдейтов, трассы которых сохраняются
+TRACE_SLOW_MS = int(os.getenv("TRACE_SLOW_MS", 1000))  # Апдейты дольше этого сохраняются всегда (мс)
+PENDING_PAGE_SIZE = 8  # Заказов на странице очереди /pending
+LAST_SEEN_WRITE_INTERVAL = 300  # Не чаще одной записи last_seen на пользователя за этот срок (сек)
+LAST_SEEN_FLUSH_INTERVAL = 60  # Период пакетной записи last_seen (сек)
+BROADCAST_BATCH_SIZE = 500  # Получателей рассылки за один запрос к БД
+BROADCAST_ACTIVE_DAYS = (1, 7, 30)  # Варианты сегмента «активные за N дней»
+EXPORT_DEFAULT_DAYS = 30  # Период выгрузки /export по умолчанию (дней)
+FIND_PAGE_SIZE = 5  # Результатов на странице /find
+NOTIFY_RATE_PER_SEC = 20  # Ограничение скорости уведомлений покупателям (сообщений в секунду)
+ADMIN_DIGEST_ENABLED = os.getenv("ADMIN_DIGEST", "0") == "1"  # Режим сводки заказов для админов
+ADMIN_DIGEST_THRESHOLD = int(os.getenv("ADMIN_DIGEST_THRESHOLD", 10))  # Заказов в минуту, выше которых включается сводка
+ADMIN_DIGEST_INTERVAL = 30  # Интервал обновления сводки (сек)
+PAYMENT_DOWNLOAD_INTERVAL = int(os.getenv("PAYMENT_DOWNLOAD_INTERVAL", 300))  # Фоновая загрузка скриншотов (сек), 0 — только по запросу админа
+PAYMENT_DOWNLOAD_BATCH = 20  # Скриншотов за один запуск фоновой загрузки
+PAYMENT_DOWNLOAD_MAX_ATTEMPTS = 5  # Неудачных попыток фоновой загрузки, после которых скриншот грузится только по запросу админа
+
+ORDER_CONFIRMED_TEXT = "Спасибо за покупку! Ваш заказ выполнен. Буду рад если вы оставите свой отзыв здесь - @otzivi_timoteo Мой магазин со всеми товарами - @timoteo_store"
+ORDER_REJECTED_TEXT = "Ваш заказ был отклонён оператором. Если это ошибка — свяжитесь с поддержкой: {support}"
+
+PAYMENT_DETAILS = "+79652234445 Т-банк"  # Реквизиты для оплаты заказа
+STORE_TITLE = "Timoteo Store"  # Название магазина в приветствии
+SUPPORT_USERNAME = "@timoteo4"  # Контакт поддержки
+
+# ========== МАГАЗИНЫ ==========
+WORKERS = int(os.getenv("WORKERS", 0))  # Процессов-обработчиков за общим webhook (0 или 1 — всё в одном процессе)
+WORKER_SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", tempfile.gettempdir())  # Каталог unix-сокетов процессов-обработчиков
+WORKER_CONNECT_RETRY = 0.5  # Пауза между попытками подключиться к запускающемуся обработчику (сек)
+WORKER_RESTART_DELAY = 2  # Пауза перед перезапуском упавшего обработчика (сек)
+WORKER_DRAIN_TIMEOUT = 20  # Сколько при остановке ждать отправки очередей фронта и их приёма обработчиками (сек)
+WORKER_MESSAGE_LIMIT = 4 * 1024 * 1024  # Максимальный размер сообщения между фронтом и обработчиком (байт)
+WEBHOOK_QUEUE_LIMIT = 10000  # Апдейтов в очереди фронта к одному обработчику; при переполнении webhook отвечает 503
+WEBHOOK_DEDUP_WINDOW = 3600  # Сколько помнить update_id для отсева повторных доставок (сек)
+WEBHOOK_DEDUP_MAX = 100000  # Максимум запоминаемых update_id на магазин
+FRONT_STATS_INTERVAL = 60  # Период записи в лог очередей и отброшенных повторов фронта (сек)
+TENANTS_CONFIG = os.getenv("TENANTS_CONFIG", "")  # JSON-файл магазинов для запуска в одном процессе (пусто — один магазин из констант выше)
+# Поля, которые каждый магазин из TENANTS_CONFIG обязан задать сам: умолчания выше — данные Timoteo Store
+TENANT_REQUIRED_FIELDS = ("name", "admin_ids", "channel_username", "payment_details", "title", "support_username", "order_confirmed_text")
+
+class Tenant:
+    """Магазин: свой токен, своя БД и настройки, свои кеши и очереди (см. TenantLocal).
+    Цикл событий, пул HTTP-соединений, журнал и метрики — общие для всех магазинов процесса."""
+
+    def __init__(self, name, token=None, db=None, admin_ids=ADMIN_IDS, channel_username=CHANNEL_USERNAME,
+                 check_subscription=CHECK_SUBSCRIPTION, course_default=COURSE_DEFAULT,
+                 course_unsubscribed=COURSE_UNSUBSCRIBED, referral_levels=REFERRAL_LEVELS,
+                 payments_dir=None, payment_details=PAYMENT_DETAILS,
+                 order_confirmed_text=ORDER_CONFIRMED_TEXT, order_rejected_text=None,
+                 title=STORE_TITLE, support_username=SUPPORT_USERNAME):
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+            raise ValueError(f"Недопустимое имя магазина: {name!r}")
+        self.name = name
+        # Токен можно не хранить в файле конфигурации: тогда он берётся из BOT_TOKEN_<ИМЯ>
+        self.token = token or os.environ[f"BOT_TOKEN_{name.upper()}"]
+        self.db = db or f"{name}.db"
+        self.admin_ids = frozenset(admin_ids)
+        self.channel_username = channel_username
+        self.check_subscription = check_subscription
+        self.course_default = course_default
+        self.course_unsubscribed = course_unsubscribed
+        self.referral_levels = list(referral_levels)
+        self.payments_dir = payments_dir or os.path.join(PAYMENTS_DIR, name)
+        self.payment_details = payment_details
+        self.title = title
+        self.support_username = support_username
+        self.order_confirmed_text = order_confirmed_text
+        self.order_rejected_text = order_rejected_text or ORDER_REJECTED_TEXT.format(support=support_username)
+        # Telegram передаёт его в заголовке каждого апдейта — по нему общий webhook отсекает чужие запросы
+        self.webhook_secret = hashlib.sha256(self.token.encode()).hexdigest()
+        self.locals = {}  # TenantLocal -> экземпляр этого магазина
+        os.makedirs(self.payments_dir, exist_ok=True)
+
+    def local(self, proxy):
+        instance = self.locals.get(proxy)
+        if instance is None:
+            instance = self.locals[proxy] = proxy._factory()
+        return instance
+
+class TenantLocal:
+    """Объект, свой у каждого магазина (кеш, очередь, ограничитель).
+    Атрибуты берутся у экземпляра текущего магазина; экземпляр создаётся фабрикой при первом обращении."""
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+
+    def __getattr__(self, name):
+        return getattr(tenant().local(self), name)
 
-# Создаем папку для платежей
-os.makedirs(PAYMENTS_DIR, exist_ok=True)
+    def __setattr__(self, name, value):
+        setattr(tenant().local(self), name, value)
+
+default_tenant = Tenant("default", TOKEN, DB, payments_dir=PAYMENTS_DIR)
+
+def tenant():
+    """Магазин, чей апдейт или задание сейчас обрабатывается"""
+    return current_tenant.get(default_tenant)
+
+@contextmanager
+def use_tenant(store):
+    """Выполнение блока от имени магазина (инициализация, сборка приложения)"""
+    token = current_tenant.set(store)
+    try:
+        yield store
+    finally:
+        current_tenant.reset(token)
+
+def load_tenants(path):
+    """Магазины из JSON-файла: [{"name": "timoteo", "db": "timoteo_store.db", "admin_ids": [...], ...}, ...]"""
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    for number, entry in enumerate(entries, 1):
+        missing = [field for field in TENANT_REQUIRED_FIELDS if not entry.get(field)]
+        if missing:
+            raise ValueError(f"В {path} у магазина {entry.get('name') or f'№{number}'} не заданы поля: {', '.join(missing)}")
+    stores = [Tenant(**entry) for entry in entries]
+    for attr in ("name", "token", "db"):
+        values = [getattr(store, attr) for store in stores]
+        if len(set(values)) != len(values):
+            raise ValueError(f"В {path} повторяется {attr} у разных магазинов")
+    return stores
 
 # Состояния ConversationHandler
 (
@@ -61,14 +260,317 @@ os.makedirs(PAYMENTS_DIR, exist_ok=True)
 # Добавить новое состояние
 (EXCHANGE_BONUS, CONFIRM_ORDER) = (9, 10)
 
+# Статусы заказа
+ORDER_AWAITING_PAYMENT = "awaiting_payment"  # Реквизиты выданы, ждём оплату
+ORDER_CLAIMED_PAID = "claimed_paid"  # Покупатель сообщил об оплате, ждёт проверки
+ORDER_CONFIRMED = "confirmed"
+ORDER_REJECTED = "rejected"
+ORDER_EXPIRED = "expired"
+
+# Допустимые переходы: из статуса -> в статусы
+ORDER_TRANSITIONS = {
+    ORDER_AWAITING_PAYMENT: {ORDER_CLAIMED_PAID, ORDER_EXPIRED},
+    ORDER_CLAIMED_PAID: {ORDER_CONFIRMED, ORDER_REJECTED, ORDER_EXPIRED},
+}
+
+# Столбец с временем перехода в статус
+ORDER_STATUS_TIMESTAMPS = {
+    ORDER_CLAIMED_PAID: "claimed_at",
+    ORDER_CONFIRMED: "confirmed_at",
+    ORDER_REJECTED: "rejected_at",
+    ORDER_EXPIRED: "expired_at",
+}
+
+ORDER_STATUS_LABELS = {
+    ORDER_AWAITING_PAYMENT: "⏳ Ожидает оплаты",
+    ORDER_CLAIMED_PAID: "🔎 Проверяется",
+    ORDER_CONFIRMED: "✅ Оплачено",
+    ORDER_REJECTED: "❌ Отклонён",
+    ORDER_EXPIRED: "⌛ Истёк",
+}
+
+# Условие "живых" (незавершённых) заказов. Текст должен совпадать с условием
+# частичного индекса idx_orders_live, иначе SQLite его не использует.
+LIVE_ORDERS_SQL = "status IN ('awaiting_payment', 'claimed_paid')"
+TERMINAL_ORDERS_SQL = "status IN ('confirmed', 'rejected', 'expired')"
+
+# ========== МЕТРИКИ И КЕШИ ==========
+class Metrics:
+    """Счётчики и датчики процесса (просмотр через /metrics)"""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.gauges = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        return dict(self.counters), dict(self.gauges)
+
+metrics = Metrics()
+
+class UserCache:
+    """LRU-кеш строк users с ограничением по количеству записей и TTL.
+    Все пути записи в users обязаны вызывать invalidate()."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            metrics.inc("user_cache.miss")
+            return None
+        self.entries.move_to_end(user_id)
+        metrics.inc("user_cache.hit")
+        return entry[1]
+
+    def put(self, user_id, row):
+        self.entries[user_id] = (time.monotonic() + self.ttl, row)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            metrics.inc("user_cache.evicted")
+        metrics.set_gauge("user_cache.size", len(self.entries))
+
+    def invalidate(self, *user_ids):
+        self.drop(*user_ids)
+        # Строки могли быть закешированы в процессах-владельцах этих пользователей
+        if user_ids:
+            shard_link.publish(tenant().name, user_ids)
+
+    def drop(self, *user_ids):
+        for user_id in user_ids:
+            self.entries.pop(user_id, None)
+
+user_cache = TenantLocal(lambda: UserCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL))
+
+class UserState:
+    """context.user_data одного пользователя: частые ключи — в слотах, редкие (админские) — в extra.
+    Поддерживает словарный интерфейс, которым пользуются обработчики. Незаданный слот = отсутствующий ключ."""
+
+    __slots__ = (
+        "recipient_username", "stars_amount", "price", "course", "order_id",
+        "max_bonus", "main_menu_message_id", "bot_message_ids", "extra",
+    )
+    FIELDS = frozenset(__slots__) - {"extra"}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key) if key in self.FIELDS else self.extra[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        elif hasattr(self, "extra"):
+            self.extra[key] = value
+        else:
+            self.extra = {key: value}
+
+    def __delitem__(self, key):
+        try:
+            if key in self.FIELDS:
+                delattr(self, key)
+            else:
+                del self.extra[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def items(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key, getattr(self, key)
+        yield from getattr(self, "extra", {}).items()
+
+    def to_json(self):
+        return json.dumps(dict(self.items()), default=lambda value: {"__set__": sorted(value)}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data):
+        state = cls()
+        hook = lambda obj: set(obj["__set__"]) if obj.keys() == {"__set__"} else obj
+        for key, value in json.loads(data, object_hook=hook).items():
+            state[key] = value
+        return state
+
+class UserStateStore(OrderedDict):
+    """user_data всех пользователей: в памяти не больше max_resident записей (LRU),
+    вытесненные выгружаются в таблицу user_state и подгружаются при следующем обращении.
+    Записи пользователей, чьи апдейты сейчас обрабатываются, закреплены и не вытесняются:
+    обработчик продолжает менять свой UserState, и выгруженная копия оказалась бы устаревшей.
+    Запись в БД идёт в потоке, по очереди; до её завершения вытесненное состояние берётся из paging_out."""
+
+    def __init__(self, max_resident):
+        super().__init__()
+        self.max_resident = max(max_resident, 1)
+        self.pinned = Counter()  # user_id -> апдейтов этого пользователя в обработке
+        self.paging_out = {}  # user_id -> вытесненное состояние, запись которого ещё не завершилась
+        self.writer = None  # Последняя фоновая выгрузка; следующая ждёт её, чтобы старые данные не перезаписали новые
+
+    def __getitem__(self, user_id):
+        state = super().__getitem__(user_id)
+        self.move_to_end(user_id)
+        return state
+
+    def __missing__(self, user_id):
+        state = self.paging_out.pop(user_id, None)
+        if state is None:
+            data = load_user_state(user_id)
+            state = UserState.from_json(data) if data else UserState()
+            metrics.inc("user_state.loaded" if data else "user_state.created")
+        self[user_id] = state
+        self.evict()
+        metrics.set_gauge("user_state.resident", len(self))
+        return state
+
+    def pin(self, user_id):
+        self.pinned[user_id] += 1
+
+    def unpin(self, user_id):
+        self.pinned[user_id] -= 1
+        if self.pinned[user_id] <= 0:
+            del self.pinned[user_id]
+        self.evict()
+
+    def evict(self):
+        """Вытеснение давно не использованных незакреплённых записей сверх max_resident"""
+        evicted = []
+        for _ in range(len(self)):
+            if len(self) <= self.max_resident:
+                break
+            user_id, state = self.popitem(last=False)
+            if user_id in self.pinned:
+                super().__setitem__(user_id, state)  # Закреплённая запись уходит в конец очереди
+            else:
+                evicted.append((user_id, state))
+        if evicted:
+            metrics.inc("user_state.paged_out", len(evicted))
+            self.page_out(evicted)
+
+    def page_out(self, evicted):
+        """Фоновая запись вытесненных состояний; JSON снимается сразу, пока состояние не изменилось"""
+        rows = serialize_user_states(evicted)
+        self.paging_out.update(evicted)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            write_user_state_rows(rows)
+            self._paged_out(evicted)
+            return
+        self.writer = loop.create_task(self._write(self.writer, rows, evicted))
+
+    async def _write(self, previous, rows, evicted):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await asyncio.to_thread(write_user_state_rows, rows)
+        finally:
+            self._paged_out(evicted)
+
+    def _paged_out(self, evicted):
+        for user_id, state in evicted:
+            if self.paging_out.get(user_id) is state:
+                del self.paging_out[user_id]
+
+    async def flush(self):
+        """Выгрузка всех записей из памяти в БД (при остановке) после завершения фоновых выгрузок"""
+        if self.writer is not None:
+            await asyncio.wait([self.writer])
+        await asyncio.to_thread(write_user_state_rows, serialize_user_states(list(self.items())))
+
+    def resident_bytes(self):
+        """Размер записей в памяти в сериализованном виде"""
+        return sum(len(state.to_json()) for state in self.values())
+
+class FloodControl:
+    """Токен-бакеты на пару (пользователь, действие) с вытеснением простаивающих бакетов.
+    check() возвращает "allow", "warn" (первое превышение — ответить один раз) или "drop"."""
+
+    def __init__(self, limits, max_buckets, idle_ttl):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.idle_ttl = idle_ttl
+        self.buckets = OrderedDict()
+
+    def _evict(self, now):
+        # Бакеты упорядочены по последнему обращению — старые в начале
+        while self.buckets:
+            key, (_, updated, _) = next(iter(self.buckets.items()))
+            if now - updated < self.idle_ttl and len(self.buckets) < self.max_buckets:
+                break
+            self.buckets.popitem(last=False)
+
+    def check(self, user_id, action):
+        now = time.monotonic()
+        self._evict(now)
+        burst, rate = self.limits.get(action, self.limits["default"])
+        tokens, updated, warned = self.buckets.pop((user_id, action), (burst, now, False))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            verdict, tokens, warned = "allow", tokens - 1, False
+        else:
+            verdict, warned = ("drop" if warned else "warn"), True
+        self.buckets[(user_id, action)] = (tokens, now, warned)
+        metrics.set_gauge("flood.buckets", len(self.buckets))
+        return verdict
+
+flood_control = TenantLocal(lambda: FloodControl(FLOOD_LIMITS, FLOOD_MAX_BUCKETS, FLOOD_IDLE_TTL))
+
 # ========== БАЗА ДАННЫХ ==========
 def init_db():
     """Инициализация базы данных"""
     conn = None
     try:
-        conn = sqlite3.connect(DB)
+        conn = sqlite3.connect(tenant().db)
         cur = conn.cursor()
         
+        # WAL и инкрементальный VACUUM для фонового обслуживания
+        cur.execute("PRAGMA journal_mode=WAL")
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            cur.execute("VACUUM")
+        
         cur.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -78,6 +580,11 @@ def init_db():
                 referral_bonus INTEGER DEFAULT 0,
                 referrals_count INTEGER DEFAULT 0,
                 last_spin TEXT,
+                last_spin_at INTEGER,
+                subscribed INTEGER,
+                subscription_checked_at INTEGER,
+                last_seen INTEGER,
+                blocked INTEGER DEFAULT 0,
                 registration_date TEXT DEFAULT CURRENT_TIMESTAMP
             )
         """)
@@ -90,7 +597,15 @@ def init_db():
                 stars_amount INTEGER,
                 price REAL,
                 paid INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'awaiting_payment',
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                claimed_at TEXT,
+                confirmed_at TEXT,
+                rejected_at TEXT,
+                expired_at TEXT,
+                payment_file_id TEXT,
+                payment_file_unique_id TEXT,
+                payment_file_path TEXT,
                 FOREIGN KEY(user_id) REFERENCES users(user_id)
             )
         """)
@@ -112,11 +627,256 @@ def init_db():
             )
         """)
         
+        # Архив завершённых заказов (горячая таблица orders остаётся маленькой)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS orders_archive (
+                order_id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                recipient_username TEXT,
+                stars_amount INTEGER,
+                price REAL,
+                paid INTEGER DEFAULT 0,
+                status TEXT,
+                created_at TEXT,
+                claimed_at TEXT,
+                confirmed_at TEXT,
+                rejected_at TEXT,
+                expired_at TEXT,
+                payment_file_id TEXT,
+                payment_file_unique_id TEXT,
+                payment_file_path TEXT,
+                archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Итоги по архивным заказам пользователя
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_order_totals (
+                user_id INTEGER PRIMARY KEY,
+                orders_count INTEGER DEFAULT 0,
+                stars_total INTEGER DEFAULT 0,
+                price_total REAL DEFAULT 0
+            )
+        """)
+        
+        # Дерево рефералов (closure table): все пары предок -> потомок с глубиной, без строк «сам себе»
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'referral_tree'")
+        referral_tree_exists = cur.fetchone() is not None
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS referral_tree (
+                ancestor INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                descendant INTEGER NOT NULL,
+                PRIMARY KEY (ancestor, depth, descendant)
+            ) WITHOUT ROWID
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_referral_tree_descendant ON referral_tree(descendant, depth)")
+        if not referral_tree_exists:
+            cur.execute("""
+                INSERT OR IGNORE INTO referral_tree (ancestor, depth, descendant)
+                WITH RECURSIVE chain(ancestor, depth, descendant) AS (
+                    SELECT referral_id, 1, user_id FROM users WHERE referral_id IS NOT NULL
+                    UNION ALL
+                    SELECT u.referral_id, c.depth + 1, c.descendant
+                    FROM chain c JOIN users u ON u.user_id = c.ancestor
+                    WHERE u.referral_id IS NOT NULL AND c.depth < ?
+                )
+                SELECT ancestor, MIN(depth), descendant FROM chain WHERE ancestor != descendant
+                GROUP BY ancestor, descendant
+            """, (REFERRAL_MAX_DEPTH,))
+        
+        # Выгруженные из памяти user_data
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_state_updated ON user_state(updated_at)")
+        
+        # Состояния ConversationHandler: диалог продолжается после перезапуска или смены процесса-обработчика
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY (name, key)
+            )
+        """)
+        
+        # Почасовые итоги продаж (час в формате epoch, UTC)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS sales_rollup_hourly (
+                hour_ts INTEGER PRIMARY KEY,
+                orders_count INTEGER DEFAULT 0,
+                stars INTEGER DEFAULT 0,
+                revenue REAL DEFAULT 0,
+                new_users INTEGER DEFAULT 0,
+                referral_payouts INTEGER DEFAULT 0
+            )
+        """)
+        
+        # Индекс скриншотов оплаты: file_unique_id и хеш содержимого -> заказ
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS payment_evidence (
+                order_id INTEGER PRIMARY KEY,
+                file_unique_id TEXT,
+                sha256 TEXT,
+                size INTEGER,
+                duplicate_of INTEGER,
+                download_attempts INTEGER DEFAULT 0,
+                download_failed_at INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Журнал движений по балансу (только добавление)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ledger (
+                entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                stars_delta INTEGER DEFAULT 0,
+                bonus_delta INTEGER DEFAULT 0,
+                reason TEXT NOT NULL,
+                ref_type TEXT,
+                ref_id INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES users(user_id)
+            )
+        """)
+        
+        # Контрольные точки: свёрнутые старые записи журнала
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+                checkpoint_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                stars INTEGER DEFAULT 0,
+                referral_bonus INTEGER DEFAULT 0,
+                stars_delta INTEGER DEFAULT 0,
+                bonus_delta INTEGER DEFAULT 0,
+                entries_count INTEGER DEFAULT 0,
+                through_entry_id INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES users(user_id)
+            )
+        """)
+        
+        # Миграции для уже существующих баз
+        add_column_if_missing(cur, "users", "last_spin_at", "INTEGER")
+        cur.execute("""
+            UPDATE users SET last_spin_at = CAST(strftime('%s', last_spin, 'utc') AS INTEGER)
+            WHERE last_spin IS NOT NULL AND last_spin_at IS NULL
+        """)
+        add_column_if_missing(cur, "users", "subscribed", "INTEGER")
+        add_column_if_missing(cur, "users", "subscription_checked_at", "INTEGER")
+        add_column_if_missing(cur, "users", "last_seen", "INTEGER")
+        add_column_if_missing(cur, "users", "blocked", "INTEGER DEFAULT 0")
+        add_column_if_missing(cur, "payment_evidence", "download_attempts", "INTEGER DEFAULT 0")
+        add_column_if_missing(cur, "payment_evidence", "download_failed_at", "INTEGER")
+        for table in ("orders", "orders_archive"):
+            add_column_if_missing(cur, table, "status", "TEXT")
+            for column in (*ORDER_STATUS_TIMESTAMPS.values(), "payment_file_id", "payment_file_unique_id", "payment_file_path"):
+                add_column_if_missing(cur, table, column, "TEXT")
+            # Старые заказы создавались только после "оплатил": paid=0 -> на проверке
+            cur.execute(f"""
+                UPDATE {table} SET
+                    status = CASE WHEN paid = 1 THEN 'confirmed' ELSE 'claimed_paid' END,
+                    claimed_at = created_at,
+                    confirmed_at = CASE WHEN paid = 1 THEN created_at END
+                WHERE status IS NULL
+            """)
+        
         cur.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON users(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_referral_id ON users(referral_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_last_spin_at ON users(last_spin_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_blocked ON users(blocked)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users(registration_date)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_created_at ON orders_archive(created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback(created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_user_id ON orders_archive(user_id, order_id)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_orders_live ON orders(status, order_id) WHERE {LIVE_ORDERS_SQL}")
+        # Покрывающий индекс для оборота сети: соединение с деревом не читает строки заказов.
+        # status входит в ключ, иначе SQLite не считает индекс покрывающим и выбирает idx_orders_user_id.
+        # Создаётся после миграций — в старых базах столбца status до них нет
+        cur.execute("DROP INDEX IF EXISTS idx_orders_confirmed_user")
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_orders_confirmed_revenue'")
+        if cur.fetchone() is None:
+            cur.execute("CREATE INDEX idx_orders_confirmed_revenue ON orders(user_id, status, price) WHERE status = 'confirmed'")
+            # Статистика для планировщика по только что созданному индексу
+            cur.execute("ANALYZE orders")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_evidence_unique_id ON payment_evidence(file_unique_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_evidence_sha256 ON payment_evidence(sha256)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(user_id, entry_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_ledger_created ON ledger(created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_checkpoints_user ON ledger_checkpoints(user_id, checkpoint_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)")
+        
+        # Полнотекстовый поиск: отзывы (внешнее содержимое — сама таблица feedback)
+        # и получатели заказов (rowid = order_id, строка переживает перенос заказа в архив)
+        cur.execute("SELECT name FROM sqlite_master WHERE name IN ('feedback_fts', 'orders_fts')")
+        existing_fts = {row[0] for row in cur.fetchall()}
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS feedback_fts USING fts5(
+                text, content='feedback', content_rowid='feedback_id', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+                recipient_username, tokenize="unicode61 tokenchars '_'"
+            )
+        """)
+        cur.executescript("""
+            CREATE TRIGGER IF NOT EXISTS feedback_fts_insert AFTER INSERT ON feedback BEGIN
+                INSERT INTO feedback_fts (rowid, text) VALUES (new.feedback_id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS feedback_fts_delete AFTER DELETE ON feedback BEGIN
+                INSERT INTO feedback_fts (feedback_fts, rowid, text) VALUES ('delete', old.feedback_id, old.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS feedback_fts_update AFTER UPDATE OF text ON feedback BEGIN
+                INSERT INTO feedback_fts (feedback_fts, rowid, text) VALUES ('delete', old.feedback_id, old.text);
+                INSERT INTO feedback_fts (rowid, text) VALUES (new.feedback_id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS orders_fts_insert AFTER INSERT ON orders BEGIN
+                INSERT INTO orders_fts (rowid, recipient_username) VALUES (new.order_id, new.recipient_username);
+            END;
+            CREATE TRIGGER IF NOT EXISTS orders_fts_update AFTER UPDATE OF recipient_username ON orders BEGIN
+                UPDATE orders_fts SET recipient_username = new.recipient_username WHERE rowid = old.order_id;
+            END;
+            -- Архивация: сначала вставка в orders_archive, затем удаление из orders — строку поиска оставляем
+            CREATE TRIGGER IF NOT EXISTS orders_fts_delete AFTER DELETE ON orders
+            WHEN NOT EXISTS (SELECT 1 FROM orders_archive WHERE order_id = old.order_id) BEGIN
+                DELETE FROM orders_fts WHERE rowid = old.order_id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS orders_archive_fts_delete AFTER DELETE ON orders_archive BEGIN
+                DELETE FROM orders_fts WHERE rowid = old.order_id;
+            END;
+        """)
+        if "feedback_fts" not in existing_fts:
+            cur.execute("INSERT INTO feedback_fts (feedback_fts) VALUES ('rebuild')")
+        if "orders_fts" not in existing_fts:
+            cur.execute("""
+                INSERT INTO orders_fts (rowid, recipient_username)
+                SELECT order_id, recipient_username FROM orders
+                UNION ALL
+                SELECT order_id, recipient_username FROM orders_archive
+            """)
+        
+        # Начальные остатки для пользователей, у которых ещё нет истории в журнале
+        cur.execute("""
+            INSERT INTO ledger_checkpoints (user_id, stars, referral_bonus, stars_delta, bonus_delta, through_entry_id)
+            SELECT u.user_id, u.stars, u.referral_bonus, u.stars, u.referral_bonus, 0
+            FROM users u
+            WHERE (u.stars != 0 OR u.referral_bonus != 0)
+              AND NOT EXISTS (SELECT 1 FROM ledger_checkpoints c WHERE c.user_id = u.user_id)
+              AND NOT EXISTS (SELECT 1 FROM ledger l WHERE l.user_id = u.user_id)
+        """)
         
-        cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('course', ?)", (str(COURSE_DEFAULT),))
+        cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('course', ?)", (str(tenant().course_default),))
         
         conn.commit()
     except sqlite3.Error as e:
@@ -126,19 +886,27 @@ def init_db():
         if conn:
             conn.close()
 
+def add_column_if_missing(cur, table, column, definition):
+    """Добавление столбца в существующую таблицу (для миграций)"""
+    cur.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cur.fetchall()}:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 def db_connect():
     """Безопасное подключение к БД"""
     conn = None
     try:
-        conn = sqlite3.connect(DB)
+        conn = sqlite3.connect(tenant().db, factory=TracedConnection)
         conn.row_factory = sqlite3.Row
+        # Спан открывается на имя вызвавшего хелпера и закрывается в conn.close()
+        conn.begin_span(sys._getframe(1).f_code.co_name)
         return conn
     except sqlite3.Error as e:
         logger.error(f"Ошибка подключения к БД: {e}")
         raise
 
 def register_user(user_id, username, referral_id=None):
-    """Регистрация нового пользователя"""
+    """Регистрация пользователя одним UPSERT. Возвращает True для нового пользователя"""
     if referral_id == user_id:
         referral_id = None
         
@@ -146,34 +914,70 @@ def register_user(user_id, username, referral_id=None):
         conn = db_connect()
         cur = conn.cursor()
         
-        cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-        if not cur.fetchone():
+        # Вставка возвращает строку только для нового пользователя; дата регистрации —
+        # прежний CURRENT_TIMESTAMP по умолчанию. Username существующего пользователя
+        # перезаписывается только если он изменился.
+        cur.execute(
+            """
+            INSERT INTO users (user_id, username, referral_id) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO NOTHING
+            RETURNING user_id
+            """,
+            (user_id, username, referral_id),
+        )
+        is_new = cur.fetchone() is not None
+        renamed = False
+        if not is_new:
             cur.execute(
-                "INSERT INTO users (user_id, username, referral_id) VALUES (?, ?, ?)",
-                (user_id, username, referral_id),
+                "UPDATE users SET username = ? WHERE user_id = ? AND username IS NOT ?",
+                (username, user_id, username),
             )
-            if referral_id:
-                cur.execute(
-                    "UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id=?",
-                    (referral_id,),
-                )
-        else:
-            cur.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+            renamed = cur.rowcount > 0
+        if is_new and referral_id:
+            cur.execute(
+                "UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id=?",
+                (referral_id,),
+            )
+            # Новый узел дерева: реферер и все его предки (индекс по descendant), одной вставкой
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO referral_tree (ancestor, depth, descendant)
+                SELECT ?, 1, ?
+                UNION ALL
+                SELECT ancestor, depth + 1, ? FROM referral_tree
+                WHERE descendant = ? AND depth < ? AND ancestor != ?
+                """,
+                (referral_id, user_id, user_id, referral_id, REFERRAL_MAX_DEPTH, user_id),
+            )
+        if is_new:
+            bump_rollup(cur, new_users=1)
         
         conn.commit()
+        if is_new and referral_id:
+            user_cache.invalidate(user_id, referral_id)
+        elif is_new or renamed:
+            user_cache.invalidate(user_id)
+        return is_new
     except sqlite3.Error as e:
         logger.error(f"Ошибка регистрации пользователя: {e}")
+        return False
     finally:
         if conn:
             conn.close()
 
 def get_user(user_id):
-    """Получение данных пользователя"""
+    """Получение данных пользователя (через кеш)"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
     try:
         conn = db_connect()
         cur = conn.cursor()
         cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-        return cur.fetchone()
+        user = cur.fetchone()
+        if user is not None:
+            user_cache.put(user_id, user)
+        return user
     except sqlite3.Error as e:
         logger.error(f"Ошибка получения пользователя: {e}")
         return None
@@ -182,184 +986,1229 @@ def get_user(user_id):
             conn.close()
 
 async def check_subscription(user_id, context):
-    """Проверка подписки пользователя на канал"""
+    """Проверка подписки пользователя на канал через Telegram (None — проверить не удалось)"""
+    # Извлекаем username из полного URL
+    channel_username = tenant().channel_username
+    if channel_username.startswith('https://t.me/'):
+        channel_username = channel_username.replace('https://t.me/', '')
+    else:
+        channel_username = channel_username.replace('@', '')
+    
+    # Добавляем @ если его нет
+    if not channel_username.startswith('@'):
+        channel_username = '@' + channel_username
+    
     try:
-        # Извлекаем username из полного URL
-        if CHANNEL_USERNAME.startswith('https://t.me/'):
-            channel_username = CHANNEL_USERNAME.replace('https://t.me/', '')
-        else:
-            channel_username = CHANNEL_USERNAME.replace('@', '')
-        
-        # Добавляем @ если его нет
-        if not channel_username.startswith('@'):
-            channel_username = '@' + channel_username
-            
-        logger.info(f"Проверяем подписку для {user_id} в канале {channel_username}")
-        
-        # Сначала проверим, существует ли канал
-        try:
-            chat = await context.bot.get_chat(channel_username)
-            logger.info(f"Канал найден: {chat.title} (ID: {chat.id})")
-        except Exception as e:
-            logger.error(f"Канал {channel_username} не найден или недоступен: {e}")
-            # Если канал недоступен, считаем пользователя неподписанным
-            return False
-        
-        # Проверяем подписку пользователя
-        try:
-            chat_member = await context.bot.get_chat_member(channel_username, user_id)
-            logger.info(f"Статус участника {user_id}: {chat_member.status}")
-            
-            # Проверяем все возможные статусы подписки
-            is_subscribed = chat_member.status in ['member', 'administrator', 'creator', 'owner']
-            logger.info(f"Результат проверки подписки для {user_id}: {is_subscribed}")
-            
-            return is_subscribed
-        except Exception as e:
-            logger.error(f"Ошибка при получении статуса участника {user_id}: {e}")
-            return False
-            
+        chat_member = await context.bot.get_chat_member(channel_username, user_id)
+        # Проверяем все возможные статусы подписки
+        is_subscribed = chat_member.status in ['member', 'administrator', 'creator', 'owner']
+        logger.info(f"Результат проверки подписки для {user_id}: {is_subscribed} ({chat_member.status})")
+        return is_subscribed
     except Exception as e:
-        logger.error(f"Общая ошибка проверки подписки для {user_id}: {e}")
-        return False
-
-def get_user_course(user_id, context):
-    """Получение курса для пользователя с учётом подписки"""
-    # Пока что возвращаем стандартный курс, подписка будет проверяться асинхронно
-    return COURSE_DEFAULT
+        logger.error(f"Ошибка при получении статуса участника {user_id} в канале {channel_username}: {e}")
+        return None
 
-def update_stars(user_id, amount):
-    """Обновление баланса звёзд"""
+def save_subscription(user_id, subscribed):
+    """Сохранение результата проверки подписки с отметкой времени"""
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute("UPDATE users SET stars = stars + ? WHERE user_id=?", (amount, user_id))
+        cur.execute(
+            "UPDATE users SET subscribed=?, subscription_checked_at=? WHERE user_id=?",
+            (int(subscribed), int(time.time()), user_id),
+        )
         conn.commit()
+        user_cache.invalidate(user_id)
     except sqlite3.Error as e:
-        logger.error(f"Ошибка обновления звёзд: {e}")
+        logger.error(f"Ошибка сохранения подписки: {e}")
     finally:
         if conn:
             conn.close()
 
-def add_order(user_id, recipient_username, stars_amount, price, paid=0):
-    """Добавление нового заказа"""
+def load_user_state(user_id):
+    """Выгруженные user_data пользователя (JSON) или None"""
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO orders (user_id, recipient_username, stars_amount, price, paid) VALUES (?, ?, ?, ?, ?)",
-            (user_id, recipient_username, stars_amount, price, paid),
-        )
-        conn.commit()
+        cur.execute("SELECT data FROM user_state WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
     except sqlite3.Error as e:
-        logger.error(f"Ошибка добавления заказа: {e}")
+        logger.error(f"Ошибка загрузки состояния пользователя: {e}")
+        return None
     finally:
         if conn:
             conn.close()
 
-def get_orders(user_id):
-    """Получение списка заказов пользователя"""
+def serialize_user_states(states):
+    """Пары (user_id, UserState) -> (строки для записи, user_id пустых состояний для удаления)"""
+    now = int(time.time())
+    rows = [(user_id, state.to_json(), now) for user_id, state in states if len(state)]
+    empty = [(user_id,) for user_id, state in states if not len(state)]
+    return rows, empty
+
+def write_user_state_rows(serialized):
+    """Запись результата serialize_user_states одной транзакцией (вызывается вне цикла событий)"""
+    rows, empty = serialized
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE user_id=? ORDER BY created_at DESC", (user_id,))
-        return cur.fetchall()
+        cur.executemany(
+            """
+            INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+            """,
+            rows,
+        )
+        cur.executemany("DELETE FROM user_state WHERE user_id=?", empty)
+        conn.commit()
     except sqlite3.Error as e:
-        logger.error(f"Ошибка получения заказов: {e}")
-        return []
+        logger.error(f"Ошибка выгрузки состояния пользователей: {e}")
     finally:
         if conn:
             conn.close()
 
-def get_setting(key):
-    """Получение значения настройки"""
+def load_conversations(name):
+    """Сохранённые состояния диалогов ConversationHandler: {(chat_id, user_id): состояние}"""
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key=?", (key,))
-        res = cur.fetchone()
-        return res[0] if res else None
+        cur.execute("SELECT key, state FROM conversation_state WHERE name=?", (name,))
+        return {tuple(json.loads(key)): state for key, state in cur.fetchall()}
     except sqlite3.Error as e:
-        logger.error(f"Ошибка получения настройки: {e}")
-        return None
+        logger.error(f"Ошибка загрузки состояний диалогов: {e}")
+        return {}
     finally:
         if conn:
             conn.close()
 
-def set_setting(key, value):
-    """Установка значения настройки"""
+def save_conversation(name, key, state):
+    """Запись состояния диалога; None — диалог завершён, запись удаляется"""
     try:
         conn = db_connect()
         cur = conn.cursor()
-        if get_setting(key) is None:
-            cur.execute("INSERT INTO settings (key, value) VALUES (?, ?)", (key, value))
+        if state is None:
+            cur.execute("DELETE FROM conversation_state WHERE name=? AND key=?", (name, json.dumps(list(key))))
         else:
-            cur.execute("UPDATE settings SET value=? WHERE key=?", (value, key))
+            cur.execute(
+                """
+                INSERT INTO conversation_state (name, key, state, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(name, key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+                """,
+                (name, json.dumps(list(key)), state, int(time.time())),
+            )
         conn.commit()
     except sqlite3.Error as e:
-        logger.error(f"Ошибка установки настройки: {e}")
+        logger.error(f"Ошибка записи состояния диалога: {e}")
     finally:
         if conn:
             conn.close()
 
-def add_feedback(user_id, text):
-    """Добавление отзыва"""
+def prune_user_states():
+    """Удаление выгруженных user_data и состояний диалогов пользователей, неактивных дольше USER_STATE_RETENTION_DAYS"""
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO feedback (user_id, text) VALUES (?, ?)",
-            (user_id, text),
-        )
+        cutoff = int(time.time()) - USER_STATE_RETENTION_DAYS * 86400
+        cur.execute("DELETE FROM conversation_state WHERE updated_at < ?", (cutoff,))
+        cur.execute("DELETE FROM user_state WHERE updated_at < ?", (cutoff,))
         conn.commit()
+        return cur.rowcount
     except sqlite3.Error as e:
-        logger.error(f"Ошибка добавления отзыва: {e}")
+        logger.error(f"Ошибка очистки состояния пользователей: {e}")
+        return 0
     finally:
         if conn:
             conn.close()
 
-def clean_old_data():
-    """Очистка старых данных"""
+class ActivityTracker:
+    """Отметки last_seen: не чаще раза в LAST_SEEN_WRITE_INTERVAL на пользователя, запись пачкой из задания"""
+
+    def __init__(self, write_interval):
+        self.write_interval = write_interval
+        self.pending = {}  # user_id -> время активности, ещё не записанное в БД
+        self.written = {}  # user_id -> время последней отметки
+
+    def seen(self, user_id):
+        now = int(time.time())
+        if now - self.written.get(user_id, 0) >= self.write_interval:
+            self.written[user_id] = now
+            self.pending[user_id] = now
+
+    def flush(self):
+        now = int(time.time())
+        self.written = {uid: ts for uid, ts in self.written.items() if now - ts < self.write_interval}
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            conn = db_connect()
+            cur = conn.cursor()
+            # Пользователь снова пишет боту — значит, больше не заблокировал его
+            cur.executemany(
+                "UPDATE users SET last_seen=?, blocked=0 WHERE user_id=?",
+                [(ts, uid) for uid, ts in pending.items()],
+            )
+            conn.commit()
+            user_cache.invalidate(*pending)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи last_seen: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+activity_tracker = TenantLocal(lambda: ActivityTracker(LAST_SEEN_WRITE_INTERVAL))
+
+def mark_blocked(user_id):
+    """Пользователь заблокировал бота — исключаем его из рассылок"""
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute("DELETE FROM orders WHERE paid = 0 AND created_at < datetime('now', '-3 days')")
+        cur.execute("UPDATE users SET blocked=1 WHERE user_id=?", (user_id,))
         conn.commit()
-        logger.info("Очистка старых данных выполнена")
+        user_cache.invalidate(user_id)
     except sqlite3.Error as e:
-        logger.error(f"Ошибка очистки данных: {e}")
+        logger.error(f"Ошибка отметки блокировки: {e}")
     finally:
         if conn:
             conn.close()
 
-# ========== КЛАВИАТУРЫ ==========
-def main_menu_keyboard(is_subscribed=True):
-    keyboard = [
-        [InlineKeyboardButton("⭐️ Купить звёзды", callback_data="buy")],
-        [InlineKeyboardButton("🎁 Ежедневный бонус", callback_data="daily_bonus")],
-        [InlineKeyboardButton("🤝 Рефералы", callback_data="referrals")],
-        [InlineKeyboardButton("🧾 Профиль", callback_data="profile")],
-        [InlineKeyboardButton("📝 Оставить отзыв", callback_data="feedback")],
-    ]
-    
-    # Добавляем кнопки подписки только для неподписанных
-    if not is_subscribed:
-        keyboard.extend([
-            [InlineKeyboardButton("🔗 Подписаться на канал", url=CHANNEL_USERNAME)],
-            [InlineKeyboardButton("✅ Проверить подписку", callback_data="check_subscription")],
-        ])
-    
-    return InlineKeyboardMarkup(keyboard)
+# Сегменты рассылки: имя -> (подпись, условие на users)
+BROADCAST_SEGMENTS = {
+    "all": ("👥 Все", "1"),
+    "active": ("🟢 Активные", "last_seen >= ?"),
+    "subscribed": ("✅ Подписчики канала", "subscribed = 1"),
+    "buyers": ("🛒 Покупатели", """(
+        EXISTS (SELECT 1 FROM orders o WHERE o.user_id = users.user_id AND o.status = 'confirmed')
+        OR EXISTS (SELECT 1 FROM user_order_totals t WHERE t.user_id = users.user_id AND t.orders_count > 0))"""),
+    "referrers": ("🤝 Пригласившие друзей", "referrals_count > 0"),
+}
 
-def admin_menu_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("⚙️ Установить курс", callback_data="set_course")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
-        [InlineKeyboardButton("📢 Рассылка", callback_data="broadcast")],
+def broadcast_filter(segment, days=None):
+    """Условие WHERE и параметры для сегмента рассылки (заблокировавшие бота исключаются всегда)"""
+    condition = BROADCAST_SEGMENTS[segment][1]
+    params = (int(time.time()) - days * 86400,) if segment == "active" else ()
+    return f"blocked = 0 AND {condition}", params
+
+def count_broadcast_audience(segment, days=None):
+    """Размер аудитории сегмента"""
+    where, params = broadcast_filter(segment, days)
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params)
+        return cur.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка подсчёта аудитории рассылки: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def get_broadcast_batch(segment, days, after_id, limit=BROADCAST_BATCH_SIZE):
+    """Следующая пачка получателей после after_id"""
+    where, params = broadcast_filter(segment, days)
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT user_id FROM users WHERE {where} AND user_id > ? ORDER BY user_id LIMIT ?",
+            (*params, after_id, limit),
+        )
+        return [row[0] for row in cur.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения получателей рассылки: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def iter_broadcast_audience(segment, days=None):
+    """Получатели рассылки пачками по ключу — без загрузки всей таблицы и без долгой транзакции чтения"""
+    after_id = 0
+    while True:
+        batch = get_broadcast_batch(segment, days, after_id)
+        if not batch:
+            return
+        yield from batch
+        after_id = batch[-1]
+
+def get_user_course(user_id, context):
+    """Получение курса для пользователя с учётом подписки"""
+    # Пока что возвращаем стандартный курс, подписка будет проверяться асинхронно
+    return tenant().course_default
+
+def append_ledger(cur, user_id, reason, stars=0, bonus=0, ref_type=None, ref_id=None):
+    """Запись в журнал без изменения снимка (снимок обновляет вызывающий код)"""
+    cur.execute(
+        "INSERT INTO ledger (user_id, stars_delta, bonus_delta, reason, ref_type, ref_id) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, stars, bonus, reason, ref_type, ref_id),
+    )
+
+def post_ledger(cur, user_id, reason, stars=0, bonus=0, ref_type=None, ref_id=None):
+    """Проводка по балансу: запись в журнал и обновление снимка в одной транзакции.
+    Коммит выполняет вызывающий код."""
+    append_ledger(cur, user_id, reason, stars, bonus, ref_type, ref_id)
+    cur.execute(
+        "UPDATE users SET stars = stars + ?, referral_bonus = referral_bonus + ? WHERE user_id=?",
+        (stars, bonus, user_id),
+    )
+    user_cache.invalidate(user_id)
+
+def update_stars(user_id, amount, reason="manual", ref_type=None, ref_id=None):
+    """Обновление баланса звёзд"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        post_ledger(cur, user_id, reason, stars=amount, ref_type=ref_type, ref_id=ref_id)
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка обновления звёзд: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def add_order(user_id, recipient_username, stars_amount, price, status=ORDER_AWAITING_PAYMENT,
+              photo_file_id=None, photo_unique_id=None):
+    """Добавление нового заказа. Возвращает order_id"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO orders (user_id, recipient_username, stars_amount, price, status, claimed_at, "
+            "payment_file_id, payment_file_unique_id) "
+            "VALUES (?, ?, ?, ?, ?, CASE WHEN ? = 'claimed_paid' THEN datetime('now') END, ?, ?)",
+            (user_id, recipient_username, stars_amount, price, status, status, photo_file_id, photo_unique_id),
+        )
+        conn.commit()
+        return cur.lastrowid
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка добавления заказа: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def transition_order(cur, order_id, new_status):
+    """Перевод заказа в новый статус, если переход допустим из текущего.
+    Проверка и запись выполняются одним UPDATE. Коммит выполняет вызывающий код."""
+    sources = [status for status, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+    q_marks = ','.join(['?'] * len(sources))
+    cur.execute(
+        f"UPDATE orders SET status=?, {ORDER_STATUS_TIMESTAMPS[new_status]}=datetime('now'), paid=? "
+        f"WHERE order_id=? AND status IN ({q_marks})",
+        (new_status, int(new_status == ORDER_CONFIRMED), order_id, *sources),
+    )
+    return cur.rowcount == 1
+
+def claim_order(order_id, photo_file_id=None, photo_unique_id=None):
+    """Покупатель сообщил об оплате: awaiting_payment -> claimed_paid.
+    Скриншот сохраняется только ссылкой file_id, без загрузки файла."""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        claimed = transition_order(cur, order_id, ORDER_CLAIMED_PAID)
+        if claimed and photo_file_id:
+            cur.execute(
+                "UPDATE orders SET payment_file_id=?, payment_file_unique_id=? WHERE order_id=?",
+                (photo_file_id, photo_unique_id, order_id),
+            )
+        conn.commit()
+        return claimed
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка смены статуса заказа: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def get_order(order_id):
+    """Получение заказа по номеру"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM orders WHERE order_id=?", (order_id,))
+        return cur.fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения заказа: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def register_payment_evidence(order_id, file_unique_id):
+    """Регистрация скриншота при отправке заказа.
+    Возвращает номер более раннего заказа с тем же file_unique_id (повтор скриншота) или None"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT OR IGNORE INTO payment_evidence (order_id, file_unique_id) VALUES (?, ?)",
+            (order_id, file_unique_id),
+        )
+        cur.execute(
+            "SELECT MIN(order_id) FROM payment_evidence WHERE file_unique_id=? AND order_id != ?",
+            (file_unique_id, order_id),
+        )
+        duplicate_of = cur.fetchone()[0]
+        if duplicate_of:
+            cur.execute("UPDATE payment_evidence SET duplicate_of=? WHERE order_id=?", (duplicate_of, order_id))
+        conn.commit()
+        return duplicate_of
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка регистрации скриншота: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def record_evidence_hash(order_id, file_unique_id, sha256, size, path):
+    """Сохранение хеша загруженного скриншота.
+    Возвращает номер более раннего заказа с тем же содержимым или None"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO payment_evidence (order_id, file_unique_id, sha256, size) VALUES (?, ?, ?, ?)
+            ON CONFLICT(order_id) DO UPDATE SET sha256=excluded.sha256, size=excluded.size
+            """,
+            (order_id, file_unique_id, sha256, size),
+        )
+        cur.execute("UPDATE orders SET payment_file_path=? WHERE order_id=?", (path, order_id))
+        cur.execute(
+            "SELECT MIN(order_id) FROM payment_evidence WHERE sha256=? AND order_id != ?",
+            (sha256, order_id),
+        )
+        duplicate_of = cur.fetchone()[0]
+        if duplicate_of:
+            cur.execute(
+                "UPDATE payment_evidence SET duplicate_of=COALESCE(duplicate_of, ?) WHERE order_id=?",
+                (duplicate_of, order_id),
+            )
+        conn.commit()
+        return duplicate_of
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка сохранения хеша скриншота: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_orders_without_payment_file(limit=PAYMENT_DOWNLOAD_BATCH):
+    """Заказы со скриншотом, который ещё не загружен на диск.
+    Сначала ещё не пробованные; исчерпавшие PAYMENT_DOWNLOAD_MAX_ATTEMPTS не выбираются,
+    чтобы постоянно падающие загрузки не занимали всю пачку"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT o.* FROM orders o LEFT JOIN payment_evidence e ON e.order_id = o.order_id
+            WHERE o.payment_file_id IS NOT NULL AND o.payment_file_path IS NULL
+              AND COALESCE(e.download_attempts, 0) < ?
+            ORDER BY COALESCE(e.download_attempts, 0), o.order_id LIMIT ?
+            """,
+            (PAYMENT_DOWNLOAD_MAX_ATTEMPTS, limit),
+        )
+        return cur.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения заказов без скриншота: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def record_payment_download_failure(order_id):
+    """Учёт неудачной фоновой загрузки скриншота. Возвращает число попыток"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO payment_evidence (order_id, download_attempts, download_failed_at) VALUES (?, 1, ?)
+            ON CONFLICT(order_id) DO UPDATE SET
+                download_attempts = COALESCE(download_attempts, 0) + 1,
+                download_failed_at = excluded.download_failed_at
+            RETURNING download_attempts
+            """,
+            (order_id, int(time.time())),
+        )
+        attempts = cur.fetchone()[0]
+        conn.commit()
+        return attempts
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка учёта неудачной загрузки скриншота: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def count_live_orders():
+    """Количество незавершённых заказов по статусам (только по частичному индексу)"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(f"SELECT status, COUNT(*) FROM orders WHERE {LIVE_ORDERS_SQL} GROUP BY status")
+        return dict(cur.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка подсчёта заказов: {e}")
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+def bump_rollup(cur, orders=0, stars=0, revenue=0, new_users=0, referral_payouts=0):
+    """Прибавка к итогам текущего часа. Коммит выполняет вызывающий код."""
+    cur.execute(
+        """
+        INSERT INTO sales_rollup_hourly (hour_ts, orders_count, stars, revenue, new_users, referral_payouts)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(hour_ts) DO UPDATE SET
+            orders_count = orders_count + excluded.orders_count,
+            stars = stars + excluded.stars,
+            revenue = revenue + excluded.revenue,
+            new_users = new_users + excluded.new_users,
+            referral_payouts = referral_payouts + excluded.referral_payouts
+        """,
+        (int(time.time()) // 3600 * 3600, orders, stars, revenue, new_users, referral_payouts),
+    )
+
+def rebuild_rollups():
+    """Пересчёт почасовых итогов по всей истории заказов и регистраций. Возвращает число часов.
+    История пересчитывается окнами по ROLLUP_REBUILD_WINDOW, каждое — короткой транзакцией BEGIN IMMEDIATE
+    с паузой между окнами: подтверждение заказов не ждёт блокировку на всё время пересчёта,
+    а внутри окна удаление и пересчёт атомарны относительно bump_rollup."""
+    hour_sql = "CAST(strftime('%s', {}) AS INTEGER) / 3600 * 3600"
+    confirmed_orders = """(
+        SELECT user_id, stars_amount, price, created_at, confirmed_at FROM orders WHERE status = 'confirmed'
+        UNION ALL
+        SELECT user_id, stars_amount, price, created_at, confirmed_at FROM orders_archive WHERE status = 'confirmed'
+    )"""
+    levels = tenant().referral_levels
+    level_percent = " ".join(f"WHEN {depth} THEN {percent}" for depth, percent in enumerate(levels, 1))
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT MIN(hour_ts) FROM (
+                SELECT {hour_sql.format("COALESCE(confirmed_at, created_at)")} AS hour_ts FROM {confirmed_orders}
+                UNION ALL
+                SELECT {hour_sql.format("registration_date")} FROM users WHERE registration_date IS NOT NULL
+            )
+        """)
+        now_hour = int(time.time()) // 3600 * 3600
+        first = cur.fetchone()[0] or now_hour
+        # Первое окно захватывает и возможный мусор до начала истории, последнее — всё после текущего часа
+        bounds = [0, *range(first + ROLLUP_REBUILD_WINDOW, now_hour + 1, ROLLUP_REBUILD_WINDOW), sys.maxsize]
+        for window, (start_ts, end_ts) in enumerate(zip(bounds, bounds[1:])):
+            if window:
+                time.sleep(RETENTION_BATCH_PAUSE)
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("DELETE FROM sales_rollup_hourly WHERE hour_ts >= ? AND hour_ts < ?", (start_ts, end_ts))
+            cur.execute(f"""
+                INSERT INTO sales_rollup_hourly (hour_ts, orders_count, stars, revenue, referral_payouts)
+                SELECT hour_ts, COUNT(*), SUM(o.stars_amount), SUM(o.price),
+                       SUM((SELECT COALESCE(SUM(CAST(o.price * CASE t.depth {level_percent} END / 100 AS INTEGER)), 0)
+                            FROM referral_tree t WHERE t.descendant = o.user_id AND t.depth <= ?))
+                FROM (
+                    SELECT {hour_sql.format("COALESCE(confirmed_at, created_at)")} AS hour_ts, user_id, stars_amount, price
+                    FROM {confirmed_orders}
+                ) o
+                WHERE hour_ts >= ? AND hour_ts < ?
+                GROUP BY hour_ts
+            """, (len(levels), start_ts, end_ts))
+            cur.execute(f"""
+                INSERT INTO sales_rollup_hourly (hour_ts, new_users)
+                SELECT hour_ts, COUNT(*) FROM (
+                    SELECT {hour_sql.format("registration_date")} AS hour_ts FROM users WHERE registration_date IS NOT NULL
+                )
+                WHERE hour_ts >= ? AND hour_ts < ?
+                GROUP BY hour_ts
+                ON CONFLICT(hour_ts) DO UPDATE SET new_users = excluded.new_users
+            """, (start_ts, end_ts))
+            conn.commit()
+        cur.execute("SELECT COUNT(*) FROM sales_rollup_hourly")
+        return cur.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка пересчёта итогов продаж: {e}")
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_rollup_totals(start_ts, end_ts):
+    """Итоги продаж за [start_ts, end_ts) — сумма не более чем по одной строке на час"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT COALESCE(SUM(orders_count), 0) AS orders_count, COALESCE(SUM(stars), 0) AS stars,
+                   COALESCE(SUM(revenue), 0) AS revenue, COALESCE(SUM(new_users), 0) AS new_users,
+                   COALESCE(SUM(referral_payouts), 0) AS referral_payouts
+            FROM sales_rollup_hourly WHERE hour_ts >= ? AND hour_ts < ?
+            """,
+            (start_ts, end_ts),
+        )
+        return cur.fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения итогов продаж: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def settle_orders(order_ids, confirm=True):
+    """Подтверждение или отклонение пачки заказов одной транзакцией.
+    Заказы, уже завершённые другим админом, пропускаются. Возвращает завершённые заказы,
+    или None, если транзакция не прошла (например, БД занята) — это не то же, что «уже завершён»."""
+    new_status = ORDER_CONFIRMED if confirm else ORDER_REJECTED
+    levels = tenant().referral_levels
+    settled = []
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        for order_id in order_ids:
+            if not transition_order(cur, order_id, new_status):
+                continue
+            cur.execute("SELECT * FROM orders WHERE order_id=?", (order_id,))
+            order = cur.fetchone()
+            if confirm:
+                # Начисляем звёзды покупателю
+                post_ledger(cur, order['user_id'], "purchase", stars=order['stars_amount'], ref_type="order", ref_id=order_id)
+                # Реферальная система: предки покупателя до последнего оплачиваемого уровня
+                cur.execute(
+                    "SELECT ancestor, depth FROM referral_tree WHERE descendant=? AND depth<=?",
+                    (order['user_id'], len(levels)),
+                )
+                payouts = 0
+                for ancestor, depth in cur.fetchall():
+                    percent = levels[depth - 1]
+                    bonus_rub = int(order['price'] * percent / 100)
+                    bonus_stars = int(order['stars_amount'] * percent / 100)
+                    post_ledger(cur, ancestor, "referral", stars=bonus_stars, bonus=bonus_rub, ref_type="order", ref_id=order_id)
+                    payouts += bonus_rub
+                bump_rollup(cur, orders=1, stars=order['stars_amount'], revenue=order['price'], referral_payouts=payouts)
+            settled.append(order)
+        conn.commit()
+        return settled
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка завершения заказов: {e}")
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_pending_orders(after_id=0, limit=PENDING_PAGE_SIZE):
+    """Страница заказов, ожидающих проверки (старые сначала), по частичному индексу"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT o.order_id, o.user_id, u.username, o.recipient_username, o.stars_amount, o.price, o.claimed_at,
+                   o.payment_file_id
+            FROM orders o LEFT JOIN users u ON u.user_id = o.user_id
+            WHERE o.{LIVE_ORDERS_SQL} AND o.status = 'claimed_paid' AND o.order_id > ?
+            ORDER BY o.order_id
+            LIMIT ?
+            """,
+            (after_id, limit),
+        )
+        return cur.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения очереди заказов: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+ORDER_COLUMNS = (
+    "order_id, user_id, recipient_username, stars_amount, price, paid, status, "
+    "created_at, claimed_at, confirmed_at, rejected_at, expired_at, "
+    "payment_file_id, payment_file_unique_id, payment_file_path"
+)
+
+def get_orders(user_id, before_id=None, limit=ORDERS_PAGE_SIZE):
+    """Страница заказов пользователя (новые сначала), начиная до before_id.
+    Горячая таблица и архив читаются одним запросом и сливаются по order_id: заказ, отклонённый
+    и заархивированный раньше, может быть новее заказа, ещё ждущего проверки.
+    Возвращает (заказы, есть_ли_ещё)"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        before_id = before_id or sys.maxsize
+        cur.execute(
+            f"""
+            SELECT * FROM (
+                SELECT {ORDER_COLUMNS} FROM orders WHERE user_id=? AND order_id<? ORDER BY order_id DESC LIMIT ?
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT {ORDER_COLUMNS} FROM orders_archive WHERE user_id=? AND order_id<? ORDER BY order_id DESC LIMIT ?
+            )
+            ORDER BY order_id DESC LIMIT ?
+            """,
+            (user_id, before_id, limit + 1, user_id, before_id, limit + 1, limit + 1),
+        )
+        orders = cur.fetchall()
+        return orders[:limit], len(orders) > limit
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения заказов: {e}")
+        return [], False
+    finally:
+        if conn:
+            conn.close()
+
+def get_setting(key):
+    """Получение значения настройки"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM settings WHERE key=?", (key,))
+        res = cur.fetchone()
+        return res[0] if res else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения настройки: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def set_setting(key, value):
+    """Установка значения настройки"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        if get_setting(key) is None:
+            cur.execute("INSERT INTO settings (key, value) VALUES (?, ?)", (key, value))
+        else:
+            cur.execute("UPDATE settings SET value=? WHERE key=?", (value, key))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка установки настройки: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def add_feedback(user_id, text):
+    """Добавление отзыва"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO feedback (user_id, text) VALUES (?, ?)",
+            (user_id, text),
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка добавления отзыва: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def expire_orders_batch(limit=RETENTION_BATCH_SIZE):
+    """Перевод одной пачки неоплаченных заказов старше срока хранения в статус expired.
+    Заказы на проверке (claimed_paid) не истекают: покупатель уже сообщил об оплате и ждёт админа"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            UPDATE orders SET status = 'expired', expired_at = datetime('now')
+            WHERE order_id IN (
+                SELECT order_id FROM orders
+                WHERE {LIVE_ORDERS_SQL} AND status = '{ORDER_AWAITING_PAYMENT}' AND created_at < datetime('now', ?)
+                LIMIT ?
+            )
+            """,
+            (f"-{UNPAID_ORDER_TTL_DAYS} days", limit),
+        )
+        expired = cur.rowcount
+        conn.commit()
+        return expired
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка истечения старых заказов: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def archive_orders_batch(limit=ARCHIVE_BATCH_SIZE):
+    """Перенос пачки старых завершённых заказов в архив с пополнением итогов пользователя"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT order_id FROM orders WHERE {TERMINAL_ORDERS_SQL} AND created_at < datetime('now', ?) ORDER BY order_id LIMIT ?",
+            (f"-{ORDER_ARCHIVE_AFTER_DAYS} days", limit),
+        )
+        ids = [row[0] for row in cur.fetchall()]
+        if not ids:
+            return 0
+        q_marks = ','.join(['?'] * len(ids))
+        cur.execute(
+            f"INSERT INTO orders_archive ({ORDER_COLUMNS}) SELECT {ORDER_COLUMNS} FROM orders WHERE order_id IN ({q_marks})",
+            ids,
+        )
+        cur.execute(f"""
+            INSERT INTO user_order_totals (user_id, orders_count, stars_total, price_total)
+            SELECT user_id, COUNT(*), SUM(stars_amount), SUM(price)
+            FROM orders WHERE order_id IN ({q_marks}) AND status = 'confirmed'
+            GROUP BY user_id
+            ON CONFLICT(user_id) DO UPDATE SET
+                orders_count = orders_count + excluded.orders_count,
+                stars_total = stars_total + excluded.stars_total,
+                price_total = price_total + excluded.price_total
+        """, ids)
+        cur.execute(f"DELETE FROM orders WHERE order_id IN ({q_marks})", ids)
+        conn.commit()
+        return len(ids)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка архивации заказов: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def prune_payment_files(max_age_days=PAYMENT_FILES_RETENTION_DAYS):
+    """Удаление старых скриншотов оплаты. Возвращает (кол-во файлов, байт)"""
+    cutoff = datetime.now().timestamp() - max_age_days * 24 * 60 * 60
+    files, freed = 0, 0
+    for root, _, names in os.walk(tenant().payments_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+                if st.st_mtime < cutoff:
+                    os.remove(path)
+                    files += 1
+                    freed += st.st_size
+            except OSError as e:
+                logger.warning(f"Не удалось удалить файл {path}: {e}")
+    return files, freed
+
+def db_file_size():
+    """Размер файлов БД вместе с WAL"""
+    size = 0
+    db = tenant().db
+    for path in (db, f"{db}-wal"):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+def db_housekeeping():
+    """ANALYZE, контрольная точка WAL и инкрементальный VACUUM"""
+    try:
+        conn = db_connect()
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA incremental_vacuum")
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка обслуживания БД: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def log_maintenance(rows, archived, size_before, files, files_bytes):
+    """Запись в лог итогов обслуживания"""
+    reclaimed = max(size_before - db_file_size(), 0)
+    logger.info(
+        f"Обслуживание выполнено: истекло заказов {rows}, перенесено в архив {archived}, "
+        f"освобождено в БД {reclaimed} байт, удалено файлов {files} ({files_bytes} байт)"
+    )
+
+def clean_old_data():
+    """Очистка старых данных за один проход (без пауз, если JobQueue недоступен)"""
+    size_before = db_file_size()
+    rows = 0
+    while True:
+        deleted = expire_orders_batch()
+        rows += deleted
+        if deleted < RETENTION_BATCH_SIZE:
+            break
+    archived = 0
+    while True:
+        moved = archive_orders_batch()
+        archived += moved
+        if moved < ARCHIVE_BATCH_SIZE:
+            break
+    files, files_bytes = prune_payment_files()
+    db_housekeeping()
+    log_maintenance(rows, archived, size_before, files, files_bytes)
+
+async def maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое обслуживание: пачками удаляет старые заказы с паузами между пачками"""
+    size_before = db_file_size()
+    rows = 0
+    while True:
+        deleted = expire_orders_batch()
+        rows += deleted
+        if deleted < RETENTION_BATCH_SIZE:
+            break
+        await traced_sleep(RETENTION_BATCH_PAUSE)
+    archived = 0
+    while True:
+        moved = archive_orders_batch()
+        archived += moved
+        if moved < ARCHIVE_BATCH_SIZE:
+            break
+        await traced_sleep(RETENTION_BATCH_PAUSE)
+    # Обход каталога скриншотов и ANALYZE/VACUUM — в потоке, чтобы не останавливать цикл событий
+    files, files_bytes = await asyncio.to_thread(prune_payment_files)
+    prune_user_states()
+    await asyncio.to_thread(db_housekeeping)
+    log_maintenance(rows, archived, size_before, files, files_bytes)
+
+def day_start_ts(now=None):
+    """Начало текущих суток (локальное время) в формате epoch"""
+    now = now or datetime.now()
+    return int(now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+def roll_daily_bonus():
+    """95% шанс 1-5, 5% шанс 6-100"""
+    return randint(1, 5) if random() < 0.95 else randint(6, 100)
+
+def claim_daily_bonus(user_id):
+    """Атомарное получение ежедневного бонуса.
+    Проверка и начисление выполняются одним условным UPDATE, поэтому повторное
+    нажатие не может начислить бонус дважды. Возвращает сумму или None."""
+    reward = roll_daily_bonus()
+    now = datetime.now()
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET referral_bonus = referral_bonus + ?, last_spin_at = ?
+            WHERE user_id = ? AND (last_spin_at IS NULL OR last_spin_at < ?)
+            RETURNING user_id
+            """,
+            (reward, int(now.timestamp()), user_id, day_start_ts(now)),
+        )
+        if cur.fetchone() is None:
+            conn.rollback()
+            return None
+        append_ledger(cur, user_id, "daily_bonus", bonus=reward, ref_type="daily_bonus", ref_id=int(now.strftime("%Y%m%d")))
+        conn.commit()
+        user_cache.invalidate(user_id)
+        logger.info(f"Ежедневный бонус {reward}₽ начислен пользователю {user_id}")
+        return reward
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка начисления ежедневного бонуса: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def exchange_bonus(user_id, amount, stars):
+    """Атомарный обмен бонусных рублей на звёзды.
+    Списание выполняется одним условным UPDATE, поэтому два быстрых запроса
+    не уведут баланс в минус. Возвращает остаток бонуса или None, если средств не хватило."""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET referral_bonus = referral_bonus - ?, stars = stars + ?
+            WHERE user_id = ? AND referral_bonus >= ?
+            RETURNING referral_bonus
+            """,
+            (amount, stars, user_id, amount),
+        )
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        append_ledger(cur, user_id, "exchange", stars=stars, bonus=-amount, ref_type="exchange")
+        conn.commit()
+        return row[0]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка обмена бонуса: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+        user_cache.invalidate(user_id)
+
+def count_daily_claims(since=None):
+    """Количество пользователей, получивших бонус с начала суток (диапазон по индексу)"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM users WHERE last_spin_at >= ?", (since or day_start_ts(),))
+        return cur.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка подсчёта бонусов: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def get_ledger(user_id, limit=50):
+    """История движений по балансу пользователя (последние записи)"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT * FROM ledger WHERE user_id=? ORDER BY entry_id DESC LIMIT ?",
+            (user_id, limit),
+        )
+        return cur.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения журнала: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def audit_balance(user_id):
+    """Сверка снимка баланса с журналом: последняя контрольная точка + записи после неё.
+    Возвращает (снимок, пересчёт) как пары (stars, referral_bonus)."""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT stars, referral_bonus FROM users WHERE user_id=?", (user_id,))
+        user = cur.fetchone()
+        if not user:
+            return None
+        cur.execute(
+            "SELECT stars, referral_bonus, through_entry_id FROM ledger_checkpoints "
+            "WHERE user_id=? ORDER BY checkpoint_id DESC LIMIT 1",
+            (user_id,),
+        )
+        checkpoint = cur.fetchone()
+        stars, bonus, through = (checkpoint['stars'], checkpoint['referral_bonus'], checkpoint['through_entry_id']) if checkpoint else (0, 0, 0)
+        cur.execute(
+            "SELECT COALESCE(SUM(stars_delta), 0), COALESCE(SUM(bonus_delta), 0) FROM ledger WHERE user_id=? AND entry_id > ?",
+            (user_id, through),
+        )
+        stars_delta, bonus_delta = cur.fetchone()
+        return (user['stars'], user['referral_bonus']), (stars + stars_delta, bonus + bonus_delta)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка сверки баланса: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def compact_ledger():
+    """Сворачивание старых записей журнала в контрольные точки"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT MAX(entry_id) FROM ledger WHERE created_at < datetime('now', ?)",
+            (f"-{LEDGER_RETENTION_DAYS} days",),
+        )
+        through = cur.fetchone()[0]
+        if not through:
+            return 0
+        # Новая точка = предыдущая точка пользователя + сумма свёрнутых записей
+        cur.execute("""
+            INSERT INTO ledger_checkpoints
+                (user_id, stars, referral_bonus, stars_delta, bonus_delta, entries_count, through_entry_id)
+            SELECT
+                l.user_id,
+                COALESCE((SELECT c.stars FROM ledger_checkpoints c WHERE c.user_id = l.user_id
+                          ORDER BY c.checkpoint_id DESC LIMIT 1), 0) + SUM(l.stars_delta),
+                COALESCE((SELECT c.referral_bonus FROM ledger_checkpoints c WHERE c.user_id = l.user_id
+                          ORDER BY c.checkpoint_id DESC LIMIT 1), 0) + SUM(l.bonus_delta),
+                SUM(l.stars_delta),
+                SUM(l.bonus_delta),
+                COUNT(*),
+                MAX(l.entry_id)
+            FROM ledger l
+            WHERE l.entry_id <= ?
+            GROUP BY l.user_id
+        """, (through,))
+        cur.execute("DELETE FROM ledger WHERE entry_id <= ?", (through,))
+        compacted = cur.rowcount
+        conn.commit()
+        logger.info(f"Журнал сжат: {compacted} записей свёрнуто в контрольные точки")
+        return compacted
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка сжатия журнала: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+async def ledger_compact_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое сжатие журнала вне цикла событий"""
+    await asyncio.to_thread(compact_ledger)
+
+# Выгрузки /export: вид -> (колонки, таблицы, колонка даты)
+EXPORTS = {
+    "orders": (ORDER_COLUMNS, ("orders", "orders_archive"), "created_at"),
+    "users": (
+        "user_id, username, stars, referral_id, referral_bonus, referrals_count, "
+        "subscribed, last_seen, blocked, registration_date",
+        ("users",),
+        "registration_date",
+    ),
+    "feedback": ("feedback_id, user_id, text, created_at", ("feedback",), "created_at"),
+}
+
+def iter_export_rows(kind, date_from, date_to):
+    """Заголовок и строки выгрузки за [date_from, date_to) прямо из курсора — в памяти одна строка.
+    Соединение только для чтения: в режиме WAL выгрузка не мешает записи."""
+    columns, tables, date_column = EXPORTS[kind]
+    conn = db_connect()
+    try:
+        conn.execute("PRAGMA query_only = ON")
+        yield [column.strip() for column in columns.split(",")]
+        for table in tables:
+            # Диапазон по индексу на колонке даты — без полного сканирования и сортировки
+            yield from conn.execute(
+                f"SELECT {columns} FROM {table} WHERE {date_column} >= ? AND {date_column} < ? ORDER BY {date_column}",
+                (date_from, date_to),
+            )
+    finally:
+        conn.close()
+
+def write_export(kind, date_from, date_to):
+    """Потоковая запись выгрузки в сжатый CSV во временном файле. Возвращает (путь, число строк)"""
+    fd, path = tempfile.mkstemp(prefix=f"export_{kind}_", suffix=".csv.gz")
+    os.close(fd)
+    rows = -1  # Заголовок не считается
+    try:
+        with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            for row in iter_export_rows(kind, date_from, date_to):
+                writer.writerow(row)
+                rows += 1
+    except Exception:
+        os.remove(path)
+        raise
+    return path, rows
+
+def fts_query(text):
+    """Поисковая строка пользователя -> запрос FTS5: все слова, каждое как префикс.
+    Кавычки и операторы FTS5 из ввода не пропускаются."""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+def search_orders(query, offset=0, limit=FIND_PAGE_SIZE):
+    """Заказы по получателю, по релевантности (включая архив). Возвращает limit + 1 строк для пагинации"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT f.rowid AS order_id, f.recipient_username,
+                   COALESCE(o.user_id, a.user_id) AS user_id,
+                   COALESCE(o.stars_amount, a.stars_amount) AS stars_amount,
+                   COALESCE(o.price, a.price) AS price,
+                   COALESCE(o.status, a.status) AS status,
+                   COALESCE(o.created_at, a.created_at) AS created_at
+            FROM (SELECT rowid, recipient_username, rank FROM orders_fts WHERE orders_fts MATCH ?
+                  ORDER BY rank LIMIT ? OFFSET ?) f
+            LEFT JOIN orders o ON o.order_id = f.rowid
+            LEFT JOIN orders_archive a ON a.order_id = f.rowid
+            ORDER BY f.rank
+            """,
+            (query, limit + 1, offset),
+        )
+        return cur.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка поиска заказов: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def search_feedback(query, offset=0, limit=FIND_PAGE_SIZE):
+    """Отзывы по тексту, по релевантности, с фрагментом совпадения. Возвращает limit + 1 строк для пагинации"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT f.rowid AS feedback_id, fb.user_id, fb.created_at,
+                   snippet(feedback_fts, 0, '«', '»', '…', 12) AS snippet
+            FROM feedback_fts f JOIN feedback fb ON fb.feedback_id = f.rowid
+            WHERE feedback_fts MATCH ?
+            ORDER BY f.rank LIMIT ? OFFSET ?
+            """,
+            (query, limit + 1, offset),
+        )
+        return cur.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка поиска отзывов: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def search_users(username, offset=0, limit=FIND_PAGE_SIZE):
+    """Пользователи по началу username без учёта регистра (индекс NOCASE). Возвращает limit + 1 строк"""
+    username = username.lstrip("@").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id, username, stars, referrals_count, registration_date FROM users
+            WHERE username LIKE ? ESCAPE '\\' ORDER BY username COLLATE NOCASE LIMIT ? OFFSET ?
+            """,
+            (username + "%", limit + 1, offset),
+        )
+        return cur.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка поиска пользователей: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+# ========== КЛАВИАТУРЫ ==========
+def main_menu_keyboard(is_subscribed=True):
+    keyboard = [
+        [InlineKeyboardButton("⭐️ Купить звёзды", callback_data="buy")],
+        [InlineKeyboardButton("🎁 Ежедневный бонус", callback_data="daily_bonus")],
+        [InlineKeyboardButton("🤝 Рефералы", callback_data="referrals")],
+        [InlineKeyboardButton("🧾 Профиль", callback_data="profile")],
+        [InlineKeyboardButton("📝 Оставить отзыв", callback_data="feedback")],
+    ]
+    
+    # Добавляем кнопки подписки только для неподписанных
+    if not is_subscribed:
+        keyboard.extend([
+            [InlineKeyboardButton("🔗 Подписаться на канал", url=tenant().channel_username)],
+            [InlineKeyboardButton("✅ Проверить подписку", callback_data="check_subscription")],
+        ])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+def admin_menu_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("⚙️ Установить курс", callback_data="set_course")],
+        [InlineKeyboardButton("🕓 Заказы на проверке", callback_data="pending")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
+        [InlineKeyboardButton("📢 Рассылка", callback_data="broadcast")],
         [InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")],
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def broadcast_segments_keyboard():
+    keyboard = [[InlineKeyboardButton(BROADCAST_SEGMENTS["all"][0], callback_data="bcast_all")]]
+    keyboard.append([
+        InlineKeyboardButton(f"{BROADCAST_SEGMENTS['active'][0]} {days} дн.", callback_data=f"bcast_active_{days}")
+        for days in BROADCAST_ACTIVE_DAYS
+    ])
+    for segment in ("subscribed", "buyers", "referrers"):
+        keyboard.append([InlineKeyboardButton(BROADCAST_SEGMENTS[segment][0], callback_data=f"bcast_{segment}")])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
+    return InlineKeyboardMarkup(keyboard)
+
 def cancel_keyboard(show_main_menu=True):
     keyboard = [[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]]
     if show_main_menu:
@@ -378,13 +2227,42 @@ def confirm_order_keyboard():
 
 # Добавить клавиатуру для подтверждения заказа админом
 
-def admin_confirm_keyboard(order_id):
-    return InlineKeyboardMarkup([
+def admin_confirm_keyboard(order_id, has_photo=False):
+    keyboard = [
         [
             InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm_order_{order_id}"),
             InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_order_{order_id}")
         ]
-    ])
+    ]
+    if has_photo:
+        keyboard.append([InlineKeyboardButton("📥 Сохранить скриншот", callback_data=f"download_payment_{order_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
+def pending_orders_keyboard(orders, selected, after_id, next_after):
+    keyboard = []
+    for order in orders:
+        row = [InlineKeyboardButton(
+            f"{'✅' if order['order_id'] in selected else '⬜'} #{order['order_id']} — {order['stars_amount']}⭐ / {order['price']}₽",
+            callback_data=f"pending_toggle_{order['order_id']}",
+        )]
+        if order['payment_file_id']:
+            row.append(InlineKeyboardButton("🖼", callback_data=f"payment_photo_{order['order_id']}"))
+        keyboard.append(row)
+    if orders:
+        keyboard.append([
+            InlineKeyboardButton("✅ Подтвердить выбранные", callback_data="pending_confirm_selected"),
+            InlineKeyboardButton("❌ Отклонить выбранные", callback_data="pending_reject_selected"),
+        ])
+        keyboard.append([InlineKeyboardButton("✅ Подтвердить все на странице", callback_data="pending_confirm_page")])
+    nav = []
+    if after_id:
+        nav.append(InlineKeyboardButton("⏮ В начало", callback_data="pending_page_0"))
+    if next_after:
+        nav.append(InlineKeyboardButton("➡️ Далее", callback_data=f"pending_page_{next_after}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
 
 def profile_keyboard():
     return InlineKeyboardMarkup([
@@ -392,25 +2270,272 @@ def profile_keyboard():
         [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")],
     ])
 
+def orders_page_keyboard(before_id=None):
+    keyboard = []
+    if before_id:
+        keyboard.append([InlineKeyboardButton("⬇️ Показать ещё", callback_data=f"my_orders_{before_id}")])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
+    return InlineKeyboardMarkup(keyboard)
+
+def find_page_keyboard(page, has_more):
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"find_page_{page - 1}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("➡️ Далее", callback_data=f"find_page_{page + 1}"))
+    return InlineKeyboardMarkup([nav]) if nav else None
+
 def referrals_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("💸 Обменять бонус", callback_data="exchange_bonus")],
         [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")],
     ])
 
+# ========== УВЕДОМЛЕНИЯ ==========
+class NotificationQueue:
+    """Очередь исходящих уведомлений с ограничением скорости отправки.
+    Обработчик очереди запускается при первой постановке сообщения."""
+
+    def __init__(self, rate_per_sec):
+        self.interval = 1 / rate_per_sec
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+    def send(self, bot, chat_id, text, **kwargs):
+        self.queue.put_nowait((bot, chat_id, text, kwargs))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            bot, chat_id, text, kwargs = await self.queue.get()
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+            except Forbidden:
+                mark_blocked(chat_id)
+            except Exception as e:
+                logger.error(f"Не удалось отправить уведомление {chat_id}: {e}")
+            finally:
+                self.queue.task_done()
+            await asyncio.sleep(self.interval)
+
+    async def stop(self, timeout=10):
+        """Дожидается отправки оставшихся уведомлений и останавливает обработчик"""
+        if self.worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено уведомлений при остановке: {self.queue.qsize()}")
+        self.worker.cancel()
+
+notification_queue = TenantLocal(lambda: NotificationQueue(NOTIFY_RATE_PER_SEC))
+
+async def notify_admins(bot, text, photo=None, **kwargs):
+    """Параллельная отправка сообщения всем админам.
+    Фото пересылается по file_id — без загрузки и повторной выгрузки файла."""
+    admin_ids = list(tenant().admin_ids)
+    if photo:
+        sends = (bot.send_photo(admin_id, photo, caption=text, **kwargs) for admin_id in admin_ids)
+    else:
+        sends = (bot.send_message(admin_id, text, **kwargs) for admin_id in admin_ids)
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    for admin_id, result in zip(admin_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {result}")
+
+def notify_admins_background(context, text, photo=None, **kwargs):
+    """Уведомление админов вне критического пути ответа покупателю"""
+    context.application.create_task(notify_admins(context.bot, text, photo=photo, **kwargs))
+
+class AdminDigest:
+    """Сводка новых заказов для админов.
+    Когда заказов в минуту больше порога, они не отправляются по одному, а копятся
+    и раз в ADMIN_DIGEST_INTERVAL дописываются в одно редактируемое сообщение у каждого админа."""
+
+    MAX_TEXT_LENGTH = 3500  # Запас до лимита Telegram в 4096 символов
+
+    def __init__(self, enabled, threshold, window=60):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.window = window
+        self.recent = deque()
+        self.pending = []
+        self.lines = []
+        self.message_ids = {}
+        self.relay = False  # Сводку ведёт другой процесс: строки пересылаются ему через фронт
+
+    def rate(self):
+        cutoff = time.monotonic() - self.window
+        while self.recent and self.recent[0] < cutoff:
+            self.recent.popleft()
+        return len(self.recent)
+
+    def record_order(self):
+        """Учёт нового заказа. Возвращает True, если заказ нужно отправить через сводку"""
+        self.recent.append(time.monotonic())
+        return self.enabled and self.rate() > self.threshold
+
+    def add(self, line):
+        if self.relay:
+            shard_link.publish(tenant().name, digest=line)
+        else:
+            self.pending.append(line)
+
+    async def flush(self, bot):
+        """Дописывает накопленные заказы в сводку (или начинает новую)"""
+        if not self.pending:
+            # Поток заказов спал — следующая сводка начнётся новым сообщением
+            if self.rate() <= self.threshold:
+                self.lines = []
+                self.message_ids = {}
+            return
+        lines, self.pending = self.pending, []
+        if len("\n".join(self.lines + lines)) > self.MAX_TEXT_LENGTH:
+            self.lines = []
+            self.message_ids = {}
+        self.lines.extend(lines)
+        text = f"<b>📥 Новые заказы (сводка): {len(self.lines)}</b>\n\n" + "\n".join(self.lines)
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("🕓 Открыть очередь", callback_data="pending")]])
+
+        async def publish(admin_id):
+            message_id = self.message_ids.get(admin_id)
+            if message_id:
+                await bot.edit_message_text(text, chat_id=admin_id, message_id=message_id, reply_markup=markup, parse_mode=ParseMode.HTML)
+            else:
+                sent = await bot.send_message(admin_id, text, reply_markup=markup, parse_mode=ParseMode.HTML)
+                self.message_ids[admin_id] = sent.message_id
+
+        admin_ids = list(tenant().admin_ids)
+        results = await asyncio.gather(*(publish(admin_id) for admin_id in admin_ids), return_exceptions=True)
+        for admin_id, result in zip(admin_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось обновить сводку заказов у админа {admin_id}: {result}")
+
+admin_digest = TenantLocal(lambda: AdminDigest(ADMIN_DIGEST_ENABLED, ADMIN_DIGEST_THRESHOLD))
+
+def evidence_path(sha256):
+    """Путь к файлу в хранилище по хешу: payments/ab/cd/<sha256>.jpg"""
+    return os.path.join(tenant().payments_dir, sha256[:2], sha256[2:4], f"{sha256}.jpg")
+
+def store_evidence_file(data):
+    """Запись скриншота в хранилище по хешу содержимого (вызывается вне цикла событий).
+    Одинаковые файлы хранятся один раз. Возвращает (sha256, путь)"""
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = evidence_path(sha256)
+    if os.path.exists(path):
+        # Продлеваем срок хранения уже сохранённого файла
+        os.utime(path)
+        return sha256, path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return sha256, path
+
+async def download_payment_photo(bot, order):
+    """Загрузка скриншота оплаты в хранилище по file_id. Возвращает путь к файлу"""
+    path = order['payment_file_path']
+    if path and os.path.exists(path):
+        return path
+    file = await bot.get_file(order['payment_file_id'])
+    data = await file.download_as_bytearray()
+    # Хеширование и запись на диск — в отдельном потоке
+    sha256, path = await asyncio.to_thread(store_evidence_file, bytes(data))
+    duplicate_of = record_evidence_hash(order['order_id'], order['payment_file_unique_id'], sha256, len(data), path)
+    if duplicate_of:
+        logger.warning(f"Скриншот заказа {order['order_id']} совпадает с заказом {duplicate_of}")
+        await notify_admins(bot, f"⚠️ Скриншот заказа #{order['order_id']} совпадает по содержимому со скриншотом заказа #{duplicate_of}")
+    return path
+
+async def payment_download_job(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая загрузка скриншотов оплаты, которые ещё не сохранены на диск"""
+    for order in get_orders_without_payment_file():
+        try:
+            await download_payment_photo(context.bot, order)
+        except Exception as e:
+            attempts = record_payment_download_failure(order['order_id'])
+            logger.error(f"Не удалось загрузить скриншот заказа {order['order_id']} (попытка {attempts}): {e}")
+            if attempts >= PAYMENT_DOWNLOAD_MAX_ATTEMPTS:
+                metrics.inc("payment_download.abandoned")
+
+async def admin_digest_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое обновление сводки заказов"""
+    await admin_digest.flush(context.bot)
+
+def notify_settled_orders(context, orders, confirm):
+    """Постановка уведомлений покупателям о завершённых заказах в очередь"""
+    text = tenant().order_confirmed_text if confirm else tenant().order_rejected_text
+    for order in orders:
+        # Явно отправляем уведомление даже если user_id в ADMIN_IDS
+        notification_queue.send(context.bot, order['user_id'], text)
+
+def build_find_page(kind, query, page=0):
+    """Текст и клавиатура страницы результатов /find"""
+    started = time.perf_counter()
+    offset = page * FIND_PAGE_SIZE
+    if kind == "users":
+        rows = search_users(query, offset)
+    else:
+        match = fts_query(query)
+        rows = (search_orders if kind == "orders" else search_feedback)(match, offset) if match else []
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    has_more = len(rows) > FIND_PAGE_SIZE
+    rows = rows[:FIND_PAGE_SIZE]
+    text = f"🔎 {kind}: «{query}» — стр. {page + 1} ({elapsed_ms:.0f} мс)\n\n"
+    if not rows:
+        text += "Ничего не найдено."
+    for row in rows:
+        if kind == "orders":
+            status = ORDER_STATUS_LABELS.get(row['status'], row['status'])
+            text += (
+                f"#{row['order_id']} · {row['recipient_username']} · покупатель {row['user_id']}\n"
+                f"⭐ {row['stars_amount']} · 💰 {row['price']}₽ · {status} · {row['created_at']}\n\n"
+            )
+        elif kind == "feedback":
+            text += f"💬 #{row['feedback_id']} · от {row['user_id']} · {row['created_at']}\n{row['snippet']}\n\n"
+        else:
+            text += (
+                f"👤 @{row['username']} (ID {row['user_id']}) · ⭐ {row['stars']} · "
+                f"рефералов {row['referrals_count']} · с {row['registration_date'][:10]}\n"
+            )
+    return text, find_page_keyboard(page, has_more)
+
+def build_pending_page(context, after_id=0, notice=None):
+    """Текст и клавиатура страницы очереди заказов на проверке"""
+    orders = get_pending_orders(after_id, PENDING_PAGE_SIZE + 1)
+    next_after = orders[PENDING_PAGE_SIZE - 1]['order_id'] if len(orders) > PENDING_PAGE_SIZE else None
+    orders = orders[:PENDING_PAGE_SIZE]
+    selected = context.user_data.setdefault('pending_selected', set())
+    context.user_data['pending_after'] = after_id
+    context.user_data['pending_page'] = [order['order_id'] for order in orders]
+    total = count_live_orders().get(ORDER_CLAIMED_PAID, 0)
+    text = f"{notice}\n\n" if notice else ""
+    text += f"🕓 Заказы на проверке: {total}\nВыбрано: {len(selected)}\n\n"
+    if not orders:
+        text += "Очередь пуста."
+    for order in orders:
+        buyer = f"@{order['username']}" if order['username'] else f"ID: {order['user_id']}"
+        text += (
+            f"#{order['order_id']} · {buyer} → {order['recipient_username']}\n"
+            f"⭐ {order['stars_amount']} · 💰 {order['price']}₽ · 🕓 {order['claimed_at']}\n\n"
+        )
+    return text, pending_orders_keyboard(orders, selected, after_id, next_after)
+
 async def show_main_menu(update, context, greeting=False):
     user_id = update.effective_user.id if update.effective_user else None
     logger.info(f"show_main_menu вызван для пользователя {user_id}")
-    is_subscribed = await check_subscription(user_id, context) if user_id else True
+    is_subscribed = subscription_status(user_id) if user_id else True
     logger.info(f"Пользователь {user_id} подписан: {is_subscribed}")
-    current_course = COURSE_DEFAULT if is_subscribed else COURSE_UNSUBSCRIBED
+    current_course = tenant().course_default if is_subscribed else tenant().course_unsubscribed
     logger.info(f"Курс для пользователя {user_id}: {current_course}₽")
     
     if greeting:
         text = (
-            "👋 Приветствую в Timoteo Store!⭐️ Тут вы можете купить звезды телеграм по лучшей цене. Быстро, дешево, безопасно! 🔐\n"
+            f"👋 Приветствую в {tenant().title}!⭐️ Тут вы можете купить звезды телеграм по лучшей цене. Быстро, дешево, безопасно! 🔐\n"
             f"Текущий курс: {current_course}₽ за 1 звезду\n"
-            "Поддержка бота: @timoteo4"
+            f"Поддержка бота: {tenant().support_username}"
         )
     else:
         text = (
@@ -460,12 +2585,12 @@ async def fallback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 except Exception as e:
                     logger.info(f"Не удалось удалить сообщение {mid}: {e}")
             context.user_data['bot_message_ids'] = []
-            is_subscribed = await check_subscription(user_id, context)
-            current_course = COURSE_DEFAULT if is_subscribed else COURSE_UNSUBSCRIBED
+            is_subscribed = subscription_status(user_id)
+            current_course = tenant().course_default if is_subscribed else tenant().course_unsubscribed
             text = (
-                "👋 Приветствую в Timoteo Store!⭐️ Тут вы можете купить звезды телеграм по лучшей цене. Быстро, дешево, безопасно! 🔐\n"
+                f"👋 Приветствую в {tenant().title}!⭐️ Тут вы можете купить звезды телеграм по лучшей цене. Быстро, дешево, безопасно! 🔐\n"
                 f"Текущий курс: {current_course}₽ за 1 звезду\n"
-                "Поддержка бота: @timoteo4"
+                f"Поддержка бота: {tenant().support_username}"
             )
             sent = await context.bot.send_message(chat_id=user_id, text=text, reply_markup=main_menu_keyboard(is_subscribed))
             context.user_data['bot_message_ids'] = [sent.message_id]
@@ -479,6 +2604,135 @@ async def fallback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     return ConversationHandler.END
 
+# ========== ПОДПИСКА ==========
+class SubscriptionRefresher:
+    """Фоновая проверка подписки: по одному запросу get_chat_member за тик задания.
+    Порядок: запрошенные по кнопке, затем покупатели, затем давно проверенные активные пользователи."""
+
+    def __init__(self, max_tracked):
+        self.max_tracked = max_tracked
+        self.forced = OrderedDict()  # user_id -> ожидающие результата futures
+        self.purchasing = {}  # user_id -> время последнего шага покупки
+        self.active = OrderedDict()  # user_id -> [последняя активность, последняя проверка], давно проверенные в начале
+
+    def touch(self, user_id, purchase=False):
+        now = time.monotonic()
+        entry = self.active.get(user_id)
+        if entry:
+            entry[0] = now
+        else:
+            self.active[user_id] = [now, 0.0]
+            self.active.move_to_end(user_id, last=False)
+            if len(self.active) > self.max_tracked:
+                self.active.popitem()
+        if purchase:
+            self.purchasing[user_id] = now
+
+    def schedule(self, user_id):
+        """Внеочередная проверка без ожидания результата"""
+        self.forced.setdefault(user_id, [])
+
+    async def refresh_now(self, user_id, timeout):
+        """Внеочередная проверка с ожиданием; None — не успели за timeout"""
+        future = asyncio.get_running_loop().create_future()
+        self.forced.setdefault(user_id, []).append(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def _next(self, now):
+        if self.forced:
+            return self.forced.popitem(last=False)
+        for user_id, started in list(self.purchasing.items()):
+            if now - started > SUBSCRIPTION_PURCHASE_WINDOW:
+                del self.purchasing[user_id]
+            elif now - self.active.get(user_id, [0.0, 0.0])[1] >= SUBSCRIPTION_PURCHASE_TTL:
+                return user_id, []
+        while self.active:
+            user_id, (seen, checked) = next(iter(self.active.items()))
+            if now - seen > SUBSCRIPTION_ACTIVE_WINDOW:
+                self.active.popitem(last=False)
+                continue
+            if now - checked < SUBSCRIPTION_TTL:
+                break
+            return user_id, []
+        return None
+
+    async def tick(self, context):
+        now = time.monotonic()
+        item = self._next(now)
+        if item is None:
+            return
+        user_id, waiters = item
+        subscribed = await check_subscription(user_id, context)
+        if subscribed is None:
+            metrics.inc("subscription.errors")
+            user = get_user(user_id)
+            subscribed = bool(user and user["subscribed"])
+        else:
+            metrics.inc("subscription.checks")
+            save_subscription(user_id, subscribed)
+        entry = self.active.setdefault(user_id, [now, now])
+        entry[1] = now
+        self.active.move_to_end(user_id)
+        metrics.set_gauge("subscription.tracked", len(self.active))
+        for future in waiters:
+            if not future.done():
+                future.set_result(subscribed)
+
+subscription_refresher = TenantLocal(lambda: SubscriptionRefresher(SUBSCRIPTION_MAX_TRACKED))
+
+def subscription_status(user_id, purchase=False):
+    """Статус подписки из БД — без запросов к Telegram.
+    Пока статус неизвестен (новый пользователь, проверка ещё не прошла), действует обычный курс:
+    повышенный курс применяется только после подтверждённой неподписки."""
+    if not tenant().check_subscription:
+        return True
+    subscription_refresher.touch(user_id, purchase)
+    user = get_user(user_id)
+    if user is None or user["subscribed"] is None:
+        subscription_refresher.schedule(user_id)
+        return True
+    return bool(user["subscribed"])
+
+async def subscription_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое задание: одна проверка подписки за запуск"""
+    await subscription_refresher.tick(context)
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ==========
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отметка активности пользователя (запись в БД откладывается и объединяется)"""
+    if update.effective_user:
+        activity_tracker.seen(update.effective_user.id)
+
+async def last_seen_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая пакетная запись last_seen"""
+    activity_tracker.flush()
+
+def flood_action(update):
+    """Имя действия для ограничения частоты: callback_data без числового параметра"""
+    if update.callback_query:
+        return re.sub(r"_\d+$", "", update.callback_query.data or "") or "default"
+    return "message"
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отсекает слишком частые действия до ConversationHandler — без обращений к БД и API"""
+    user = update.effective_user
+    if not user or user.id in tenant().admin_ids:
+        return
+    verdict = flood_control.check(user.id, flood_action(update))
+    if verdict == "allow":
+        return
+    metrics.inc(f"flood.{verdict}")
+    if update.callback_query:
+        # Отвечаем и на отброшенные нажатия — иначе у клиента крутится индикатор загрузки кнопки
+        try:
+            await update.callback_query.answer(FLOOD_WARNING_TEXT if verdict == "warn" else None)
+        except Exception as e:
+            logger.info(f"Не удалось ответить на частый запрос: {e}")
+    raise ApplicationHandlerStop
+
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок"""
@@ -501,24 +2755,148 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         if user:
             register_user(user.id, user.username or "", referral_id)
-        context.user_data['course'] = float(get_setting('course') or COURSE_DEFAULT)
+        context.user_data['course'] = float(get_setting('course') or tenant().course_default)
         await show_main_menu(update, context, greeting=True)
         # Сообщение для админа отправляем отдельным сообщением, не дублируя главное меню
-        if user and hasattr(user, 'id') and user.id in ADMIN_IDS:
+        if user and hasattr(user, 'id') and user.id in tenant().admin_ids:
             await context.bot.send_message(chat_id=user.id, text="⚙️ Доступно админ-меню: /admin")
     except Exception as e:
         logger.error(f"Ошибка в start: {e}")
         if update.message:
             await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=main_menu_keyboard(is_subscribed=True))
 
+def format_trend(current, previous):
+    """Изменение относительно прошлого периода"""
+    if not previous:
+        return "—" if not current else "новое"
+    change = (current - previous) / previous * 100
+    return f"{change:+.0f}%"
+
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /report — итоги продаж по почасовым агрегатам"""
+    user = update.effective_user
+    if not user or user.id not in tenant().admin_ids:
+        if update.message:
+            await update.message.reply_text("❌ Доступ запрещён.")
+        return ConversationHandler.END
+    now = int(time.time())
+    day_start = day_start_ts()
+    # Период -> (начало, сдвиг до прошлого периода): «сегодня» сравнивается с тем же отрезком вчера
+    periods = (
+        ("Сегодня", day_start, 86400),
+        ("7 дней", now - 7 * 86400, 7 * 86400),
+        ("30 дней", now - 30 * 86400, 30 * 86400),
+    )
+    text = "📈 Отчёт по продажам\n\n"
+    for title, start, shift in periods:
+        totals = get_rollup_totals(start, now + 1)
+        previous = get_rollup_totals(start - shift, now + 1 - shift)
+        if totals is None or previous is None:
+            await update.message.reply_text("⚠️ Ошибка получения отчёта")
+            return ConversationHandler.END
+        text += (
+            f"<b>{title}</b>\n"
+            f"🧾 Заказов: {totals['orders_count']} ({format_trend(totals['orders_count'], previous['orders_count'])})\n"
+            f"⭐ Звёзд: {totals['stars']}\n"
+            f"💰 Выручка: {totals['revenue']:.2f}₽ ({format_trend(totals['revenue'], previous['revenue'])})\n"
+            f"👤 Новых пользователей: {totals['new_users']} ({format_trend(totals['new_users'], previous['new_users'])})\n"
+            f"🤝 Реферальные выплаты: {totals['referral_payouts']}₽\n\n"
+        )
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    return ConversationHandler.END
+
+async def rebuild_rollups_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /rebuild_rollups — пересчёт итогов продаж по истории"""
+    user = update.effective_user
+    if not user or user.id not in tenant().admin_ids:
+        if update.message:
+            await update.message.reply_text("❌ Доступ запрещён.")
+        return ConversationHandler.END
+    await update.message.reply_text("⏳ Пересчитываю итоги продаж...")
+    hours = await asyncio.to_thread(rebuild_rollups)
+    if hours is None:
+        await update.message.reply_text("⚠️ Не удалось пересчитать итоги.")
+    else:
+        await update.message.reply_text(f"✅ Итоги пересчитаны: {hours} ч. с данными.")
+    return ConversationHandler.END
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /find — поиск заказов по получателю, отзывов по тексту и пользователей по username"""
+    user = update.effective_user
+    if not user or user.id not in tenant().admin_ids:
+        if update.message:
+            await update.message.reply_text("❌ Доступ запрещён.")
+        return ConversationHandler.END
+    args = context.args or []
+    if args and args[0] in ("orders", "feedback", "users"):
+        kind, args = args[0], args[1:]
+    else:
+        # Без указания вида: @username — заказы по получателю, иначе — отзывы
+        kind = "orders" if args and args[0].startswith("@") else "feedback"
+    query = " ".join(args).strip()
+    if not query:
+        await update.message.reply_text("Использование: /find [orders|feedback|users] текст или @username")
+        return ConversationHandler.END
+    context.user_data['find'] = (kind, query)
+    text, markup = build_find_page(kind, query)
+    await update.message.reply_text(text, reply_markup=markup)
+    return ConversationHandler.END
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /export — выгрузка заказов, пользователей или отзывов в CSV.gz"""
+    user = update.effective_user
+    if not user or user.id not in tenant().admin_ids:
+        if update.message:
+            await update.message.reply_text("❌ Доступ запрещён.")
+        return ConversationHandler.END
+    args = context.args or []
+    try:
+        kind = args[0] if args else "orders"
+        if kind not in EXPORTS:
+            raise ValueError(kind)
+        date_to = datetime.strptime(args[2], "%Y-%m-%d") if len(args) > 2 else datetime.now()
+        date_from = datetime.strptime(args[1], "%Y-%m-%d") if len(args) > 1 else date_to - timedelta(days=EXPORT_DEFAULT_DAYS)
+    except ValueError:
+        await update.message.reply_text(
+            "Использование: /export orders|users|feedback [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]"
+        )
+        return ConversationHandler.END
+    date_from = date_from.strftime("%Y-%m-%d")
+    date_to_excl = (date_to + timedelta(days=1)).strftime("%Y-%m-%d")
+    await update.message.reply_text("⏳ Готовлю выгрузку...")
+    path = None
+    try:
+        # Чтение БД и сжатие — в отдельном потоке, цикл событий не блокируется
+        path, rows = await asyncio.to_thread(write_export, kind, date_from, date_to_excl)
+        with open(path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=user.id,
+                document=f,
+                filename=f"{kind}_{date_from}_{date_to.strftime('%Y-%m-%d')}.csv.gz",
+                caption=f"📦 {kind}: {rows} строк",
+            )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки {kind}: {e}")
+        await update.message.reply_text("⚠️ Не удалось сделать выгрузку. Попробуйте позже.")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+    return ConversationHandler.END
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     help_text = (
         "📌 Доступные команды:\n"
         "/start - Главное меню\n"
         "/help - Эта справка\n"
-        "/admin - Админ-панель (только для админов)\n\n"
-        "ℹ️ По всем вопросам обращайтесь к @timoteo4"
+        "/admin - Админ-панель (только для админов)\n"
+        "/pending - Заказы на проверке (только для админов)\n"
+        "/metrics - Метрики бота (только для админов)\n"
+        "/report - Отчёт по продажам за день, неделю и месяц (только для админов)\n"
+        "/rebuild_rollups - Пересчитать итоги продаж по истории (только для админов)\n"
+        "/find [orders|feedback|users] текст - Поиск заказов, отзывов и пользователей (только для админов)\n"
+        "/export orders|users|feedback [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] - Выгрузка в CSV (только для админов)\n\n"
+        f"ℹ️ По всем вопросам обращайтесь к {tenant().support_username}"
     )
     await update.message.reply_text(help_text)
 
@@ -526,7 +2904,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
         user_id = user.id if user and hasattr(user, 'id') else None
-        if user_id in ADMIN_IDS and update.message:
+        if user_id in tenant().admin_ids and update.message:
             await update.message.reply_text("⚙️ Админ-панель", reply_markup=admin_menu_keyboard())
             return ADMIN_PANEL
         else:
@@ -539,6 +2917,43 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=main_menu_keyboard(is_subscribed=True))
         return ConversationHandler.END
 
+async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /pending — очередь заказов на проверке"""
+    try:
+        user = update.effective_user
+        if not user or user.id not in tenant().admin_ids:
+            if update.message:
+                await update.message.reply_text("❌ Доступ запрещён.")
+            return ConversationHandler.END
+        context.user_data['pending_selected'] = set()
+        text, markup = build_pending_page(context)
+        if update.message:
+            await update.message.reply_text(text, reply_markup=markup)
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Ошибка в pending_command: {e}")
+        if update.message:
+            await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=main_menu_keyboard(is_subscribed=True))
+        return ConversationHandler.END
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /metrics — счётчики и датчики процесса"""
+    user = update.effective_user
+    if not user or user.id not in tenant().admin_ids:
+        if update.message:
+            await update.message.reply_text("❌ Доступ запрещён.")
+        return ConversationHandler.END
+    metrics.set_gauge("user_state.resident_bytes", context.application.user_data_resident_bytes())
+    counters, gauges = metrics.snapshot()
+    lines = [f"{name}: {value}" for name, value in sorted(counters.items())]
+    lines += [f"{name} = {value}" for name, value in sorted(gauges.items())]
+    hits, misses = counters.get("user_cache.hit", 0), counters.get("user_cache.miss", 0)
+    if hits + misses:
+        lines.append(f"user_cache.hit_ratio = {hits / (hits + misses):.2%}")
+    if update.message:
+        await update.message.reply_text("📈 Метрики:\n\n" + ("\n".join(lines) or "Пока пусто."))
+    return ConversationHandler.END
+
 async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик отмены действий"""
     try:
@@ -566,359 +2981,455 @@ async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 # ========== ОБРАБОТЧИКИ СОСТОЯНИЙ ==========
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки"""
-    try:
-        query = update.callback_query if hasattr(update, 'callback_query') else None
-        if not query:
-            if update.message:
-                await update.message.reply_text("Неизвестная команда.")
-            return ConversationHandler.END
-        await query.answer()
-        data = query.data if hasattr(query, 'data') else None
-        user_id = query.from_user.id if hasattr(query, 'from_user') and query.from_user else None
-        # --- ДОБАВЛЯЕМ ОБРАБОТКУ ПОДТВЕРЖДЕНИЯ/ОТКЛОНЕНИЯ ЗАКАЗА АДМИНОМ ---
-        if data and data.startswith("confirm_order_"):
-            order_id = int(data.split("_")[-1])
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM orders WHERE order_id=?", (order_id,))
-            order = cur.fetchone()
-            if not order or order['paid']:
-                await query.edit_message_text("Заказ уже подтверждён или не найден.")
-                conn.close()
-                return ConversationHandler.END
-            # Начисляем звёзды покупателю
-            update_stars(order['user_id'], order['stars_amount'])
-            # Обновляем заказ как оплаченный
-            cur.execute("UPDATE orders SET paid=1 WHERE order_id=?", (order_id,))
-            conn.commit()
-            # Реферальная система
-            user = get_user(order['user_id'])
-            if user and user['referral_id']:
-                referral_id = user['referral_id']
-                bonus_rub = int(order['price'] * REF_PERCENT / 100)
-                bonus_stars = int(order['stars_amount'] * REF_PERCENT / 100)
-                cur.execute("""
-                    UPDATE users 
-                    SET referral_bonus = referral_bonus + ?,
-                        stars = stars + ?
-                    WHERE user_id = ?
-                """, (bonus_rub, bonus_stars, referral_id))
-                conn.commit()
-            conn.close()
-            # Уведомляем пользователя о подтверждении
-            try:
-                # Явно отправляем уведомление даже если user_id в ADMIN_IDS
-                await context.bot.send_message(
-                    order['user_id'],
-                    "Спасибо за покупку! Ваш заказ выполнен. Буду рад если вы оставите свой отзыв здесь - @otzivi_timoteo Мой магазин со всеми товарами - @timoteo_store"
-                )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить пользователя о подтверждении заказа: {e}")
-            await query.edit_message_text("Заказ подтверждён и звёзды начислены.")
-            return ConversationHandler.END
-        elif data and data.startswith("reject_order_"):
-            order_id = int(data.split("_")[-1])
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM orders WHERE order_id=?", (order_id,))
-            order = cur.fetchone()
-            if not order or order['paid']:
-                await query.edit_message_text("Заказ уже подтверждён/отклонён или не найден.")
-                conn.close()
-                return ConversationHandler.END
-            # Отклоняем заказ (можно удалить или оставить paid=0)
-            cur.execute("DELETE FROM orders WHERE order_id=?", (order_id,))
-            conn.commit()
-            conn.close()
-            # Уведомляем пользователя
-            try:
-                await context.bot.send_message(
-                    order['user_id'],
-                    "Ваш заказ был отклонён оператором. Если это ошибка — свяжитесь с поддержкой: @timoteo4"
-                )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить пользователя об отклонении заказа: {e}")
-            await query.edit_message_text("Заказ отклонён.")
-            return ConversationHandler.END
-        # далее все проверки query.message перед вызовом reply_text/edit_text
-        if data == "buy":
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text(
-                    "Укажите получателя звёзд ⭐️\n\n"
-                    "📝 Введите username получателя\n"
-                    "💡 Обязательно начните с символа @\n\n"
-                    "📋 Формат: @username\n\n"
-                    "💎 Звёзды будут отправлены указанному пользователю",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            return BUY_USERNAME
-        elif data == "daily_bonus":
-            user = get_user(user_id)
-            last_spin = user['last_spin'] if user and user['last_spin'] else None
-            if last_spin:
-                last_spin_date = datetime.strptime(last_spin, "%Y-%m-%d")
-                if datetime.now() - last_spin_date < timedelta(days=1):
-                    if hasattr(query, 'message') and isinstance(query.message, Message):
-                        await query.message.reply_text("🎁 Ежедневный бонус уже получен. Попробуйте завтра!")
-                    return ConversationHandler.END
-            # 95% шанс 1-5, 5% шанс 6-100
-            import random
-            chance = random.random()
-            if chance < 0.95:
-                reward = random.randint(1, 5)
-            else:
-                reward = random.randint(6, 100)
-            
-            # Добавляем бонус в referral_bonus (рубли) вместо stars
-            try:
-                conn = db_connect()
-                cur = conn.cursor()
-                cur.execute("UPDATE users SET referral_bonus = referral_bonus + ?, last_spin=? WHERE user_id=?", (reward, datetime.now().strftime("%Y-%m-%d"), user_id))
-                conn.commit()
-                logger.info(f"Ежедневный бонус {reward}₽ начислен пользователю {user_id}")
-            finally:
-                if conn:
-                    conn.close()
-            
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text(f"🎁 Ваш ежедневный бонус: {reward}₽!\n\nЗаглядывайте каждый день и получайте больше!")
-            return ConversationHandler.END
-        elif data == "referrals":
-            user = get_user(user_id)
-            if user:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text(
-                        f"🤝 Рефералы: {user['referrals_count']}\n"
-                        f"🎁 Бонус: {user['referral_bonus']}₽\n\n"
-                        f"Реферальная ссылка:\n"
-                        f"t.me/{context.bot.username}?start={user_id}",
-                        reply_markup=referrals_keyboard()
-                    )
-            else:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text("Данные не найдены.", reply_markup=cancel_keyboard())
-            return ConversationHandler.END
-        elif data == "profile":
-            user = get_user(user_id)
-            if user:
-                total_stars = get_total_stars(user_id)
-                bonus = get_referral_bonus(user_id)
-                personal_course = get_personal_course(user_id)
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text(
-                        f"🧾 Профиль:\n"
-                        f"⭐ Всего куплено звёзд: {total_stars}\n"
-                        f"🤝 Бонус: {bonus}₽\n"
-                        f"👥 Приглашено: {user['referrals_count']}\n"
-                        f"💸 Ваш персональный курс: {personal_course:.2f}₽ за 1 звезду\n\n"
-                        f"Выберите действие:",
-                        reply_markup=profile_keyboard()
-                    )
-            else:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text("Данные не найдены.", reply_markup=cancel_keyboard())
-            return ConversationHandler.END
-        elif data == "my_orders":
-            orders = get_orders(user_id)
-            if orders:
-                text = "📦 Ваши заказы:\n\n"
-                for order in orders:
-                    text += (
-                        f"🆔 Заказ #{order['order_id']}\n"
-                        f"👤 Получатель: {order['recipient_username']}\n"
-                        f"⭐ Звёзд: {order['stars_amount']}\n"
-                        f"💰 Сумма: {order['price']}₽\n"
-                        f"📅 Дата: {order['created_at']}\n"
-                        f"Статус: {'✅ Оплачено' if order['paid'] else '❌ Не оплачено'}\n\n"
-                    )
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text(text, reply_markup=cancel_keyboard(show_main_menu=False))
-                return VIEW_ORDERS
-            else:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text("У вас пока нет заказов.", reply_markup=cancel_keyboard(show_main_menu=False))
-                return VIEW_ORDERS
-        elif data == "feedback":
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text("Напишите ваш отзыв или предложение:", reply_markup=cancel_keyboard(show_main_menu=False))
-            return LEAVE_FEEDBACK
-        elif data == "exchange_bonus":
-            user = get_user(user_id)
-            bonus = user['referral_bonus'] if user else 0
-            current_course = float(get_setting('course') or COURSE_DEFAULT)
-            if bonus < 50:
-                msg = f"Ваш бонус: {bonus}₽\n\nМинимальная сумма для обмена — 50₽.\nБонусы начисляются за покупки ваших рефералов."
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text(msg, reply_markup=cancel_keyboard(show_main_menu=False))
-                return ConversationHandler.END
-            msg = (
-                f"💸 Ваш бонус: {bonus}₽\n\n"
-                f"Вы можете обменять бонусные рубли на звёзды по курсу {current_course}₽ за 1 звезду.\n"
-                f"Минимальная сумма для обмена — 50₽.\n\n"
-                f"Введите сумму для обмена (целое число, не более {bonus}):"
-            )
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text(msg, reply_markup=cancel_keyboard(show_main_menu=False))
-            context.user_data['max_bonus'] = bonus
-            return EXCHANGE_BONUS
-        elif data == "check_subscription":
-            user_id = query.from_user.id
-            import asyncio
-            await query.answer("Проверяем подписку...", show_alert=False)
-            await asyncio.sleep(1.5)  # Даем Telegram время обновить статус
-            try:
-                is_subscribed = await check_subscription(user_id, context)
-                logger.info(f"Проверка подписки: user_id={user_id}, is_subscribed={is_subscribed}")
-                if is_subscribed:
-                    # Удаляем сообщение с кнопками подписки, если это возможно
-                    msg = getattr(query, 'message', None)
-                    if msg and hasattr(msg, 'delete'):
-                        try:
-                            await msg.delete()
-                        except Exception as e:
-                            logger.warning(f"Не удалось удалить сообщение с кнопками подписки: {e}")
-                    # Отправляем новое сообщение с главным меню
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"✅ Вы подписаны на канал {CHANNEL_USERNAME}!\nТекущий курс: {COURSE_DEFAULT}₽ за 1 звезду\n\nВыбери действие:",
-                        reply_markup=main_menu_keyboard(is_subscribed=True)
-                    )
-                else:
-                    # Показываем сообщение для неподписанных с кнопками подписки
-                    await query.edit_message_text(
-                        f"❌ Вы не подписаны на канал {CHANNEL_USERNAME}.\n"
-                        f"Ваш курс: {COURSE_UNSUBSCRIBED}₽ за 1 звезду\n"
-                        f"Подпишитесь для получения лучшего курса!",
-                        reply_markup=main_menu_keyboard(is_subscribed=False)
-                    )
-            except Exception as e:
-                logger.error(f"Ошибка при проверке подписки: {e}")
-                await query.edit_message_text(
-                    f"⚠️ Ошибка проверки подписки. Попробуйте позже.\n"
-                    f"Или подпишитесь на канал {CHANNEL_USERNAME} и нажмите кнопку снова."
-                )
+# Данные незавершённых диалогов, которые не нужны после их истечения
+CONVERSATION_KEYS = ("recipient_username", "stars_amount", "price", "order_id", "max_bonus", "broadcast_segment")
+
+async def conversation_timeout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Диалог брошен дольше CONVERSATION_TIMEOUT — освобождаем его данные"""
+    for key in CONVERSATION_KEYS:
+        context.user_data.pop(key, None)
+    metrics.inc("conversation.timeouts")
+
+class CallbackRouter:
+    """Таблица маршрутов кнопок: callback_data -> корутина.
+    Точное имя ищется в словаре; для маршрутов с параметром числовой хвост "_<id>"
+    отделяется один раз и маршрут тоже ищется в словаре — без цепочки startswith."""
+
+    def __init__(self):
+        self.routes = {}  # имя -> (корутина, только для админов, принимает ли числовой параметр)
+
+    def route(self, *names, admin=False, param=False):
+        """Декоратор: регистрирует корутину route(query, context, arg) под одним или несколькими именами"""
+        def register(handler):
+            for name in names:
+                self.routes[name] = (handler, admin, param)
+            return handler
+        return register
+
+    def resolve(self, data):
+        """Имя маршрута и числовой параметр (или None) по callback_data"""
+        if data in self.routes:
+            return data, None
+        prefix, _, tail = (data or "").rpartition("_")
+        if tail.isdigit() and self.routes.get(prefix, (None, False, False))[2]:
+            return prefix, int(tail)
+        return None, None
+
+    async def dispatch(self, query, context):
+        name, arg = self.resolve(query.data)
+        if name is None:
+            metrics.inc("route.unknown")
+            await reply(query, "Неизвестная команда.")
             return ConversationHandler.END
-        elif data == "set_course":
-            if user_id not in ADMIN_IDS:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text("❌ Доступ запрещён.")
-                return ConversationHandler.END
-            current_course = float(get_setting('course') or COURSE_DEFAULT)
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text(f"Текущий курс: {current_course}₽\nВведите новый:")
-            return ADMIN_SET_COURSE
-        elif data == "stats":
-            if user_id not in ADMIN_IDS:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text("❌ Доступ запрещён.")
-                return ConversationHandler.END
-            try:
-                conn = db_connect()
-                cur = conn.cursor()
-                cur.execute("SELECT COUNT(*) as users_count, SUM(stars) as total_stars FROM users")
-                stats = cur.fetchone()
-                cur.execute("""
-                    SELECT 
-                        u.user_id,
-                        u.username,
-                        u.referrals_count,
-                        u.referral_bonus,
-                        COUNT(o.order_id) as orders_count,
-                        SUM(o.price) as total_income
-                    FROM users u
-                    LEFT JOIN orders o ON u.user_id = o.user_id
-                    WHERE u.referrals_count > 0
-                    GROUP BY u.user_id
-                    ORDER BY u.referrals_count DESC
-                """)
-                referrals = cur.fetchall()
-                text = (
-                    f"📊 Общая статистика:\n"
-                    f"👥 Пользователей: {stats['users_count']}\n"
-                    f"⭐ Всего звёзд: {stats['total_stars'] or 0}\n\n"
-                    f"🤝 Реферальная система:\n"
-                )
-                for ref in referrals:
-                    text += (
-                        f"\n@{ref['username']} (ID: {ref['user_id']})\n"
-                        f"→ Приглашено: {ref['referrals_count']}\n"
-                        f"→ Бонусов: {ref['referral_bonus']}\n"
-                        f"→ Заказов: {ref['orders_count']}\n"
-                        f"→ Сумма: {ref['total_income'] or 0}₽\n"
-                    )
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text(text)
-            except Exception as e:
-                logger.error(f"Ошибка получения статистики: {e}")
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text("⚠️ Ошибка получения статистики", reply_markup=main_menu_keyboard(is_subscribed=True))
-            finally:
-                if conn:
-                    conn.close()
-            return ADMIN_PANEL
-        elif data == "broadcast":
-            if user_id not in ADMIN_IDS:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.reply_text("❌ Доступ запрещён.")
-                return ConversationHandler.END
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text("Введите текст рассылки:")
-            return ADMIN_BROADCAST
-        elif data == "main_menu":
-            try:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
-                    await query.message.delete()
-            except Exception as e:
-                logger.error(f"Ошибка при возврате в главное меню: {e}")
+        handler, admin, _ = self.routes[name]
+        if admin and query.from_user.id not in tenant().admin_ids:
+            metrics.inc(f"route.{name}.denied")
+            await reply(query, "❌ Доступ запрещён.")
             return ConversationHandler.END
-        elif data == "cancel":
-            try:
-                if hasattr(query, 'message') and isinstance(query.message, Message):
+        started = time.perf_counter()
+        try:
+            return await handler(query, context, arg)
+        except Exception:
+            metrics.inc(f"route.{name}.errors")
+            raise
+        finally:
+            metrics.inc(f"route.{name}.calls")
+            metrics.inc(f"route.{name}.ms", round((time.perf_counter() - started) * 1000))
+
+router = CallbackRouter()
+
+async def reply(query, text, **kwargs):
+    """Ответ новым сообщением под нажатой кнопкой (если исходное сообщение доступно)"""
+    if isinstance(query.message, Message):
+        return await query.message.reply_text(text, **kwargs)
+
+# --- ПОДТВЕРЖДЕНИЕ/ОТКЛОНЕНИЕ ЗАКАЗА АДМИНОМ ---
+@router.route("confirm_order", admin=True, param=True)
+async def route_confirm_order(query, context, order_id):
+    # Подтверждаем только заказ, ожидающий проверки
+    settled = settle_orders([order_id], confirm=True)
+    if settled is None:
+        await reply(query, SETTLE_FAILED_TEXT)
+        return ConversationHandler.END
+    if not settled:
+        await query.edit_message_text("Заказ уже подтверждён или не найден.")
+        return ConversationHandler.END
+    notify_settled_orders(context, settled, confirm=True)
+    await query.edit_message_text("Заказ подтверждён и звёзды начислены.")
+    return ConversationHandler.END
+
+@router.route("reject_order", admin=True, param=True)
+async def route_reject_order(query, context, order_id):
+    settled = settle_orders([order_id], confirm=False)
+    if settled is None:
+        await reply(query, SETTLE_FAILED_TEXT)
+        return ConversationHandler.END
+    if not settled:
+        await query.edit_message_text("Заказ уже подтверждён/отклонён или не найден.")
+        return ConversationHandler.END
+    notify_settled_orders(context, settled, confirm=False)
+    await query.edit_message_text("Заказ отклонён.")
+    return ConversationHandler.END
+
+@router.route("payment_photo", "download_payment", admin=True, param=True)
+async def route_payment_photo(query, context, order_id):
+    user_id = query.from_user.id
+    order = get_order(order_id)
+    if not order or not order['payment_file_id']:
+        await context.bot.send_message(user_id, f"У заказа #{order_id} нет скриншота.")
+        return ConversationHandler.END
+    if query.data.startswith("payment_photo_"):
+        # Повторная пересылка по file_id, без загрузки
+        await context.bot.send_photo(
+            user_id,
+            order['payment_file_id'],
+            caption=f"Скриншот оплаты к заказу #{order_id}",
+            reply_markup=admin_confirm_keyboard(order_id, has_photo=True)
+        )
+    else:
+        path = await download_payment_photo(context.bot, order)
+        await context.bot.send_message(user_id, f"📥 Скриншот заказа #{order_id} сохранён: {path}")
+    return ConversationHandler.END
+
+@router.route("find_page", admin=True, param=True)
+async def route_find_page(query, context, page):
+    if 'find' not in context.user_data:
+        return ConversationHandler.END
+    kind, find_query = context.user_data['find']
+    text, markup = build_find_page(kind, find_query, page)
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except Exception as e:
+        logger.info(f"Не удалось обновить результаты поиска: {e}")
+    return ConversationHandler.END
+
+@router.route(
+    "pending", "pending_page", "pending_toggle",
+    "pending_confirm_selected", "pending_reject_selected", "pending_confirm_page",
+    admin=True, param=True,
+)
+async def route_pending(query, context, arg):
+    data = query.data
+    selected = context.user_data.setdefault('pending_selected', set())
+    after_id = context.user_data.get('pending_after', 0)
+    notice = None
+    if data == "pending":
+        after_id = 0
+        selected.clear()
+    elif data.startswith("pending_page_"):
+        after_id = arg
+    elif data.startswith("pending_toggle_"):
+        selected ^= {arg}
+    elif data in ("pending_confirm_selected", "pending_reject_selected", "pending_confirm_page"):
+        # Вся пачка завершается одной транзакцией
+        ids = context.user_data.get('pending_page', []) if data == "pending_confirm_page" else sorted(selected)
+        confirm = data != "pending_reject_selected"
+        settled = settle_orders(ids, confirm=confirm)
+        if settled is None:
+            notice = SETTLE_FAILED_TEXT
+        else:
+            notify_settled_orders(context, settled, confirm=confirm)
+            selected.difference_update(ids)
+            notice = f"{'✅ Подтверждено' if confirm else '❌ Отклонено'}: {len(settled)}"
+            if len(settled) < len(ids):
+                notice += f" (уже завершено другим админом: {len(ids) - len(settled)})"
+    text, markup = build_pending_page(context, after_id, notice)
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except Exception as e:
+        logger.info(f"Не удалось обновить очередь заказов: {e}")
+    return ConversationHandler.END
+
+# --- МАРШРУТЫ ПОКУПАТЕЛЯ ---
+@router.route("buy")
+async def route_buy(query, context, arg):
+    subscription_refresher.touch(query.from_user.id, purchase=True)
+    await reply(
+        query,
+        "Укажите получателя звёзд ⭐️\n\n"
+        "📝 Введите username получателя\n"
+        "💡 Обязательно начните с символа @\n\n"
+        "📋 Формат: @username\n\n"
+        "💎 Звёзды будут отправлены указанному пользователю",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return BUY_USERNAME
+
+@router.route("daily_bonus")
+async def route_daily_bonus(query, context, arg):
+    # Бонус начисляется в referral_bonus (рубли) вместо stars
+    reward = claim_daily_bonus(query.from_user.id)
+    if reward is None:
+        await reply(query, "🎁 Ежедневный бонус уже получен. Попробуйте завтра!")
+        return ConversationHandler.END
+    await reply(query, f"🎁 Ваш ежедневный бонус: {reward}₽!\n\nЗаглядывайте каждый день и получайте больше!")
+    return ConversationHandler.END
+
+@router.route("referrals")
+async def route_referrals(query, context, arg):
+    user_id = query.from_user.id
+    user = get_user(user_id)
+    if user:
+        await reply(
+            query,
+            f"🤝 Рефералы: {user['referrals_count']}\n"
+            f"🎁 Бонус: {user['referral_bonus']}₽\n\n"
+            f"Реферальная ссылка:\n"
+            f"t.me/{context.bot.username}?start={user_id}",
+            reply_markup=referrals_keyboard()
+        )
+    else:
+        await reply(query, "Данные не найдены.", reply_markup=cancel_keyboard())
+    return ConversationHandler.END
+
+@router.route("profile")
+async def route_profile(query, context, arg):
+    user_id = query.from_user.id
+    user = get_user(user_id)
+    if user:
+        total_stars = get_total_stars(user_id)
+        bonus = get_referral_bonus(user_id)
+        personal_course = get_personal_course(user_id)
+        # Оборот сети пропорционален её размеру — считаем вне цикла событий
+        network_size, network_depth, network_revenue = await asyncio.to_thread(get_referral_network, user_id)
+        await reply(
+            query,
+            f"🧾 Профиль:\n"
+            f"⭐ Всего куплено звёзд: {total_stars}\n"
+            f"🤝 Бонус: {bonus}₽\n"
+            f"👥 Приглашено: {user['referrals_count']}\n"
+            f"🌐 Вся сеть: {network_size} чел., уровней: {network_depth}, оборот: {network_revenue}₽\n"
+            f"💸 Ваш персональный курс: {personal_course:.2f}₽ за 1 звезду\n\n"
+            f"Выберите действие:",
+            reply_markup=profile_keyboard()
+        )
+    else:
+        await reply(query, "Данные не найдены.", reply_markup=cancel_keyboard())
+    return ConversationHandler.END
+
+@router.route("my_orders", param=True)
+async def route_my_orders(query, context, before_id):
+    orders, has_more = get_orders(query.from_user.id, before_id)
+    if not orders:
+        await reply(query, "У вас пока нет заказов.", reply_markup=cancel_keyboard(show_main_menu=False))
+        return VIEW_ORDERS
+    text = "📦 Ваши заказы:\n\n" if before_id is None else "📦 Более ранние заказы:\n\n"
+    for order in orders:
+        text += (
+            f"🆔 Заказ #{order['order_id']}\n"
+            f"👤 Получатель: {order['recipient_username']}\n"
+            f"⭐ Звёзд: {order['stars_amount']}\n"
+            f"💰 Сумма: {order['price']}₽\n"
+            f"📅 Дата: {order['created_at']}\n"
+            f"Статус: {ORDER_STATUS_LABELS.get(order['status'], order['status'])}\n\n"
+        )
+    next_before = orders[-1]['order_id'] if has_more else None
+    await reply(query, text, reply_markup=orders_page_keyboard(next_before))
+    return VIEW_ORDERS
+
+@router.route("feedback")
+async def route_feedback(query, context, arg):
+    await reply(query, "Напишите ваш отзыв или предложение:", reply_markup=cancel_keyboard(show_main_menu=False))
+    return LEAVE_FEEDBACK
+
+@router.route("exchange_bonus")
+async def route_exchange_bonus(query, context, arg):
+    user = get_user(query.from_user.id)
+    bonus = user['referral_bonus'] if user else 0
+    current_course = float(get_setting('course') or tenant().course_default)
+    if bonus < 50:
+        msg = f"Ваш бонус: {bonus}₽\n\nМинимальная сумма для обмена — 50₽.\nБонусы начисляются за покупки ваших рефералов."
+        await reply(query, msg, reply_markup=cancel_keyboard(show_main_menu=False))
+        return ConversationHandler.END
+    msg = (
+        f"💸 Ваш бонус: {bonus}₽\n\n"
+        f"Вы можете обменять бонусные рубли на звёзды по курсу {current_course}₽ за 1 звезду.\n"
+        f"Минимальная сумма для обмена — 50₽.\n\n"
+        f"Введите сумму для обмена (целое число, не более {bonus}):"
+    )
+    await reply(query, msg, reply_markup=cancel_keyboard(show_main_menu=False))
+    context.user_data['max_bonus'] = bonus
+    return EXCHANGE_BONUS
+
+@router.route("check_subscription")
+async def route_check_subscription(query, context, arg):
+    user_id = query.from_user.id
+    await query.answer("Проверяем подписку...", show_alert=False)
+    try:
+        # Проверка вне очереди; если фоновое задание не успело — берём сохранённый статус
+        is_subscribed = None
+        if tenant().check_subscription:
+            is_subscribed = await subscription_refresher.refresh_now(user_id, SUBSCRIPTION_FORCE_TIMEOUT)
+        if is_subscribed is None:
+            is_subscribed = subscription_status(user_id)
+        logger.info(f"Проверка подписки: user_id={user_id}, is_subscribed={is_subscribed}")
+        if is_subscribed:
+            # Удаляем сообщение с кнопками подписки, если это возможно
+            if isinstance(query.message, Message):
+                try:
                     await query.message.delete()
-            except Exception as e:
-                logger.error(f"Ошибка при отмене действия: {e}")
-            return ConversationHandler.END
-        elif data == "pay_order":
-            price = context.user_data.get("price") if context.user_data else None
-            recipient = context.user_data.get("recipient_username", "-") if context.user_data else "-"
-            amount = context.user_data.get("stars_amount") if context.user_data else None
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text(
-                    f"<b>РЕКВИЗИТЫ ДЛЯ ОПЛАТЫ:</b>\n"
-                    f"+79652234445 Т-банк\n\n"
-                    f"Сумма к оплате: <b>{price}₽</b>\n\n"
-                    f"После оплаты напишите <b>оплатил</b> для подтверждения.",
-                    reply_markup=cancel_keyboard(),
-                    parse_mode=ParseMode.HTML
-                )
-            return WAIT_PAYMENT
-        elif data == "edit_recipient":
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text(
-                    "Укажите нового получателя звёзд ⭐️\n\n"
-                    "📝 Введите username получателя\n"
-                    "💡 Обязательно начните с символа @\n\n"
-                    "📋 Формат: @username\n\n"
-                    "💎 Звёзды будут отправлены указанному пользователю",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            return BUY_USERNAME
-        elif data == "edit_amount":
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text(
-                    f"Введите количество звёзд (мин. {MIN_STARS}):",
-                    reply_markup=cancel_keyboard(show_main_menu=False)
-                )
-            return BUY_AMOUNT
+                except Exception as e:
+                    logger.warning(f"Не удалось удалить сообщение с кнопками подписки: {e}")
+            # Отправляем новое сообщение с главным меню
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"✅ Вы подписаны на канал {tenant().channel_username}!\nТекущий курс: {tenant().course_default}₽ за 1 звезду\n\nВыбери действие:",
+                reply_markup=main_menu_keyboard(is_subscribed=True)
+            )
         else:
-            if hasattr(query, 'message') and isinstance(query.message, Message):
-                await query.message.reply_text("Неизвестная команда.")
+            # Показываем сообщение для неподписанных с кнопками подписки
+            await query.edit_message_text(
+                f"❌ Вы не подписаны на канал {tenant().channel_username}.\n"
+                f"Ваш курс: {tenant().course_unsubscribed}₽ за 1 звезду\n"
+                f"Подпишитесь для получения лучшего курса!",
+                reply_markup=main_menu_keyboard(is_subscribed=False)
+            )
+    except Exception as e:
+        logger.error(f"Ошибка при проверке подписки: {e}")
+        await query.edit_message_text(
+            f"⚠️ Ошибка проверки подписки. Попробуйте позже.\n"
+            f"Или подпишитесь на канал {tenant().channel_username} и нажмите кнопку снова."
+        )
+    return ConversationHandler.END
+
+# --- МАРШРУТЫ АДМИН-ПАНЕЛИ ---
+@router.route("set_course", admin=True)
+async def route_set_course(query, context, arg):
+    current_course = float(get_setting('course') or tenant().course_default)
+    await reply(query, f"Текущий курс: {current_course}₽\nВведите новый:")
+    return ADMIN_SET_COURSE
+
+@router.route("stats", admin=True)
+async def route_stats(query, context, arg):
+    conn = None
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) as users_count, SUM(stars) as total_stars FROM users")
+        stats = cur.fetchone()
+        cur.execute("""
+            SELECT 
+                u.user_id,
+                u.username,
+                u.referrals_count,
+                u.referral_bonus,
+                (SELECT COUNT(*) FROM orders o WHERE o.user_id = u.user_id AND o.status = 'confirmed')
+                    + COALESCE(t.orders_count, 0) as orders_count,
+                COALESCE((SELECT SUM(o.price) FROM orders o WHERE o.user_id = u.user_id AND o.status = 'confirmed'), 0)
+                    + COALESCE(t.price_total, 0) as total_income
+            FROM users u
+            LEFT JOIN user_order_totals t ON t.user_id = u.user_id
+            WHERE u.referrals_count > 0
+            ORDER BY u.referrals_count DESC
+        """)
+        referrals = cur.fetchall()
+        daily_claims = count_daily_claims()
+        live_orders = count_live_orders()
+        text = (
+            f"📊 Общая статистика:\n"
+            f"👥 Пользователей: {stats['users_count']}\n"
+            f"⭐ Всего звёзд: {stats['total_stars'] or 0}\n"
+            f"🎁 Бонус получен сегодня: {daily_claims}\n"
+            f"⏳ Ожидают оплаты: {live_orders.get(ORDER_AWAITING_PAYMENT, 0)}\n"
+            f"🔎 Ждут проверки: {live_orders.get(ORDER_CLAIMED_PAID, 0)}\n\n"
+            f"🤝 Реферальная система:\n"
+        )
+        for ref in referrals:
+            text += (
+                f"\n@{ref['username']} (ID: {ref['user_id']})\n"
+                f"→ Приглашено: {ref['referrals_count']}\n"
+                f"→ Бонусов: {ref['referral_bonus']}\n"
+                f"→ Заказов: {ref['orders_count']}\n"
+                f"→ Сумма: {ref['total_income'] or 0}₽\n"
+            )
+        await reply(query, text)
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики: {e}")
+        await reply(query, "⚠️ Ошибка получения статистики", reply_markup=main_menu_keyboard(is_subscribed=True))
+    finally:
+        if conn:
+            conn.close()
+    return ADMIN_PANEL
+
+@router.route("broadcast", admin=True)
+async def route_broadcast(query, context, arg):
+    await reply(query, "Кому отправить рассылку?", reply_markup=broadcast_segments_keyboard())
+    return ADMIN_PANEL
+
+@router.route(*(f"bcast_{segment}" for segment in BROADCAST_SEGMENTS), admin=True, param=True)
+async def route_broadcast_segment(query, context, days):
+    segment = query.data[len("bcast_"):].split("_")[0]
+    if segment != "active":
+        days = None
+    elif days is None:
+        # Кнопка без срока (например, из старой клавиатуры) — самый широкий вариант
+        days = max(BROADCAST_ACTIVE_DAYS)
+    context.user_data['broadcast_segment'] = (segment, days)
+    audience = count_broadcast_audience(segment, days)
+    label = BROADCAST_SEGMENTS[segment][0] + (f" {days} дн." if days else "")
+    await reply(query, f"Сегмент: {label}\nПолучателей: {audience}\n\nВведите текст рассылки:")
+    return ADMIN_BROADCAST
+
+# --- НАВИГАЦИЯ И ОФОРМЛЕНИЕ ЗАКАЗА ---
+@router.route("main_menu", "cancel")
+async def route_close(query, context, arg):
+    try:
+        if isinstance(query.message, Message):
+            await query.message.delete()
+    except Exception as e:
+        logger.error(f"Ошибка при закрытии сообщения ({query.data}): {e}")
+    return ConversationHandler.END
+
+@router.route("pay_order")
+async def route_pay_order(query, context, arg):
+    price = context.user_data.get("price")
+    recipient = context.user_data.get("recipient_username", "-")
+    amount = context.user_data.get("stars_amount")
+    # Заказ создаётся в статусе awaiting_payment при выдаче реквизитов
+    if price is not None and amount and not context.user_data.get("order_id"):
+        context.user_data["order_id"] = add_order(query.from_user.id, recipient, amount, price)
+    await reply(
+        query,
+        f"<b>РЕКВИЗИТЫ ДЛЯ ОПЛАТЫ:</b>\n"
+        f"{tenant().payment_details}\n\n"
+        f"Сумма к оплате: <b>{price}₽</b>\n\n"
+        f"После оплаты напишите <b>оплатил</b> для подтверждения.",
+        reply_markup=cancel_keyboard(),
+        parse_mode=ParseMode.HTML
+    )
+    return WAIT_PAYMENT
+
+@router.route("edit_recipient")
+async def route_edit_recipient(query, context, arg):
+    await reply(
+        query,
+        "Укажите нового получателя звёзд ⭐️\n\n"
+        "📝 Введите username получателя\n"
+        "💡 Обязательно начните с символа @\n\n"
+        "📋 Формат: @username\n\n"
+        "💎 Звёзды будут отправлены указанному пользователю",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return BUY_USERNAME
+
+@router.route("edit_amount")
+async def route_edit_amount(query, context, arg):
+    await reply(query, f"Введите количество звёзд (мин. {MIN_STARS}):", reply_markup=cancel_keyboard(show_main_menu=False))
+    return BUY_AMOUNT
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий на кнопки: диспетчеризация по таблице маршрутов"""
+    try:
+        query = update.callback_query
+        if not query:
+            if update.message:
+                await update.message.reply_text("Неизвестная команда.")
             return ConversationHandler.END
+        await query.answer()
+        return await router.dispatch(query, context)
     except Exception as e:
         logger.error(f"Ошибка в button_handler: {e}")
-        if hasattr(update, 'callback_query') and update.callback_query and hasattr(update.callback_query, 'message') and update.callback_query.message:
+        if update.callback_query and update.callback_query.message:
             await update.callback_query.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=main_menu_keyboard(is_subscribed=True))
         return ConversationHandler.END
 
@@ -942,10 +3453,10 @@ async def buy_username_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         # Получаем актуальный курс для пользователя
         user_id = update.effective_user.id if update.effective_user else None
         if user_id:
-            is_subscribed = await check_subscription(user_id, context)
-            current_course = COURSE_DEFAULT if is_subscribed else COURSE_UNSUBSCRIBED
+            is_subscribed = subscription_status(user_id, purchase=True)
+            current_course = tenant().course_default if is_subscribed else tenant().course_unsubscribed
         else:
-            current_course = COURSE_UNSUBSCRIBED
+            current_course = tenant().course_unsubscribed
         
         if isinstance(update.message, Message):
             await update.message.reply_text(
@@ -988,12 +3499,14 @@ async def buy_amount_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data["stars_amount"] = amount
     user_id = update.effective_user.id if update.effective_user else None
     if user_id:
-        is_subscribed = await check_subscription(user_id, context)
-        current_course = COURSE_DEFAULT if is_subscribed else COURSE_UNSUBSCRIBED
+        is_subscribed = subscription_status(user_id, purchase=True)
+        current_course = tenant().course_default if is_subscribed else tenant().course_unsubscribed
     else:
-        current_course = COURSE_UNSUBSCRIBED  # По умолчанию повышенный курс
+        current_course = tenant().course_unsubscribed  # По умолчанию повышенный курс
     price = round(amount * current_course, 2)
     context.user_data["price"] = price
+    # Условия заказа изменились — при оплате будет создан новый заказ
+    context.user_data.pop("order_id", None)
     context.user_data["course"] = current_course
     recipient = context.user_data.get("recipient_username", "-")
     confirm_text = (
@@ -1018,41 +3531,41 @@ async def wait_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         if "оплатил" in text or has_photo:
             user_id = update.effective_user.id
             payment_data = context.user_data
-            if has_photo:
-                photo = await update.message.photo[-1].get_file()
-                filename = f"{PAYMENTS_DIR}/{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                await photo.download_to_drive(filename)
-            # Сохраняем заказ с paid=0
-            add_order(
-                user_id=user_id,
-                recipient_username=payment_data['recipient_username'],
-                stars_amount=payment_data['stars_amount'],
-                price=payment_data['price'],
-                paid=0
-            )
-            # Получаем только что созданный заказ (по user_id и paid=0, самый свежий)
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute("SELECT order_id FROM orders WHERE user_id=? AND paid=0 ORDER BY created_at DESC LIMIT 1", (user_id,))
-            order = cur.fetchone()
-            order_id = order['order_id'] if order else None
-            conn.close()
-            # Уведомление админу с кнопками
-            for admin_id in ADMIN_IDS:
-                try:
-                    buyer_username = f"@{update.effective_user.username}" if update.effective_user and update.effective_user.username else f"не указан (ID: {update.effective_user.id})"
-                    recipient_username = payment_data['recipient_username'] if payment_data.get('recipient_username') else 'не указан'
-                    await context.bot.send_message(
-                        admin_id,
-                        f"<b>Новый заказ!</b>\n"
-                        f"Покупатель: {buyer_username}\n"
-                        f"Получатель: {recipient_username}\n"
-                        f"Сумма: <b>{payment_data['price']}₽</b>",
-                        reply_markup=admin_confirm_keyboard(order_id),
-                        parse_mode=ParseMode.HTML
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+            # Скриншот не загружаем: сохраняем file_id и пересылаем админам по нему
+            photo = update.message.photo[-1] if has_photo else None
+            photo_file_id = photo.file_id if photo else None
+            photo_unique_id = photo.file_unique_id if photo else None
+            # Переводим заказ в claimed_paid; если он уже истёк — создаём новый
+            order_id = payment_data.pop('order_id', None)
+            if not order_id or not claim_order(order_id, photo_file_id, photo_unique_id):
+                order_id = add_order(
+                    user_id=user_id,
+                    recipient_username=payment_data['recipient_username'],
+                    stars_amount=payment_data['stars_amount'],
+                    price=payment_data['price'],
+                    status=ORDER_CLAIMED_PAID,
+                    photo_file_id=photo_file_id,
+                    photo_unique_id=photo_unique_id
+                )
+            # Повторно использованный скриншот отмечаем сразу, без загрузки файла
+            duplicate_of = register_payment_evidence(order_id, photo_unique_id) if photo else None
+            warning = f"\n⚠️ Скриншот уже использовался в заказе #{duplicate_of}" if duplicate_of else ""
+            # Уведомление админам с кнопками — в фоне, параллельно, либо через сводку
+            buyer_username = f"@{update.effective_user.username}" if update.effective_user and update.effective_user.username else f"не указан (ID: {update.effective_user.id})"
+            recipient_username = payment_data['recipient_username'] if payment_data.get('recipient_username') else 'не указан'
+            if admin_digest.record_order():
+                admin_digest.add(f"#{order_id} · {buyer_username} → {recipient_username} · <b>{payment_data['price']}₽</b>{' 🖼' if photo else ''}{' ⚠️' if duplicate_of else ''}")
+            else:
+                notify_admins_background(
+                    context,
+                    f"<b>Новый заказ!</b>\n"
+                    f"Покупатель: {buyer_username}\n"
+                    f"Получатель: {recipient_username}\n"
+                    f"Сумма: <b>{payment_data['price']}₽</b>{warning}",
+                    photo=photo_file_id,
+                    reply_markup=admin_confirm_keyboard(order_id, has_photo=bool(photo)),
+                    parse_mode=ParseMode.HTML
+                )
             if update.message:
                 await update.message.reply_text(
                     "Спасибо! Ваша оплата будет проверена оператором. Ожидайте подтверждения.",
@@ -1076,7 +3589,7 @@ async def admin_set_course(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_main_menu(update, context, greeting=False)
             return ConversationHandler.END
         user_id = update.effective_user.id
-        if user_id not in ADMIN_IDS:
+        if user_id not in tenant().admin_ids:
             if update.message:
                 await update.message.reply_text("❌ Доступ запрещён.", reply_markup=main_menu_keyboard(is_subscribed=True))
             return ConversationHandler.END
@@ -1104,7 +3617,7 @@ async def admin_broadcast_handler(update: Update, context: ContextTypes.DEFAULT_
             await show_main_menu(update, context, greeting=False)
             return ConversationHandler.END
         user_id = update.effective_user.id
-        if user_id not in ADMIN_IDS:
+        if user_id not in tenant().admin_ids:
             if update.message:
                 await update.message.reply_text("❌ Доступ запрещён.", reply_markup=main_menu_keyboard(is_subscribed=True))
             return ConversationHandler.END
@@ -1113,24 +3626,23 @@ async def admin_broadcast_handler(update: Update, context: ContextTypes.DEFAULT_
             if update.message:
                 await update.message.reply_text("Текст пустой, попробуйте снова.", reply_markup=cancel_keyboard())
             return ADMIN_BROADCAST
-        try:
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute("SELECT user_id FROM users")
-            users = cur.fetchall()
-            count = 0
-            for (uid,) in users:
-                try:
-                    await context.bot.send_message(uid, f"📢 Админ рассылка:\n\n{text}")
-                    count += 1
-                    await asyncio.sleep(0.05)
-                except Exception as e:
-                    logger.warning(f"Ошибка отправки {uid}: {e}")
-            if update.message:
-                await update.message.reply_text(f"Рассылка отправлена {count} пользователям.", reply_markup=main_menu_keyboard(is_subscribed=True))
-        finally:
-            if conn:
-                conn.close()
+        segment, days = context.user_data.pop('broadcast_segment', ("all", None))
+        count = blocked = 0
+        for uid in iter_broadcast_audience(segment, days):
+            try:
+                await context.bot.send_message(uid, f"📢 Админ рассылка:\n\n{text}")
+                count += 1
+            except Forbidden:
+                mark_blocked(uid)
+                blocked += 1
+            except Exception as e:
+                logger.warning(f"Ошибка отправки {uid}: {e}")
+            await traced_sleep(0.05)
+        if update.message:
+            await update.message.reply_text(
+                f"Рассылка отправлена {count} пользователям. Заблокировали бота: {blocked}.",
+                reply_markup=main_menu_keyboard(is_subscribed=True),
+            )
         return ConversationHandler.END
     except Exception as e:
         logger.error(f"Ошибка в admin_broadcast_handler: {e}")
@@ -1151,14 +3663,7 @@ async def leave_feedback_handler(update: Update, context: ContextTypes.DEFAULT_T
                 await update.message.reply_text("Отзыв слишком короткий. Напишите подробнее.", reply_markup=cancel_keyboard())
             return LEAVE_FEEDBACK
         add_feedback(user_id, text)
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_message(
-                    admin_id,
-                    f"Новый отзыв от @{update.effective_user.username}:\n\n{text}"
-                )
-            except Exception as e:
-                logger.error(f"Не удалось отправить отзыв админу {admin_id}: {e}")
+        notify_admins_background(context, f"Новый отзыв от @{update.effective_user.username}:\n\n{text}")
         if update.message:
             await update.message.reply_text(
                 "✅ Спасибо за ваш отзыв!",
@@ -1180,7 +3685,7 @@ async def exchange_bonus_handler(update: Update, context: ContextTypes.DEFAULT_T
         user_id = update.effective_user.id
         user = get_user(user_id)
         bonus = user['referral_bonus'] if user else 0
-        current_course = float(get_setting('course') or COURSE_DEFAULT)
+        current_course = float(get_setting('course') or tenant().course_default)
         try:
             amount = int(text.strip())
         except:
@@ -1200,15 +3705,11 @@ async def exchange_bonus_handler(update: Update, context: ContextTypes.DEFAULT_T
             if update.message:
                 await update.message.reply_text("Сумма слишком мала для обмена хотя бы на 1 звезду.", reply_markup=cancel_keyboard())
             return EXCHANGE_BONUS
-        # Списываем бонус и начисляем звёзды
-        try:
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute("UPDATE users SET referral_bonus = referral_bonus - ?, stars = stars + ? WHERE user_id = ?", (amount, stars, user_id))
-            conn.commit()
-        finally:
-            if conn:
-                conn.close()
+        # Списываем бонус и начисляем звёзды; баланс проверяется ещё раз в том же UPDATE
+        if exchange_bonus(user_id, amount, stars) is None:
+            if update.message:
+                await update.message.reply_text("У вас нет такой суммы бонуса.", reply_markup=cancel_keyboard())
+            return EXCHANGE_BONUS
         if update.message:
             await update.message.reply_text(f"✅ {amount}₽ успешно обменяны на {stars} звёзд!", reply_markup=main_menu_keyboard(is_subscribed=True))
         return ConversationHandler.END
@@ -1224,7 +3725,10 @@ def get_total_stars(user_id):
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute("SELECT SUM(stars_amount) FROM orders WHERE user_id=? AND paid=1", (user_id,))
+        cur.execute("""
+            SELECT COALESCE((SELECT SUM(stars_amount) FROM orders WHERE user_id=? AND status='confirmed'), 0)
+                 + COALESCE((SELECT stars_total FROM user_order_totals WHERE user_id=?), 0)
+        """, (user_id, user_id))
         res = cur.fetchone()
         return res[0] or 0
     except Exception as e:
@@ -1234,19 +3738,45 @@ def get_total_stars(user_id):
         if conn:
             conn.close()
 
+# Оборот рефералов: заказы читаются только из idx_orders_confirmed_revenue (покрывающий индекс)
+REFERRALS_REVENUE_SQL = """
+    SELECT
+        COALESCE((SELECT SUM(o.price) FROM referral_tree r JOIN orders o ON o.user_id = r.descendant
+                  WHERE r.ancestor = ? AND r.depth <= ? AND o.status = 'confirmed'), 0)
+      + COALESCE((SELECT SUM(t.price_total) FROM referral_tree r JOIN user_order_totals t ON t.user_id = r.descendant
+                  WHERE r.ancestor = ? AND r.depth <= ?), 0)
+"""
+
+def get_referrals_revenue(cur, user_id, max_depth=1):
+    """Сумма оплаченных покупок рефералов до уровня max_depth (по умолчанию — прямых):
+    свежие заказы + архивные итоги, по одному соединению с деревом рефералов"""
+    cur.execute(REFERRALS_REVENUE_SQL, (user_id, max_depth, user_id, max_depth))
+    return cur.fetchone()[0] or 0
+
+def get_referral_network(user_id):
+    """Вся сеть пользователя: (число участников, глубина, оборот)"""
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT COUNT(*), COALESCE(MAX(depth), 0) FROM referral_tree WHERE ancestor=?",
+            (user_id,),
+        )
+        size, depth = cur.fetchone()
+        return size, depth, get_referrals_revenue(cur, user_id, REFERRAL_MAX_DEPTH)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка подсчёта сети рефералов: {e}")
+        return 0, 0, 0
+    finally:
+        if conn:
+            conn.close()
+
 def get_referral_bonus(user_id):
     """Считает 5% от суммы всех покупок рефералов пользователя"""
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE referral_id=?", (user_id,))
-        refs = [row[0] for row in cur.fetchall()]
-        if not refs:
-            return 0
-        q_marks = ','.join(['?']*len(refs))
-        cur.execute(f"SELECT SUM(price) FROM orders WHERE user_id IN ({q_marks}) AND paid=1", refs)
-        res = cur.fetchone()
-        total = res[0] or 0
+        total = get_referrals_revenue(cur, user_id)
         return int(total * 0.05)
     except Exception as e:
         logger.error(f"Ошибка подсчёта бонуса: {e}")
@@ -1257,19 +3787,12 @@ def get_referral_bonus(user_id):
 
 def get_personal_course(user_id):
     """Персональный курс: за каждые 1000₽, потраченные рефералами, минус 0.01, но не ниже 1.45"""
-    base_course = float(get_setting('course') or COURSE_DEFAULT)
+    base_course = float(get_setting('course') or tenant().course_default)
     min_course = 1.45
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE referral_id=?", (user_id,))
-        refs = [row[0] for row in cur.fetchall()]
-        if not refs:
-            return base_course
-        q_marks = ','.join(['?']*len(refs))
-        cur.execute(f"SELECT SUM(price) FROM orders WHERE user_id IN ({q_marks}) AND paid=1", refs)
-        res = cur.fetchone()
-        total = res[0] or 0
+        total = get_referrals_revenue(cur, user_id)
         discount = int(total // 1000) * 0.01
         return max(base_course - discount, min_course)
     except Exception as e:
@@ -1279,15 +3802,402 @@ def get_personal_course(user_id):
         if conn:
             conn.close()
 
+# ========== ДИАГНОСТИКА ==========
+def describe_stall(frame):
+    """Кому приписать блокировку: обработчик апдейта, его callback_data и место в коде.
+    Берётся ближайший к месту блокировки кадр бота с переменной update — внешние кадры бота
+    (StoreApplication.process_update, фронт) есть в каждом стеке и обработчик не различают."""
+    bot_frames = []
+    innermost = frame
+    while frame is not None:
+        if frame.f_code.co_filename == __file__:
+            bot_frames.append(frame)
+        frame = frame.f_back
+    if not bot_frames:
+        return "unknown", f"{innermost.f_code.co_name}:{innermost.f_lineno}", ""
+    label = bot_frames[-1].f_code.co_name
+    for bot_frame in bot_frames:
+        update = bot_frame.f_locals.get("update")
+        if isinstance(update, Update):
+            label = f"{bot_frame.f_code.co_name}:{flood_action(update)}"
+            break
+    site = f"{innermost.f_code.co_name}:{innermost.f_lineno}"
+    stack = "".join(traceback.format_stack(innermost, limit=LOOP_STALL_STACK_DEPTH))
+    return label, site, stack
+
+class LoopWatchdog:
+    """Замер задержки цикла событий. Корутина-пульс отмечается каждые interval секунд;
+    поток-сторож при пропуске пульса снимает стек потока цикла и приписывает блокировку обработчику."""
+
+    def __init__(self, interval, threshold):
+        self.interval = interval
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.beat = time.monotonic()
+        self.stall = None
+        self.task = None
+
+    def start(self):
+        # Один сторож на процесс, сколько бы магазинов ни запускалось
+        if self.task is not None:
+            return
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag_ms = round(max(0.0, now - expected) * 1000)
+            metrics.set_gauge("loop.lag_ms", lag_ms)
+            with self.lock:
+                self.beat = now
+                stall, self.stall = self.stall, None
+            if stall:
+                label, site, stack = stall
+                metrics.inc(f"loop.stalls.{label}")
+                metrics.inc(f"loop.stall_ms.{label}", lag_ms)
+                logger.warning(f"Цикл событий заблокирован на {lag_ms} мс: {label} в {site}\n{stack}")
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                beat = self.beat
+                if self.stall or time.monotonic() - beat < self.interval + self.threshold:
+                    continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stall = describe_stall(frame)
+            with self.lock:
+                # Пульс мог вернуться, пока снимали стек — тогда блокировка уже закончилась
+                if self.beat == beat and self.stall is None:
+                    self.stall = stall
+
+loop_watchdog = LoopWatchdog(LOOP_HEARTBEAT_INTERVAL, LOOP_STALL_THRESHOLD)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class UpdateTrace:
+    """Спаны одного апдейта: (имя, категория, начало, длительность, аргументы)"""
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.start = time.perf_counter()
+        self.spans = []
+        self.closed = False
+
+@contextmanager
+def trace_span(name, category, **args):
+    """Дочерний спан текущего апдейта; вне апдейта ничего не делает"""
+    trace = current_trace.get()
+    if trace is None or trace.closed:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, category, start, time.perf_counter() - start, args))
+
+async def traced_sleep(delay):
+    """asyncio.sleep со спаном в трассе апдейта"""
+    with trace_span("sleep", "sleep", delay=delay):
+        await asyncio.sleep(delay)
+
+class TracedConnection(sqlite3.Connection):
+    """Соединение SQLite, время жизни которого пишется спаном хелпера БД"""
+
+    span = None
+
+    def begin_span(self, name):
+        trace = current_trace.get()
+        if trace is not None and not trace.closed:
+            self.span = (trace, name, time.perf_counter())
+
+    def close(self):
+        super().close()
+        if self.span:
+            trace, name, start = self.span
+            self.span = None
+            trace.spans.append((name, "db", start, time.perf_counter() - start, {}))
+
+class TracedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API со спаном на каждый вызов метода"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        with trace_span(url.rsplit("/", 1)[-1], "api"):
+            return await super().do_request(url, method, *args, **kwargs)
+
+class SharedRequest(TracedRequest):
+    """Пул HTTP-соединений, общий для ботов всех магазинов процесса.
+    Каждый бот инициализирует и закрывает его сам — пул закрывается, когда его отпустит последний."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.users = 0
+
+    async def initialize(self):
+        self.users += 1
+        await super().initialize()
+
+    async def shutdown(self):
+        self.users -= 1
+        if self.users <= 0:
+            await super().shutdown()
+
+class Tracer:
+    """Сбор трасс апдейтов и запись выбранных в файл Chrome Trace Event (открывается в Perfetto / chrome://tracing).
+    Файл — JSON-массив без закрывающей скобки: формат это допускает, а дописывать можно построчно."""
+
+    def __init__(self, path, sample_rate, slow_ms):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _event(self, trace, name, category, start, duration, args):
+        return json.dumps({
+            "name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": trace.update_id,
+            "ts": round(start * 1e6), "dur": round(duration * 1e6), "args": args,
+        }, ensure_ascii=False)
+
+    def _write(self, lines):
+        new_file = not os.path.exists(self.path)
+        with open(self.path, "a", encoding="utf-8") as f:
+            if new_file:
+                f.write("[\n")
+            f.write(",\n".join(lines) + ",\n")
+
+    async def finish(self, trace, name, args):
+        trace.closed = True
+        duration = time.perf_counter() - trace.start
+        if duration * 1000 < self.slow_ms and random() >= self.sample_rate:
+            return
+        metrics.inc("trace.sampled")
+        lines = [self._event(trace, name, "update", trace.start, duration, args)]
+        lines += [self._event(trace, *span) for span in trace.spans]
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except OSError as e:
+            logger.warning(f"Не удалось записать трассу: {e}")
+
+tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW_MS)
+
+class SeenUpdates:
+    """Недавно принятые update_id магазина. Если Telegram не дождался ответа webhook, он доставляет
+    апдейт повторно — такой апдейт отбрасывается до обработчиков (иначе двойной заказ или бонус).
+    Память ограничена и окном по времени, и числом записей."""
+
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # update_id -> время получения, старые в начале
+
+    def add(self, update_id):
+        """True — апдейт новый; False — уже принимался в пределах окна"""
+        now = time.monotonic()
+        while self.entries:
+            oldest_id, received = next(iter(self.entries.items()))
+            if now - received <= self.window and len(self.entries) < self.max_entries:
+                break
+            del self.entries[oldest_id]
+        if update_id in self.entries:
+            return False
+        self.entries[update_id] = now
+        return True
+
+    def discard(self, update_id):
+        self.entries.pop(update_id, None)
+
+class ConversationStore(BasePersistence):
+    """Хранение состояний ConversationHandler в БД магазина.
+    user_data уже живут в UserStateStore/user_state, поэтому здесь — только диалоги: новый владелец
+    пользователя (после перезапуска или смены WORKERS) продолжает диалог с того же шага.
+    Остальные данные PTB не сохраняются — их методы ничего не делают."""
+
+    def __init__(self, store):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=CONVERSATION_PERSIST_INTERVAL,
+        )
+        self.store = store
+
+    async def _run(self, function, *args):
+        """Запрос к БД магазина в потоке, чтобы не останавливать цикл событий"""
+        def call():
+            with use_tenant(self.store):
+                return function(*args)
+        return await asyncio.to_thread(call)
+
+    async def get_conversations(self, name):
+        return await self._run(load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        await self._run(save_conversation, name, key, new_state)
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+class StoreApplication(Application):
+    """Application одного магазина: делает его текущим на время обработки апдейта, отбрасывает
+    повторные доставки, пишет корневой спан трассы и хранит user_data в ограниченном UserStateStore вместо defaultdict"""
+
+    def __init__(self, *args, tenant=default_tenant, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tenant = tenant
+        self.seen_updates = SeenUpdates(WEBHOOK_DEDUP_WINDOW, WEBHOOK_DEDUP_MAX)
+        self._user_data = UserStateStore(USER_STATE_MAX_RESIDENT)
+        self.user_data = MappingProxyType(self._user_data)
+
+    async def process_update(self, update):
+        current_tenant.set(self.tenant)
+        if not isinstance(update, Update):
+            return await super().process_update(update)
+        # Апдейтов, ожидающих обработки после этого
+        metrics.set_gauge(f"updates.{self.tenant.name}.queue", self.update_queue.qsize())
+        if not self.seen_updates.add(update.update_id):
+            metrics.inc("updates.duplicates")
+            return
+        user = update.effective_user
+        if user is None:
+            return await self._process_traced(update)
+        # user_data пользователя не вытесняется, пока его апдейт обрабатывается
+        self._user_data.pin(user.id)
+        try:
+            await self._process_traced(update)
+        finally:
+            self._user_data.unpin(user.id)
+
+    def user_data_resident_bytes(self):
+        """Размер user_data в памяти (для /metrics)"""
+        return self._user_data.resident_bytes()
+
+    async def flush_user_data(self):
+        """Запись всех user_data в БД (при остановке)"""
+        await self._user_data.flush()
+
+    async def _process_traced(self, update):
+        if not tracer.enabled:
+            return await super().process_update(update)
+        trace = UpdateTrace(update.update_id)
+        token = current_trace.set(trace)
+        try:
+            await super().process_update(update)
+        finally:
+            current_trace.reset(token)
+            user = update.effective_user
+            await tracer.finish(trace, flood_action(update), {"user_id": user.id if user else None})
+
+class StoreContext(CallbackContext):
+    """CallbackContext, который делает магазин приложения текущим.
+    Задания JobQueue запускаются вне process_update — магазин для них выставляется здесь."""
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        current_tenant.set(application.tenant)
+
 # ========== ЗАПУСК БОТА ==========
-def main():
-    """Основная функция запуска бота"""
-    init_db()
+async def on_startup(application):
+    """Запуск фоновой диагностики в цикле событий бота"""
+    current_tenant.set(application.tenant)
+    loop_watchdog.start()
+
+async def on_stop(application):
+    """Досылка сводки и очереди уведомлений: post_stop вызывается, пока HTTP-клиент бота ещё открыт"""
+    current_tenant.set(application.tenant)
+    await admin_digest.flush(application.bot)
+    await notification_queue.stop()
+
+async def on_shutdown(application):
+    """Остановка фоновых обработчиков при завершении работы"""
+    current_tenant.set(application.tenant)
+    loop_watchdog.stop()
+    activity_tracker.flush()
+    await application.flush_user_data()
+
+def build_application(store, request=None, get_updates_request=None, shard=0, shards=1, init_schema=True):
+    """Application магазина со всеми обработчиками и фоновыми заданиями.
+    При работе в нескольких процессах общие для магазина задания выполняет только обработчик 0.
+    init_schema=False — схему и миграции уже выполнил фронт до запуска обработчиков."""
+    if init_schema:
+        init_db()
+    if shards > 1:
+        # Лимиты Telegram общие для бота: каждый процесс отправляет свою долю,
+        # сводку заказов ведёт обработчик 0, а порог сводки считается по доле заказов процесса
+        notification_queue.interval = shards / NOTIFY_RATE_PER_SEC
+        admin_digest.threshold = ADMIN_DIGEST_THRESHOLD / shards
+        admin_digest.relay = shard != 0
 
     # Создаем Application
-    application = (
+    builder = (
         ApplicationBuilder()
-        .token(TOKEN)
+        .application_class(StoreApplication, kwargs={"tenant": store})
+        .context_types(ContextTypes(context=StoreContext, user_data=UserState))
+        .token(store.token)
+        .persistence(ConversationStore(store))
+    )
+    if request:
+        builder = builder.request(request).get_updates_request(get_updates_request)
+    elif tracer.enabled:
+        builder = builder.request(TracedRequest(connection_pool_size=256))
+    application = (
+        builder
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
         .build()
     )
 
@@ -1299,10 +4209,17 @@ def main():
         entry_points=[
             CommandHandler("start", start),
             CommandHandler("admin", admin_command),
+            CommandHandler("pending", pending_command),
+            CommandHandler("metrics", metrics_command),
+            CommandHandler("export", export_command),
+            CommandHandler("find", find_command),
+            CommandHandler("report", report_command),
+            CommandHandler("rebuild_rollups", rebuild_rollups_command),
             CommandHandler("help", help_command),
             CallbackQueryHandler(button_handler),
         ],
         states={
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout_handler)],
             CHOOSING: [CallbackQueryHandler(button_handler)],
             BUY_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, buy_username_handler)],
             BUY_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, buy_amount_handler)],
@@ -1324,34 +4241,474 @@ def main():
             # MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_handler),
         ],
         allow_reentry=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="main",
+        persistent=True,
     )
 
     # Удаляю глобальный обработчик для текста с высоким приоритетом
     # application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_handler), group=-1)
     
+    # Отметка активности и ограничение частоты — раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, track_activity), group=-2)
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
     application.add_handler(conv_handler)
 
-    # Запуск очистки старых данных через JobQueue (если доступен)
+    # Периодическая очистка старых данных и обслуживание БД через JobQueue (если доступен)
+    if shard == 0:
+        try:
+            application.job_queue.run_repeating(maintenance_job, interval=MAINTENANCE_INTERVAL, first=5)
+        except Exception as e:
+            logger.warning(f"JobQueue не доступен или ошибка: {e}. Очистка старых данных будет выполнена сразу.")
+            clean_old_data()
+
+    # Периодическое обновление сводки заказов для админов
+    if ADMIN_DIGEST_ENABLED and shard == 0:
+        try:
+            application.job_queue.run_repeating(admin_digest_job, interval=ADMIN_DIGEST_INTERVAL, first=ADMIN_DIGEST_INTERVAL)
+        except Exception as e:
+            logger.warning(f"JobQueue не доступен: {e}. Сводка заказов отключена.")
+            admin_digest.enabled = False
+
+    # Фоновая загрузка скриншотов оплаты (по умолчанию только по запросу админа)
+    if PAYMENT_DOWNLOAD_INTERVAL and shard == 0:
+        try:
+            application.job_queue.run_repeating(payment_download_job, interval=PAYMENT_DOWNLOAD_INTERVAL, first=PAYMENT_DOWNLOAD_INTERVAL)
+        except Exception as e:
+            logger.warning(f"JobQueue не доступен: {e}. Фоновая загрузка скриншотов отключена.")
+
+    # Фоновое обновление статуса подписки в пределах бюджета запросов к API (бюджет делится между процессами)
+    if store.check_subscription:
+        try:
+            application.job_queue.run_repeating(subscription_refresh_job, interval=60 * shards / SUBSCRIPTION_API_BUDGET, first=1)
+        except Exception as e:
+            logger.warning(f"JobQueue не доступен: {e}. Статус подписки не будет обновляться.")
+
+    # Пакетная запись отметок активности
     try:
-        application.job_queue.run_once(lambda context: clean_old_data(), when=5)
+        application.job_queue.run_repeating(last_seen_job, interval=LAST_SEEN_FLUSH_INTERVAL, first=LAST_SEEN_FLUSH_INTERVAL)
     except Exception as e:
-        logger.warning(f"JobQueue не доступен или ошибка: {e}. Очистка старых данных будет выполнена сразу.")
-        clean_old_data()
+        logger.warning(f"JobQueue не доступен: {e}. Отметки активности не будут сохраняться.")
 
-    logger.info("Бот запущен")
-    
-    # Для хостинга используем webhook, для локальной разработки - polling
-    port = int(os.environ.get('PORT', 8080))
+    # Периодическое сжатие журнала баланса
+    if shard == 0:
+        try:
+            application.job_queue.run_repeating(ledger_compact_job, interval=LEDGER_COMPACT_INTERVAL, first=60)
+        except Exception as e:
+            logger.warning(f"JobQueue не доступен: {e}. Сжатие журнала отключено.")
+
+    return application
+
+def webhook_base_url():
+    """Адрес webhook на Railway; None — локальный запуск с polling"""
     if os.environ.get('RAILWAY_ENVIRONMENT'):
-        # На Railway используем webhook
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            webhook_url=f"https://{os.environ.get('RAILWAY_PUBLIC_DOMAIN')}.railway.app"
+        return f"https://{os.environ.get('RAILWAY_PUBLIC_DOMAIN')}.railway.app"
+    return None
+
+def update_shard_key(data):
+    """Ключ шардирования сырого апдейта — id пользователя (для апдейтов без пользователя — чата)"""
+    for payload in data.values():
+        if not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+async def enqueue_update(application, data):
+    """Апдейт из JSON webhook в очередь приложения магазина"""
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return True
+
+async def set_store_webhook(bot, store, base_url):
+    """Регистрация адреса магазина на общем webhook"""
+    await bot.set_webhook(f"{base_url}/{store.name}", secret_token=store.webhook_secret)
+
+class StoreWebhookFront:
+    """Общий HTTP-сервер webhook для всех магазинов: POST /<имя магазина>.
+    Апдейт с верным секретным заголовком передаётся deliver — в очередь приложения или процессу-обработчику."""
+
+    def __init__(self, stores, deliver):
+        self.stores = {store.name: store for store in stores}
+        self.seen = {store.name: SeenUpdates(WEBHOOK_DEDUP_WINDOW, WEBHOOK_DEDUP_MAX) for store in stores}
+        self.deliver = deliver  # корутина (магазин, dict апдейта) -> принят ли апдейт; не ждёт обработки
+        self.server = None
+
+    async def handle(self, name, secret, body):
+        """Код ответа HTTP на запрос Telegram"""
+        store = self.stores.get(name)
+        if store is None:
+            return 404
+        if secret != store.webhook_secret:
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return 400
+        seen = self.seen[name]
+        if not seen.add(data["update_id"]):
+            # Повторная доставка: отвечаем 200, чтобы Telegram перестал её повторять
+            metrics.inc("webhook.duplicates")
+            return 200
+        if not await self.deliver(store, data):
+            # 503 — Telegram повторит доставку, и она не должна считаться повтором
+            seen.discard(data["update_id"])
+            return 503
+        return 200
+
+    def start(self, port):
+        # tornado — необязательная зависимость из python-telegram-bot[webhooks], нужна только для webhook
+        import tornado.httpserver
+        import tornado.web
+
+        front = self
+
+        class WebhookHandler(tornado.web.RequestHandler):
+            async def post(self, name):
+                secret = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+                self.set_status(await front.handle(name, secret, self.request.body))
+
+        self.server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/([\w-]+)", WebhookHandler)]))
+        self.server.listen(port)
+
+    def stop(self):
+        if self.server:
+            self.server.stop()
+
+def stop_event():
+    """Событие остановки по SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+def build_applications(stores, shard=0, shards=1, init_schema=True):
+    """Приложения магазинов процесса с общим пулом HTTP-соединений"""
+    # Долгие getUpdates держат по соединению на магазин
+    request = SharedRequest(connection_pool_size=256)
+    get_updates_request = SharedRequest(connection_pool_size=len(stores) + 1)
+    applications = []
+    for store in stores:
+        with use_tenant(store):
+            applications.append(build_application(store, request, get_updates_request, shard, shards, init_schema))
+    return applications
+
+async def start_applications(applications, base_url=None, polling=True):
+    """Запуск приложений по очереди, как в run_polling/run_webhook. Возвращает запущенные"""
+    started = []
+    for application in applications:
+        with use_tenant(application.tenant) as store:
+            await application.initialize()
+            await on_startup(application)
+            started.append(application)
+            if base_url:
+                await set_store_webhook(application.bot, store, base_url)
+            elif polling:
+                await application.updater.start_polling()
+            await application.start()
+    return started
+
+async def stop_applications(started):
+    """Остановка приложений: очередь апдейтов дорабатывается, user_data и отметки активности пишутся в БД"""
+    for application in reversed(started):
+        with use_tenant(application.tenant):
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            # Тот же порядок, что в run_polling: post_stop, shutdown, post_shutdown
+            await on_stop(application)
+            await application.shutdown()
+            await on_shutdown(application)
+
+async def run_stores(applications, port):
+    """Все магазины в одном цикле событий: общий пул HTTP-соединений, журнал и метрики"""
+    stop = stop_event()
+    base_url = webhook_base_url()
+    by_name = {application.tenant.name: application for application in applications}
+    front = StoreWebhookFront(
+        [application.tenant for application in applications],
+        lambda store, data: enqueue_update(by_name[store.name], data),
+    )
+    started = []
+    try:
+        started = await start_applications(applications, base_url)
+        if base_url:
+            front.start(port)
+        logger.info(f"Запущено магазинов: {len(started)}")
+        await stop.wait()
+    finally:
+        front.stop()
+        await stop_applications(started)
+
+# ========== НЕСКОЛЬКО ПРОЦЕССОВ ==========
+# Фронт принимает webhook всех магазинов и раздаёт апдейты WORKERS процессам-обработчикам по id пользователя.
+# Обмен — строки JSON через unix-сокеты: {"store", "update"} фронт -> обработчик,
+# {"store", "invalidate"} обработчик -> фронт -> остальные обработчики (сброс кеша строк users),
+# {"store", "digest"} обработчик -> фронт -> обработчик 0 (строка сводки заказов для админов).
+
+def worker_socket_path(shard):
+    return os.path.join(WORKER_SOCKET_DIR, f"bot-worker-{shard}.sock")
+
+class ShardWorkerLink:
+    """Связь процесса-обработчика с фронтом. Вне режима нескольких процессов ничего не делает."""
+
+    def __init__(self):
+        self.applications = {}
+        self.writers = set()
+        self.readers = set()  # Задачи чтения соединений с фронтом
+        self.loop = None
+        self.server = None
+
+    async def serve(self, applications, path):
+        self.applications = {application.tenant.name: application for application in applications}
+        self.loop = asyncio.get_running_loop()
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = await asyncio.start_unix_server(self._client, path, limit=WORKER_MESSAGE_LIMIT)
+
+    async def close(self):
+        """Прекращение приёма апдейтов. Фронт при остановке сам закрывает соединение после отправки
+        своих очередей — дочитываем до конца потока, чтобы не потерять уже отправленные апдейты"""
+        if self.server:
+            self.server.close()
+        if self.readers:
+            await asyncio.wait(self.readers, timeout=WORKER_DRAIN_TIMEOUT)
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.sleep(0)
+        self.loop = None
+
+    async def _client(self, reader, writer):
+        self.writers.add(writer)
+        self.readers.add(asyncio.current_task())
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                application = self.applications.get(message["store"])
+                if application is None:
+                    continue
+                if "update" in message:
+                    await enqueue_update(application, message["update"])
+                elif "digest" in message:
+                    with use_tenant(application.tenant):
+                        admin_digest.add(message["digest"])
+                else:
+                    with use_tenant(application.tenant):
+                        user_cache.drop(*message["invalidate"])
+        finally:
+            self.readers.discard(asyncio.current_task())
+            self.writers.discard(writer)
+            writer.close()
+
+    def publish(self, store_name, user_ids=(), digest=None):
+        """Сброс кеша в остальных процессах или строка сводки для обработчика 0; вызывается из любого потока"""
+        if self.loop is None:
+            return
+        message = {"store": store_name, "digest": digest} if digest is not None else {"store": store_name, "invalidate": list(user_ids)}
+        line = (json.dumps(message, ensure_ascii=False) + "\n").encode()
+        self.loop.call_soon_threadsafe(self._send, line)
+
+    def _send(self, line):
+        for writer in self.writers:
+            writer.write(line)
+
+shard_link = ShardWorkerLink()
+
+async def run_worker(applications, shard):
+    """Процесс-обработчик: те же магазины, но апдейты своей доли пользователей приходят от фронта"""
+    stop = stop_event()
+    started = []
+    try:
+        started = await start_applications(applications, polling=False)
+        await shard_link.serve(applications, worker_socket_path(shard))
+        logger.info(f"Обработчик {shard} запущен, магазинов: {len(started)}")
+        await stop.wait()
+    finally:
+        await shard_link.close()
+        await stop_applications(started)
+
+class ShardRouter:
+    """Фронт нескольких процессов: апдейт уходит процессу-владельцу пользователя (rendezvous hashing).
+    Диалог, user_data и кеши пользователя живут только у владельца — без дублей и без расщепления состояния.
+    При смене WORKERS переезжает лишь доля пользователей добавленного или убранного процесса; их user_data
+    (on_shutdown) и шаг диалога (ConversationStore) к этому времени записаны в БД, и новый владелец загружает их оттуда.
+    При аварийном завершении обработчика теряются изменения диалогов за последние CONVERSATION_PERSIST_INTERVAL секунд."""
+
+    def __init__(self, count):
+        self.count = count
+        self.writers = {}  # номер обработчика -> StreamWriter
+        # Очереди переживают перезапуск обработчика: принятое, но не отправленное уйдёт новому процессу
+        self.queues = {shard: asyncio.Queue(WEBHOOK_QUEUE_LIMIT) for shard in range(count)}
+        self.connected = {shard: asyncio.Event() for shard in range(count)}
+        self.processes = {}
+        self.stopping = False
+
+    def owner(self, key):
+        return max(range(self.count), key=lambda shard: hashlib.blake2b(f"{shard}:{key}".encode(), digest_size=8).digest())
+
+    async def deliver(self, store, data):
+        """Постановка в очередь обработчика-владельца без ожидания отправки — webhook отвечает сразу"""
+        shard = self.owner(update_shard_key(data))
+        try:
+            self.queues[shard].put_nowait((json.dumps({"store": store.name, "update": data}, ensure_ascii=False) + "\n").encode())
+        except asyncio.QueueFull:
+            # Обработчик не успевает или долго перезапускается — Telegram повторит доставку позже
+            metrics.inc("shard.queue_full")
+            return False
+        metrics.inc(f"shard.{shard}.updates")
+        return True
+
+    async def send(self, shard):
+        """Отправка очереди обработчику; при разрыве соединения строка ждёт следующего подключения"""
+        queue = self.queues[shard]
+        while True:
+            line = await queue.get()
+            while True:
+                await self.connected[shard].wait()
+                writer = self.writers.get(shard)
+                if writer is None:
+                    self.disconnected(shard)
+                    continue
+                try:
+                    writer.write(line)
+                    await writer.drain()
+                    break
+                except ConnectionError:
+                    self.disconnected(shard)
+            queue.task_done()
+
+    def disconnected(self, shard):
+        self.writers.pop(shard, None)
+        self.connected[shard].clear()
+
+    async def supervise(self, shard):
+        """Запуск обработчика и перезапуск при аварийном завершении"""
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__),
+                env={**os.environ, "WORKER_INDEX": str(shard)},
+            )
+            self.processes[shard] = process
+            relay = asyncio.create_task(self._relay(shard, process))
+            code = await process.wait()
+            relay.cancel()
+            self.disconnected(shard)
+            if not self.stopping:
+                logger.error(f"Обработчик {shard} завершился с кодом {code}, перезапуск")
+                await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def _relay(self, shard, process):
+        """Подключение к обработчику и пересылка его сбросов кеша остальным, а строк сводки — обработчику 0"""
+        while process.returncode is None:
+            try:
+                reader, writer = await asyncio.open_unix_connection(worker_socket_path(shard), limit=WORKER_MESSAGE_LIMIT)
+                break
+            except OSError:
+                await asyncio.sleep(WORKER_CONNECT_RETRY)
+        else:
+            return
+        self.writers[shard] = writer
+        self.connected[shard].set()
+        logger.info(f"Обработчик {shard} подключён")
+        async for line in reader:
+            digest = b'"digest"' in line and "digest" in json.loads(line)
+            for other, other_writer in list(self.writers.items()):
+                if other != shard and (other == 0 or not digest):
+                    other_writer.write(line)
+
+    async def stop(self):
+        """Мягкая остановка. Webhook на принятые апдейты уже ответил 200 и Telegram их не повторит, поэтому:
+        очереди отправляются обработчикам, соединения закрываются (обработчик дочитывает их до конца),
+        и только затем обработчики получают SIGTERM, дорабатывают принятые апдейты и сохраняют состояние"""
+        self.stopping = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues.values())), WORKER_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            lost = sum(queue.qsize() for queue in self.queues.values())
+            logger.error(f"Не отправлено обработчикам при остановке: {lost} апдейтов")
+        for shard, writer in list(self.writers.items()):
+            self.disconnected(shard)
+            try:
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError as e:
+                logger.warning(f"Соединение с обработчиком {shard} закрылось при остановке: {e}")
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in self.processes.values()))
+
+async def log_front_stats(router):
+    """Периодическая запись в лог очередей фронта и отброшенных повторов (у фронта нет /metrics)"""
+    while True:
+        await asyncio.sleep(FRONT_STATS_INTERVAL)
+        depths = {shard: queue.qsize() for shard, queue in router.queues.items()}
+        for shard, depth in depths.items():
+            metrics.set_gauge(f"shard.{shard}.queue", depth)
+        counters, _ = metrics.snapshot()
+        logger.info(
+            f"Фронт: очереди обработчиков {depths}, повторов отброшено {counters.get('webhook.duplicates', 0)}, "
+            f"отказов из-за переполнения {counters.get('shard.queue_full', 0)}"
         )
-    else:
-        # Локально используем polling
-        application.run_polling()
+
+async def run_front(stores, port):
+    """Фронт: общий webhook, раздача апдейтов WORKERS обработчикам и их перезапуск"""
+    stop = stop_event()
+    router = ShardRouter(WORKERS)
+    supervisors = [asyncio.create_task(router.supervise(shard)) for shard in range(WORKERS)]
+    supervisors += [asyncio.create_task(router.send(shard)) for shard in range(WORKERS)]
+    supervisors.append(asyncio.create_task(log_front_stats(router)))
+    front = StoreWebhookFront(stores, router.deliver)
+    base_url = webhook_base_url()
+    try:
+        for store in stores:
+            async with Bot(store.token) as bot:
+                await set_store_webhook(bot, store, base_url)
+        front.start(port)
+        logger.info(f"Фронт запущен: магазинов {len(stores)}, обработчиков {WORKERS}")
+        await stop.wait()
+    finally:
+        # Сначала перестаём принимать апдейты, затем останавливаем обработчики
+        front.stop()
+        await router.stop()
+        for supervisor in supervisors:
+            supervisor.cancel()
+
+def main():
+    """Основная функция запуска бота"""
+    stores = load_tenants(TENANTS_CONFIG) if TENANTS_CONFIG else [default_tenant]
+    port = int(os.environ.get('PORT', 8080))
+    if os.environ.get("WORKER_INDEX"):
+        # Процесс-обработчик, запущенный фронтом
+        shard = int(os.environ["WORKER_INDEX"])
+        asyncio.run(run_worker(build_applications(stores, shard, WORKERS, init_schema=False), shard))
+        return
+    if WORKERS > 1 and webhook_base_url():
+        # Схема и миграции — один раз до запуска обработчиков, а не наперегонки из K процессов
+        for store in stores:
+            with use_tenant(store):
+                init_db()
+        asyncio.run(run_front(stores, port))
+        return
+    if len(stores) > 1 or webhook_base_url():
+        # Webhook всегда через StoreWebhookFront: мгновенный ответ, отсев повторов, проверка секрета
+        asyncio.run(run_stores(build_applications(stores), port))
+        return
+
+    with use_tenant(stores[0]):
+        application = build_application(stores[0])
+    logger.info("Бот запущен")
+    
+    # Локально используем polling
+    application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# bot.py при импорте создаёт bot.log и каталог payments в текущем каталоге
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
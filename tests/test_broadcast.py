@@ -0,0 +1,28 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+def press(store, data):
+    """Нажатие кнопки админом через таблицу маршрутов"""
+    query = SimpleNamespace(data=data, from_user=SimpleNamespace(id=1), message=None)
+    context = SimpleNamespace(user_data={})
+    with bot.use_tenant(store):
+        state = asyncio.run(bot.router.dispatch(query, context))
+    return state, context.user_data
+
+def test_active_segment_without_days_uses_default(tmp_path):
+    store = bot.Tenant("bcast", "1:test", db=str(tmp_path / "bcast.db"), admin_ids=[1], payments_dir=str(tmp_path / "payments"))
+    with bot.use_tenant(store):
+        bot.init_db()
+
+    state, user_data = press(store, "bcast_active")
+    assert state == bot.ADMIN_BROADCAST
+    assert user_data["broadcast_segment"] == ("active", max(bot.BROADCAST_ACTIVE_DAYS))
+
+    state, user_data = press(store, "bcast_active_7")
+    assert user_data["broadcast_segment"] == ("active", 7)
+
+    # Числовой хвост у сегментов без срока игнорируется
+    state, user_data = press(store, "bcast_all_5")
+    assert user_data["broadcast_segment"] == ("all", None)
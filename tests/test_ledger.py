@@ -0,0 +1,27 @@
+import sqlite3
+
+import bot
+
+def make_store(tmp_path):
+    store = bot.Tenant("ledger", "1:test", db=str(tmp_path / "ledger.db"), payments_dir=str(tmp_path / "payments"))
+    with bot.use_tenant(store):
+        bot.init_db()
+    return store
+
+def test_exchange_bonus_cannot_overdraw(tmp_path):
+    store = make_store(tmp_path)
+    with bot.use_tenant(store):
+        bot.register_user(1, "buyer")
+        conn = sqlite3.connect(store.db)
+        conn.execute("UPDATE users SET referral_bonus = 60 WHERE user_id = 1")
+        conn.commit()
+        conn.close()
+
+        # Два быстрых обмена по 50₽ при балансе 60₽: проходит только первый
+        assert bot.exchange_bonus(1, 50, 32) == 10
+        assert bot.exchange_bonus(1, 50, 32) is None
+
+        conn = sqlite3.connect(store.db)
+        assert conn.execute("SELECT referral_bonus, stars FROM users WHERE user_id = 1").fetchone() == (10, 32)
+        assert conn.execute("SELECT COUNT(*) FROM ledger WHERE reason = 'exchange'").fetchone()[0] == 1
+        conn.close()
@@ -0,0 +1,61 @@
+import sqlite3
+
+import bot
+
+# Схема базы до миграций (первая версия бота): без status у заказов и без служебных столбцов users
+LEGACY_SCHEMA = """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        stars INTEGER DEFAULT 0,
+        referral_id INTEGER,
+        referral_bonus INTEGER DEFAULT 0,
+        referrals_count INTEGER DEFAULT 0,
+        last_spin TEXT,
+        registration_date TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE orders (
+        order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        recipient_username TEXT,
+        stars_amount INTEGER,
+        price REAL,
+        paid INTEGER DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );
+    CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE feedback (
+        feedback_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        text TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );
+    INSERT INTO users (user_id, username, stars, referral_bonus) VALUES (1, 'buyer', 100, 0), (2, 'friend', 0, 15);
+    UPDATE users SET referral_id = 2 WHERE user_id = 1;
+    INSERT INTO orders (user_id, recipient_username, stars_amount, price, paid) VALUES (1, '@buyer', 100, 155, 1), (1, '@buyer', 50, 80, 0);
+"""
+
+def test_init_db_migrates_legacy_schema(tmp_path):
+    db = tmp_path / "legacy.db"
+    conn = sqlite3.connect(db)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+
+    store = bot.Tenant("legacy", "1:test", db=str(db), payments_dir=str(tmp_path / "payments"))
+    with bot.use_tenant(store):
+        bot.init_db()
+        # Повторный запуск на уже мигрированной базе тоже должен проходить
+        bot.init_db()
+
+    conn = sqlite3.connect(db)
+    statuses = [row[0] for row in conn.execute("SELECT status FROM orders ORDER BY order_id")]
+    assert statuses == ["confirmed", "claimed_paid"]
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_orders_confirmed_revenue" in indexes
+    # Планировщик действительно берёт частичный индекс и не читает строки заказов
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + bot.REFERRALS_REVENUE_SQL, (2, 5, 2, 5))]
+    assert any("COVERING INDEX idx_orders_confirmed_revenue" in step for step in plan), plan
+    assert conn.execute("SELECT ancestor, depth FROM referral_tree WHERE descendant = 1").fetchall() == [(2, 1)]
+    conn.close()
@@ -0,0 +1,40 @@
+import sqlite3
+
+import bot
+
+def test_order_pages_merge_hot_and_archive(tmp_path):
+    store = bot.Tenant("orders", "1:test", db=str(tmp_path / "orders.db"), payments_dir=str(tmp_path / "payments"))
+    with bot.use_tenant(store):
+        bot.init_db()
+        conn = sqlite3.connect(store.db)
+        # Заказ 1 ещё на проверке, 2 и 4 отклонены и уже в архиве, 3 и 5 — в горячей таблице
+        for order_id in (1, 3, 5):
+            conn.execute("INSERT INTO orders (order_id, user_id, status) VALUES (?, 7, 'claimed_paid')", (order_id,))
+        for order_id in (2, 4):
+            conn.execute("INSERT INTO orders_archive (order_id, user_id, status) VALUES (?, 7, 'rejected')", (order_id,))
+        conn.commit()
+        conn.close()
+
+        seen = []
+        before_id, more = None, True
+        while more:
+            page, more = bot.get_orders(7, before_id, limit=2)
+            seen += [order["order_id"] for order in page]
+            before_id = page[-1]["order_id"]
+    assert seen == [5, 4, 3, 2, 1]
+
+def test_expiry_keeps_orders_awaiting_review(tmp_path):
+    store = bot.Tenant("expiry", "1:test", db=str(tmp_path / "expiry.db"), payments_dir=str(tmp_path / "payments"))
+    with bot.use_tenant(store):
+        bot.init_db()
+        conn = sqlite3.connect(store.db)
+        for order_id, status in ((1, "awaiting_payment"), (2, "claimed_paid")):
+            conn.execute(
+                "INSERT INTO orders (order_id, user_id, status, created_at) VALUES (?, 7, ?, datetime('now', '-30 days'))",
+                (order_id, status),
+            )
+        conn.commit()
+        assert bot.expire_orders_batch() == 1
+        statuses = dict(conn.execute("SELECT order_id, status FROM orders").fetchall())
+        conn.close()
+    assert statuses == {1: "expired", 2: "claimed_paid"}
@@ -0,0 +1,34 @@
+import sqlite3
+import time
+
+import bot
+
+def test_rebuild_rollups_in_windows_matches_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "RETENTION_BATCH_PAUSE", 0)
+    store = bot.Tenant("rollups", "1:test", db=str(tmp_path / "rollups.db"), referral_levels=[10],
+                       payments_dir=str(tmp_path / "payments"))
+    now = int(time.time()) // 3600 * 3600
+    with bot.use_tenant(store):
+        bot.init_db()
+        conn = sqlite3.connect(store.db)
+        conn.execute("INSERT INTO users (user_id, registration_date) VALUES (1, datetime(?, 'unixepoch'))", (now - 200 * 86400,))
+        conn.execute("INSERT INTO users (user_id, referral_id, registration_date) VALUES (2, 1, datetime(?, 'unixepoch'))", (now,))
+        conn.execute("INSERT INTO referral_tree (ancestor, descendant, depth) VALUES (1, 2, 1)")
+        # Заказы в разных окнах пересчёта: полгода назад (архив), месяц назад и сейчас
+        conn.execute("INSERT INTO orders_archive (order_id, user_id, stars_amount, price, status, created_at, confirmed_at) "
+                     "VALUES (1, 2, 100, 150, 'confirmed', datetime(?, 'unixepoch'), datetime(?, 'unixepoch'))", (now - 180 * 86400,) * 2)
+        for order_id, age in ((2, 31 * 86400), (3, 0)):
+            conn.execute("INSERT INTO orders (order_id, user_id, stars_amount, price, status, created_at, confirmed_at) "
+                         "VALUES (?, 2, 50, 75, 'confirmed', datetime(?, 'unixepoch'), datetime(?, 'unixepoch'))", (order_id, now - age, now - age))
+        # Устаревшая строка итогов должна исчезнуть
+        conn.execute("INSERT INTO sales_rollup_hourly (hour_ts, orders_count) VALUES (3600, 99)")
+        conn.commit()
+        conn.close()
+
+        assert bot.rebuild_rollups() == 4
+        totals = bot.get_rollup_totals(0, now + 3600)
+    assert totals["orders_count"] == 3
+    assert totals["stars"] == 200
+    assert totals["revenue"] == 300
+    assert totals["new_users"] == 2
+    assert totals["referral_payouts"] == 15 + 7 + 7
@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+import bot
+
+STORE = {
+    "name": "second",
+    "token": "2:test",
+    "admin_ids": [7],
+    "channel_username": "@second_channel",
+    "payment_details": "0000 Банк",
+    "title": "Second Store",
+    "support_username": "@second_support",
+    "order_confirmed_text": "Спасибо!",
+}
+
+def write_config(tmp_path, entries):
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps(entries), encoding="utf-8")
+    return str(path)
+
+def test_store_settings_come_from_config(tmp_path):
+    (store,) = bot.load_tenants(write_config(tmp_path, [STORE]))
+    assert store.admin_ids == frozenset({7})
+    assert store.title == "Second Store"
+    assert store.order_rejected_text.endswith("@second_support")
+
+@pytest.mark.parametrize("field", ["admin_ids", "channel_username", "payment_details", "support_username"])
+def test_missing_store_field_fails_fast(tmp_path, field):
+    entry = {key: value for key, value in STORE.items() if key != field}
+    with pytest.raises(ValueError, match=field):
+        bot.load_tenants(write_config(tmp_path, [entry]))
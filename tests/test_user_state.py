@@ -0,0 +1,51 @@
+import asyncio
+
+import bot
+
+def make_store(tmp_path):
+    store = bot.Tenant("state", "1:test", db=str(tmp_path / "state.db"), payments_dir=str(tmp_path / "payments"))
+    with bot.use_tenant(store):
+        bot.init_db()
+    return store
+
+def test_pinned_state_is_not_paged_out(tmp_path):
+    store = make_store(tmp_path)
+
+    async def scenario():
+        states = bot.UserStateStore(max_resident=2)
+        states.pin(1)
+        held = states[1]
+        held["stars_amount"] = 100
+        states[2]["stars_amount"] = 200
+        states[3]["stars_amount"] = 300
+        # Обработчик пользователя 1 ещё работает — вытесняется давно не использованный 2
+        assert 1 in states and 2 not in states
+        held["price"] = 150.0
+        states.unpin(1)
+        await states.writer
+        assert states[2]["stars_amount"] == 200
+        await states.flush()
+        return bot.load_user_state(1)
+
+    with bot.use_tenant(store):
+        saved = asyncio.run(scenario())
+    assert bot.UserState.from_json(saved)["price"] == 150.0
+
+def test_state_being_written_is_reused_not_reloaded(tmp_path):
+    store = make_store(tmp_path)
+
+    async def scenario():
+        states = bot.UserStateStore(max_resident=1)
+        states[1]["stars_amount"] = 100
+        states[2]["stars_amount"] = 200
+        # Запись вытесненного 1 ещё не выполнена, а он снова нужен — берётся тот же объект
+        assert 1 in states.paging_out
+        first = states[1]
+        first["stars_amount"] = 101
+        await states.flush()
+        return first
+
+    with bot.use_tenant(store):
+        first = asyncio.run(scenario())
+        assert bot.UserState.from_json(bot.load_user_state(1))["stars_amount"] == 101
+    assert first["stars_amount"] == 101
@@ -0,0 +1,24 @@
+import re
+import sqlite3
+
+import bot
+
+def test_register_user_invalidates_only_changed_rows(tmp_path, monkeypatch):
+    published = []
+    monkeypatch.setattr(bot.shard_link, "publish", lambda store, user_ids: published.append(tuple(user_ids)))
+    store = bot.Tenant("users", "1:test", db=str(tmp_path / "users.db"), payments_dir=str(tmp_path / "payments"))
+    with bot.use_tenant(store):
+        bot.init_db()
+        assert bot.register_user(1, "referrer")
+        assert bot.register_user(2, "buyer", referral_id=1)
+        # Повторный /start без изменений ничего не сбрасывает в других процессах
+        assert not bot.register_user(2, "buyer", referral_id=1)
+        assert not bot.register_user(2, "renamed")
+
+        conn = sqlite3.connect(store.db)
+        rows = conn.execute("SELECT username, referral_id, registration_date FROM users WHERE user_id = 2").fetchone()
+        conn.close()
+    assert published == [(1,), (2, 1), (2,)]
+    assert rows[:2] == ("renamed", 1)
+    # Тот же формат, что у CURRENT_TIMESTAMP в старых строках
+    assert re.fullmatch(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d", rows[2])